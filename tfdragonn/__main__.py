@@ -5,17 +5,31 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import importlib
 import sys
 
-import tfdragonn.model_runner
-import tfdragonn.preprocessing.preprocess
-
-
+# Subcommands as 'module:attribute', imported only when they are run so --help and
+# commands like labelregions start without importing Keras and TensorFlow. Runner
+# classes are instantiated and run with their run_from_args.
 command_functions = {
-    'train': tfdragonn.model_runner.TrainRunner().run_from_args,
-    'test': tfdragonn.model_runner.TestRunner().run_from_args,
-    'predict': tfdragonn.model_runner.PredictRunner().run_from_args,  # TODO: make a predict module
-    'labelregions': tfdragonn.preprocessing.preprocess.run_label_regions_from_args,
+    'train': 'tfdragonn.model_runner:TrainRunner',
+    'sweep': 'tfdragonn.model_runner:SweepRunner',
+    'distill': 'tfdragonn.model_runner:DistillRunner',
+    'calibrate-cascade': 'tfdragonn.model_runner:CascadeRunner',
+    'test': 'tfdragonn.model_runner:TestRunner',
+    'predict': 'tfdragonn.model_runner:PredictRunner',  # TODO: make a predict module
+    'predict-genome': 'tfdragonn.genome_prediction:run_predict_genome_from_args',
+    'serve': 'tfdragonn.serving:run_serve_from_args',
+    'export-model': 'tfdragonn.numpy_inference:run_export_model_from_args',
+    'benchmark-model': 'tfdragonn.benchmarks.model_benchmark:run_benchmark_model_from_args',
+    'benchmark-pipeline':
+        'tfdragonn.benchmarks.pipeline_benchmark:run_benchmark_pipeline_from_args',
+    'benchmark-startup': 'tfdragonn.benchmarks.startup_benchmark:run_benchmark_startup_from_args',
+    'analyze-model': 'tfdragonn.model_analysis:run_analyze_model_from_args',
+    'labelregions': 'tfdragonn.preprocessing.preprocess:run_label_regions_from_args',
+    'fuseinputs': 'tfdragonn.preprocessing.fuse_inputs:run_fuse_inputs_from_args',
+    'mergeintervals': 'tfdragonn.preprocessing.merge_intervals:run_merge_intervals_from_args',
+    'scanpwms': 'tfdragonn.preprocessing.scan_pwms:run_scan_pwms_from_args',
 }
 commands_str = ', '.join(command_functions.keys())
 
@@ -25,13 +39,38 @@ parser = argparse.ArgumentParser(
 
     The tfdragonn commands are:
     train           Train a model
+    sweep           Train many models against one shared data stream
+    distill         Train a compact model on the predictions of a trained model
+    calibrate-cascade
+                    Calibrate a screen model gating a trained model
     test            Test a model
     predict         Run prediction on a list of regions
+    predict-genome  Run prediction on windows tiling each chromosome
+    serve           Serve a model on localhost for interactive scoring
+    export-model    Export a trained model for prediction with numpy only
+    benchmark-model Time models on synthetic inputs
+    analyze-model   Compute receptive field, parameters and FLOPs of a model spec
+    benchmark-pipeline
+                    Time labelregions, train, test and predict on a synthetic genome
+    benchmark-startup
+                    Time the startup of commands that should not import TensorFlow
     labelregions    Label a list of regions for training
+    fuseinputs      Stack single track data dirs into multi-channel data dirs
+    mergeintervals  Merge intervalspecs into one multi-task intervalspec
+    scanpwms        Write pwm score tracks of the genome as data dirs
     ''')
 parser.add_argument('command', help='Subcommand to run; possible commands: {}'.format(commands_str))
 
 
+def get_command_function(command):
+    """Imports the module of a command and returns its command function."""
+    module_name, attr_name = command_functions[command].split(':')
+    command_fn = getattr(importlib.import_module(module_name), attr_name)
+    if isinstance(command_fn, type):
+        command_fn = command_fn().run_from_args
+    return command_fn
+
+
 def main():
     args = parser.parse_args(sys.argv[1:2])
     if args.command not in command_functions:
@@ -40,7 +79,7 @@ def main():
             status=1,
             message='\nCommand `{}` not found. Possible commands: {}\n'.format(
                 args.command, commands_str))
-    command_fn = command_functions[args.command]
+    command_fn = get_command_function(args.command)
     command_fn(args.command, sys.argv[2:])
 
 
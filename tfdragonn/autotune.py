@@ -0,0 +1,166 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import time
+
+import numpy as np
+import psutil
+
+# Batch sizes timed by the autotune probe
+DEFAULT_CANDIDATE_BATCH_SIZES = [128, 256, 512, 1000, 2000, 4000]
+
+# Default share of the available memory the probe may use
+DEFAULT_MEMORY_FRACTION = 0.5
+
+# Number of timed predictions per candidate, after one warm up prediction
+DEFAULT_NUM_REPEATS = 3
+
+# Autotune results file in the logdir, keyed by architecture and host
+CACHE_FNAME = 'batch_size_autotune.json'
+
+
+def architecture_key(inference_models, rc_average=False):
+    """
+    Returns a hash of the layers of the models and their input shapes.
+
+    Layer names are left out, they depend on the order models are built in.
+    """
+    description = [[(layer.__class__.__name__, str(layer.output_shape), layer.count_params())
+                    for layer in model.model.layers]
+                   for model in inference_models]
+    return hashlib.sha1(json.dumps([description, rc_average]).encode('utf-8')).hexdigest()
+
+
+def host_key():
+    return '{}/{}cpus/gpus={}'.format(socket.gethostname(), multiprocessing.cpu_count(),
+                                      os.environ.get('CUDA_VISIBLE_DEVICES', ''))
+
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process, ru_maxrss is in kB on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 10**3
+
+
+def resize_batch(batch, batch_size):
+    """Repeats or truncates the examples of a batch dict to batch_size."""
+    indices = None
+    resized_batch = {}
+    for name, values in batch.items():
+        if indices is None:
+            indices = np.arange(batch_size) % len(values)
+        resized_batch[name] = values[indices]
+    return resized_batch
+
+
+def get_probe_batch(queue, batch_size):
+    """Dequeues a single batch of up to batch_size examples."""
+    from tfdragonn import gf_io_utils
+
+    iterator = gf_io_utils.ExampleQueueIterator(
+        queue, num_exs_batch=batch_size, num_epochs=1, allow_smaller_final_batch=True)
+    try:
+        return next(iterator)
+    finally:
+        iterator.close()
+
+
+def time_batch_sizes(inference_models, batch, candidate_batch_sizes=DEFAULT_CANDIDATE_BATCH_SIZES,
+                     max_memory_mb=None, rc_average=False, num_repeats=DEFAULT_NUM_REPEATS,
+                     logger=None):
+    """
+    Times predictions of all models on a batch resized to each candidate batch size.
+
+    Candidates are tried in increasing order and the probe stops once the
+    peak memory of a candidate, or the projection of the next one from the
+    memory per example so far, exceeds max_memory_mb. The resident memory
+    does not include device memory, e.g. of a GPU, the probe also stops at
+    the first candidate that runs out of it.
+    Returns an OrderedDict of batch size -> examples/sec.
+    """
+    import tensorflow as tf
+
+    if max_memory_mb is None:
+        max_memory_mb = DEFAULT_MEMORY_FRACTION * psutil.virtual_memory().available / 10**6
+    process = psutil.Process(os.getpid())
+    baseline_rss_mb = process.memory_info().rss / 10**6
+    baseline_peak_rss_mb = get_peak_rss_mb()
+    memory_per_example_mb = 0
+    examples_per_sec = collections.OrderedDict()
+    for batch_size in sorted(candidate_batch_sizes):
+        if memory_per_example_mb * batch_size > max_memory_mb:
+            break
+        resized_batch = resize_batch(batch, batch_size)
+        try:
+            for model in inference_models:  # warm up
+                model.predict_on_batch(resized_batch, rc_average=rc_average)
+            start_time = time.time()
+            for _ in range(num_repeats):
+                for model in inference_models:
+                    model.predict_on_batch(resized_batch, rc_average=rc_average)
+        except tf.errors.ResourceExhaustedError:
+            if logger is not None:
+                logger.info('batch size {}: out of device memory'.format(batch_size))
+            break
+        examples_per_sec[batch_size] = batch_size * num_repeats / (time.time() - start_time)
+        # the peak only reflects this probe once it exceeds the peak before it
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb <= baseline_peak_rss_mb:
+            peak_rss_mb = process.memory_info().rss / 10**6
+        memory_mb = peak_rss_mb - baseline_rss_mb
+        memory_per_example_mb = max(memory_per_example_mb, memory_mb / batch_size)
+        if logger is not None:
+            logger.info('batch size {}: {:.0f} examples/sec, {:.0f} Mb'.format(
+                batch_size, examples_per_sec[batch_size], memory_mb))
+        if memory_mb > max_memory_mb:
+            del examples_per_sec[batch_size]
+            break
+    if not examples_per_sec:
+        raise ValueError('No candidate batch size fits in {:.0f} Mb or in device memory'.format(
+            max_memory_mb))
+    return examples_per_sec
+
+
+def autotune_batch_size(inference_models, get_batch, logdir,
+                        candidate_batch_sizes=DEFAULT_CANDIDATE_BATCH_SIZES,
+                        max_memory_mb=None, rc_average=False, logger=None):
+    """
+    Returns the batch size with the highest measured throughput.
+
+    The choice is cached in the logdir per architecture and host, so the probe
+    only runs once. get_batch(batch_size) is called on a cache miss and returns
+    a real batch the candidates are timed on.
+    """
+    cache_fname = os.path.join(logdir, CACHE_FNAME)
+    cache = {}
+    if os.path.isfile(cache_fname):
+        with open(cache_fname, 'r') as fp:
+            cache = json.load(fp)
+    key = '{}@{}'.format(architecture_key(inference_models, rc_average), host_key())
+    if key in cache:
+        if logger is not None:
+            logger.info('Using cached batch size {}'.format(cache[key]['batch_size']))
+        return cache[key]['batch_size']
+
+    if logger is not None:
+        logger.info('Autotuning batch size...')
+    batch = get_batch(max(candidate_batch_sizes))
+    examples_per_sec = time_batch_sizes(
+        inference_models, batch, candidate_batch_sizes, max_memory_mb=max_memory_mb,
+        rc_average=rc_average, logger=logger)
+    batch_size = max(examples_per_sec, key=examples_per_sec.get)
+    cache[key] = {'batch_size': batch_size,
+                  'host': host_key(),
+                  'examples_per_sec': {str(size): rate for size, rate in examples_per_sec.items()}}
+    with open(cache_fname, 'w') as fp:
+        json.dump(cache, fp, indent=4)
+    if logger is not None:
+        logger.info('Selected batch size {}'.format(batch_size))
+    return batch_size
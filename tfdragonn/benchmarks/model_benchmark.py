@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from tfdragonn import loggers
+from tfdragonn.autotune import get_peak_rss_mb
+from tfdragonn.model_specs import get_config_input_shapes, load_model_config, model_inputs
+
+LOGGER_NAME = 'tfdragonn-benchmark-model'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Table columns, in order, with their value formats
+TABLE_COLUMNS = collections.OrderedDict([
+    ('model', '{}'),
+    ('interval_length', '{}'),
+    ('batch_size', '{}'),
+    ('params', '{}'),
+    ('flops_per_example', '{:.3g}'),
+    ('forward_examples_per_sec', '{:.0f}'),
+    ('train_examples_per_sec', '{:.0f}'),
+    ('peak_rss_mb', '{:.0f}'),
+])
+
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn benchmark-model',
+                                     description='Time models on synthetic inputs.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('modelspecs', type=os.path.abspath, nargs='*',
+                        help='Model parameters json file paths.\n'
+                        'Default: every classifier with default hyperparameters.')
+    parser.add_argument('--visiblegpus', type=str, default='',
+                        help='Visible GPUs string.\nDefault: none.')
+    parser.add_argument('--num-tasks', type=int, default=1,
+                        help='Number of tasks.\nDefault: 1.')
+    parser.add_argument('--batch-sizes', type=json.loads, default=[128, 256, 1000],
+                        help='Batch sizes as a json string.\nDefault: [128, 256, 1000].')
+    parser.add_argument('--interval-lengths', type=json.loads, default=[1000],
+                        help='Interval lengths as a json string.\nDefault: [1000].')
+    parser.add_argument('--num-repeats', type=int, default=5,
+                        help='Number of timed steps per configuration.\nDefault: 5.')
+    parser.add_argument('--no-train', action='store_true',
+                        help='Only time forward steps.')
+    parser.add_argument('--output', type=os.path.abspath, default=None,
+                        help='Json file to write the results to.\nDefault: none.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_benchmark_model_from_args(command, args):
+    args = parse_args(args)
+    model_configs = [load_model_config(modelspec) for modelspec in args.modelspecs]
+    if not model_configs:
+        model_configs = default_model_configs()
+    results = []
+    for model_config in model_configs:
+        results += benchmark_model(model_config, args.num_tasks, args.batch_sizes,
+                                   args.interval_lengths, num_repeats=args.num_repeats,
+                                   train=not args.no_train, visiblegpus=args.visiblegpus)
+    print(format_table(results))
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+        _logger.info('Saved results to {}'.format(args.output))
+
+
+def default_model_configs():
+    """Configs of every classifier that builds without extra files, e.g. pwms."""
+    model_configs = []
+    for model_class_name in sorted(model_inputs):
+        if 'Baseline' in model_class_name:
+            _logger.info('Skipping {}, it needs pwm_paths in a model spec'.format(
+                model_class_name))
+            continue
+        model_configs.append({'model_class': model_class_name})
+    return model_configs
+
+
+def synthetic_batch(shapes, batch_size, rng):
+    """Random one-hot sequence and uniform tracks."""
+    batch = {}
+    for input_name, shape in shapes.items():
+        if input_name == 'data/genome_data_dir':
+            bases = rng.randint(4, size=(batch_size, shape[1]))
+            batch[input_name] = np.eye(4, dtype=np.float32)[bases].transpose((0, 2, 1))
+        else:
+            batch[input_name] = rng.rand(batch_size, *shape).astype(np.float32)
+    return batch
+
+
+def time_steps(step, num_repeats):
+    """Returns the seconds per step, after one warm up step."""
+    step()
+    start_time = time.time()
+    for _ in range(num_repeats):
+        step()
+    return (time.time() - start_time) / num_repeats
+
+
+def benchmark_model(model_config, num_tasks, batch_sizes, interval_lengths,
+                    num_repeats=5, train=True, seed=0, visiblegpus=''):
+    """
+    Times forward and train steps of a model on synthetic inputs.
+
+    Each configuration of interval length and batch size runs in a new
+    process, so its peak memory is not set by an earlier one. Returns a list
+    of result dicts, one per configuration.
+    """
+    results = []
+    for interval_length in interval_lengths:
+        for batch_size in sorted(batch_sizes):
+            _logger.info('Timing {} on {} bp intervals with batch size {}...'.format(
+                model_config['model_class'], interval_length, batch_size))
+            pool = multiprocessing.Pool(1)
+            try:
+                results.append(pool.apply(_benchmark_configuration, (
+                    model_config, num_tasks, batch_size, interval_length, num_repeats, train,
+                    seed, visiblegpus)))
+            finally:
+                pool.close()
+                pool.join()
+    return results
+
+
+def _benchmark_configuration(model_config, num_tasks, batch_size, interval_length,
+                             num_repeats, train, seed, visiblegpus):
+    """Builds and times a model in a benchmark process, see benchmark_model."""
+    from tfdragonn import models
+    from tfdragonn import trainers
+    from tfdragonn.model_analysis import analyze_model_config
+    from tfdragonn.model_runner import BaseModelRunner
+
+    BaseModelRunner.setup_keras_session(visiblegpus)
+    model_config = dict(model_config)
+    model_class_name = model_config.pop('model_class')
+    shapes = get_config_input_shapes(
+        dict(model_config, model_class=model_class_name), interval_length)
+    # FLOPs of the static analysis, the same as analyze-model reports
+    flops = analyze_model_config(
+        dict(model_config, model_class=model_class_name), shapes, num_tasks).flops_per_example
+    model = getattr(models, model_class_name)(shapes, num_tasks, **model_config)
+    if train:
+        trainers.ClassifierTrainer().compile(model)
+    rng = np.random.RandomState(seed)
+    batch = synthetic_batch(shapes, batch_size, rng)
+    labels = rng.randint(2, size=(batch_size, num_tasks)).astype(np.float32)
+    forward_time = time_steps(lambda: model.predict_on_batch(batch), num_repeats)
+    result = collections.OrderedDict([
+        ('model', model_class_name),
+        ('interval_length', interval_length),
+        ('batch_size', batch_size),
+        ('params', model.model.count_params()),
+        ('flops_per_example', flops),
+        ('forward_examples_per_sec', batch_size / forward_time),
+        ('train_examples_per_sec', None),
+    ])
+    if train:
+        train_time = time_steps(lambda: model.model.train_on_batch(batch, labels), num_repeats)
+        result['train_examples_per_sec'] = batch_size / train_time
+    result['peak_rss_mb'] = get_peak_rss_mb()
+    return result
+
+
+def format_table(results):
+    """Right aligned table of the results, with the model names left aligned."""
+    rows = [list(TABLE_COLUMNS.keys())]
+    for result in results:
+        rows.append(['-' if result[column] is None else fmt.format(result[column])
+                     for column, fmt in TABLE_COLUMNS.items()])
+    widths = [max(len(row[indx]) for row in rows) for indx in range(len(TABLE_COLUMNS))]
+    return '\n'.join('  '.join([row[0].ljust(widths[0])] +
+                               [value.rjust(width) for value, width in zip(row[1:], widths[1:])])
+                     for row in rows)
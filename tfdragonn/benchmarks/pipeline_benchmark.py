@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from tfdragonn import loggers
+from tfdragonn.extractors import write_array_dir
+
+LOGGER_NAME = 'tfdragonn-benchmark-pipeline'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# labelregions keeps bins on chr1-22, X, Y at least 5kb from the chromosome edges
+MAX_NUM_CHROMS = 22
+REGION_EDGE_DISTANCE = 10000
+
+TASK_NAME = 'SYNTHETIC'
+DATASET_ID = 'synthetic'
+
+# A CREB/ATF like motif planted at the center of each peak
+DEFAULT_MOTIF = 'TGACGTCA'
+
+# A small sequence and DNase model
+DEFAULT_MODELSPEC = collections.OrderedDict([
+    ('model_class', 'SequenceAndDnaseClassifier'),
+    ('num_seq_filters', [15, 15]),
+    ('seq_conv_width', [15, 15]),
+    ('num_dnase_filters', [15, 15]),
+    ('dnase_conv_width', [15, 15]),
+    ('num_combined_filters', [15]),
+    ('combined_conv_width', [15]),
+    ('fc_layer_widths', [20]),
+])
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn benchmark-pipeline',
+                                     description='Time labelregions, train, test and predict on'
+                                     ' a synthetic genome.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('workdir', type=os.path.abspath,
+                        help='Directory for the synthetic data and the run outputs')
+    parser.add_argument('--output', type=os.path.abspath, default=None,
+                        help='Json file to write the results to.\nDefault: <workdir>/results.json.')
+    parser.add_argument('--num-chroms', type=int, default=3,
+                        help='Number of synthetic chromosomes.\nDefault: 3.')
+    parser.add_argument('--chrom-size', type=int, default=500000,
+                        help='Size of each synthetic chromosome.\nDefault: 500000.')
+    parser.add_argument('--num-peaks', type=int, default=200,
+                        help='Number of peaks with planted motifs per chromosome.\nDefault: 200.')
+    parser.add_argument('--num-epochs', type=int, default=2,
+                        help='Number of training epochs.\nDefault: 2.')
+    parser.add_argument('--epoch-size', type=int, default=10000,
+                        help='Number of training examples per epoch.\nDefault: 10000.')
+    parser.add_argument('--batch-size', type=int, default=128,
+                        help='Training batch size.\nDefault: 128.')
+    parser.add_argument('--modelspec', type=os.path.abspath, default=None,
+                        help='Model parameters json file path.\nDefault: a small SequenceAndDnaseClassifier.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the synthetic data.\nDefault: 0.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_benchmark_pipeline_from_args(command, args):
+    args = parse_args(args)
+    results = benchmark_pipeline(args.workdir, num_chroms=args.num_chroms,
+                                 chrom_size=args.chrom_size, num_peaks=args.num_peaks,
+                                 num_epochs=args.num_epochs, epoch_size=args.epoch_size,
+                                 batch_size=args.batch_size, modelspec=args.modelspec,
+                                 seed=args.seed)
+    output = args.output or os.path.join(args.workdir, 'results.json')
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=4)
+    _logger.info('Saved results to {}'.format(output))
+
+
+def generate_synthetic_data(data_dir, num_chroms=3, chrom_size=500000, num_peaks=200,
+                            motif=DEFAULT_MOTIF, peak_width=200, seed=0):
+    """
+    Writes a synthetic genome, DNase track and peaks with planted motifs.
+
+    Each peak has the motif, on a random strand, at its center and elevated
+    DNase signal. As many decoy regions get the DNase signal but no motif, so
+    models need both inputs. Returns the paths of the written files and the
+    chromosome names.
+    """
+    if num_chroms > MAX_NUM_CHROMS:
+        raise ValueError('At most {} synthetic chromosomes are supported'.format(MAX_NUM_CHROMS))
+    if chrom_size <= 2 * REGION_EDGE_DISTANCE + peak_width:
+        raise ValueError('Chromosomes must be longer than {} bp'.format(
+            2 * REGION_EDGE_DISTANCE + peak_width))
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    rng = np.random.RandomState(seed)
+    # ACGT base indices, the reverse complement of base i is 3 - i
+    motif = np.array(['ACGT'.index(base) for base in motif])
+    motif_rc = 3 - motif[::-1]
+    chroms = ['chr{}'.format(indx + 1) for indx in range(num_chroms)]
+    genome = {}
+    dnase = {}
+    peaks = []
+    for chrom in chroms:
+        bases = rng.randint(4, size=chrom_size)
+        signal = rng.gamma(1., 0.5, size=chrom_size).astype(np.float32)
+        centers = rng.choice(np.arange(REGION_EDGE_DISTANCE + peak_width,
+                                       chrom_size - REGION_EDGE_DISTANCE - peak_width,
+                                       2 * peak_width),
+                             size=2 * num_peaks, replace=False)
+        for indx, center in enumerate(centers):
+            signal[center - peak_width // 2:center + peak_width // 2] += rng.gamma(5., 1.)
+            if indx < num_peaks:  # the rest are decoys
+                motif_start = center - len(motif) // 2
+                bases[motif_start:motif_start + len(motif)] = motif if rng.rand() < 0.5 else motif_rc
+                peaks.append((chrom, center - peak_width // 2, center + peak_width // 2))
+        genome[chrom] = np.eye(4, dtype=np.float32)[bases]
+        dnase[chrom] = signal
+
+    paths = {'genome_data_dir': os.path.join(data_dir, 'genome_data_dir'),
+             'dnase_data_dir': os.path.join(data_dir, 'dnase_data_dir'),
+             'peaks': os.path.join(data_dir, 'peaks.bed.gz'),
+             'regions': os.path.join(data_dir, 'regions.bed'),
+             'chrom_sizes': os.path.join(data_dir, 'chrom.sizes')}
+    write_array_dir(paths['genome_data_dir'], genome)
+    write_array_dir(paths['dnase_data_dir'], dnase)
+    with gzip.open(paths['peaks'], 'wb') as fp:
+        for chrom, start, end in sorted(peaks, key=lambda peak: (chroms.index(peak[0]), peak[1])):
+            fp.write('{}\t{}\t{}\n'.format(chrom, start, end).encode('ascii'))
+    with open(paths['regions'], 'w') as fp:
+        for chrom in chroms:
+            fp.write('{}\t{}\t{}\n'.format(chrom, REGION_EDGE_DISTANCE, chrom_size - REGION_EDGE_DISTANCE))
+    with open(paths['chrom_sizes'], 'w') as fp:
+        for chrom in chroms:
+            fp.write('{}\t{}\n'.format(chrom, chrom_size))
+    return paths, chroms
+
+
+def write_specs(spec_dir, paths, modelspec=None):
+    """Writes the raw intervals, dataset and model specs of the synthetic data."""
+    specs = {'raw_intervals': os.path.join(spec_dir, 'raw_intervals.json'),
+             'datasetspec': os.path.join(spec_dir, 'datasetspec.json'),
+             'modelspec': os.path.join(spec_dir, 'modelspec.json')}
+    raw_intervals = collections.OrderedDict([
+        ('task_names', [TASK_NAME]),
+        (DATASET_ID, {'feature_beds': {TASK_NAME: paths['peaks']},
+                      'region_bed': paths['regions']})])
+    datasetspec = {DATASET_ID: {'genome_data_dir': paths['genome_data_dir'],
+                                'dnase_data_dir': paths['dnase_data_dir']}}
+    if modelspec is not None:
+        with open(modelspec, 'r') as fp:
+            modelspec = json.load(fp)
+    else:
+        modelspec = DEFAULT_MODELSPEC
+    for spec, value in [('raw_intervals', raw_intervals), ('datasetspec', datasetspec),
+                        ('modelspec', modelspec)]:
+        with open(specs[spec], 'w') as fp:
+            json.dump(value, fp, indent=4)
+    return specs
+
+
+def count_intervals(intervalspec, chroms=None):
+    """Number of intervals in the intervals files of an intervalspec, optionally on some chroms."""
+    with open(intervalspec, 'r') as fp:
+        data = json.load(fp)
+    num_intervals = 0
+    for dataset_id, dataset_dict in data.items():
+        if dataset_id == 'task_names':
+            continue
+        with gzip.open(dataset_dict['intervals_file'], 'rb') as fp:
+            for line in fp:
+                if chroms is None or line.decode('ascii').split('\t', 1)[0] in chroms:
+                    num_intervals += 1
+    return num_intervals
+
+
+def run_stage(command, args):
+    """Runs a tfdragonn command in a new process, returns its wall time in seconds."""
+    cmd = [sys.executable, '-m', 'tfdragonn', command] + [str(arg) for arg in args]
+    _logger.info('Running {}'.format(' '.join(cmd)))
+    start_time = time.time()
+    subprocess.check_call(cmd)
+    return time.time() - start_time
+
+
+def benchmark_pipeline(workdir, num_chroms=3, chrom_size=500000, num_peaks=200,
+                       num_epochs=2, epoch_size=10000, batch_size=128, modelspec=None,
+                       seed=0):
+    """
+    Generates synthetic data and times each stage of the pipeline on it.
+
+    Stages run as separate CPU only tfdragonn processes, so timings include
+    imports and session setup as users see them. The first chromosome is
+    used for validation, test and predict run on all intervals.
+    Returns a results dict with the configuration and per stage timings.
+    """
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    _logger.info('Generating synthetic data in {}...'.format(workdir))
+    start_time = time.time()
+    paths, chroms = generate_synthetic_data(
+        os.path.join(workdir, 'data'), num_chroms=num_chroms, chrom_size=chrom_size,
+        num_peaks=num_peaks, seed=seed)
+    specs = write_specs(workdir, paths, modelspec)
+    generate_time = time.time() - start_time
+
+    intervals_prefix = os.path.join(workdir, 'intervals')
+    intervalspec = intervals_prefix + '.json'
+    logdir = os.path.join(workdir, 'logdir')
+    valid_chroms = chroms[:1]
+    stages = collections.OrderedDict()
+    stages['generate'] = {'seconds': generate_time, 'examples': num_chroms * chrom_size}
+
+    seconds = run_stage('labelregions', [specs['raw_intervals'], intervals_prefix])
+    num_intervals = count_intervals(intervalspec)
+    stages['labelregions'] = {'seconds': seconds, 'examples': num_intervals}
+
+    seconds = run_stage('train', [
+        specs['datasetspec'], intervalspec, specs['modelspec'], logdir,
+        '--visiblegpus', '', '--holdout-chroms', json.dumps([]),
+        '--valid-chroms', json.dumps(valid_chroms), '--num-epochs', num_epochs,
+        '--epoch-size', epoch_size, '--batch-size', batch_size])
+    stages['train'] = {'seconds': seconds, 'examples': num_epochs * epoch_size}
+
+    seconds = run_stage('test', [
+        specs['datasetspec'], intervalspec, specs['modelspec'], logdir, '--visiblegpus', ''])
+    stages['test'] = {'seconds': seconds, 'examples': num_intervals}
+
+    seconds = run_stage('predict', [
+        specs['datasetspec'], intervalspec, specs['modelspec'], logdir,
+        os.path.join(workdir, 'predictions'), '--visiblegpus', ''])
+    stages['predict'] = {'seconds': seconds, 'examples': num_intervals}
+
+    for stage in stages.values():
+        stage['examples_per_sec'] = stage['examples'] / stage['seconds']
+    return collections.OrderedDict([
+        ('config', collections.OrderedDict([
+            ('num_chroms', num_chroms), ('chrom_size', chrom_size), ('num_peaks', num_peaks),
+            ('num_epochs', num_epochs), ('epoch_size', epoch_size), ('batch_size', batch_size),
+            ('num_valid_intervals', count_intervals(intervalspec, valid_chroms)),
+            ('seed', seed)])),
+        ('host', collections.OrderedDict([
+            ('hostname', socket.gethostname()), ('cpus', multiprocessing.cpu_count()),
+            ('python', platform.python_version())])),
+        ('stages', stages),
+        ('total_seconds', sum(stage['seconds'] for stage in stages.values())),
+    ])
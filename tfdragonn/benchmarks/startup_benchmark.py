@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from tfdragonn import loggers
+
+LOGGER_NAME = 'tfdragonn-benchmark-startup'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Commands, as tfdragonn arguments, that need none of the deep learning stack
+DEFAULT_COMMANDS = [['--help'], ['labelregions', '--help']]
+
+# Top level modules these commands must not import
+HEAVY_MODULES = ['genomedatalayer', 'genomeflow', 'keras', 'sklearn', 'tensorflow']
+
+# Default max startup wall time of each command in seconds
+DEFAULT_MAX_SECONDS = 1.0
+
+# Runs tfdragonn with the json arguments in argv[1], then writes the top level
+# modules it imported to the json file argv[2]
+STARTUP_SCRIPT = '''
+import json
+import sys
+args, output = json.loads(sys.argv[1]), sys.argv[2]
+sys.argv = ['tfdragonn'] + args
+try:
+    from tfdragonn.__main__ import main
+    main()
+except SystemExit as e:
+    if e.code:
+        raise
+finally:
+    with open(output, 'w') as fp:
+        json.dump(sorted(set(name.split('.')[0] for name in sys.modules)), fp)
+'''
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn benchmark-startup',
+                                     description='Time the startup of commands that should not'
+                                     ' import TensorFlow, fail if any is slow or does.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--commands', type=json.loads, default=DEFAULT_COMMANDS,
+                        help='Commands as a json list of tfdragonn argument lists.'
+                        '\nDefault: {}.'.format(json.dumps(DEFAULT_COMMANDS)))
+    parser.add_argument('--max-seconds', type=float, default=DEFAULT_MAX_SECONDS,
+                        help='Max startup wall time of each command.'
+                        '\nDefault: {}.'.format(DEFAULT_MAX_SECONDS))
+    parser.add_argument('--num-repeats', type=int, default=5,
+                        help='Runs of each command, the fastest is reported.\nDefault: 5.')
+    parser.add_argument('--output', type=os.path.abspath, default=None,
+                        help='Json file to write the results to.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_benchmark_startup_from_args(command, args):
+    args = parse_args(args)
+    results = [benchmark_startup(command_args, num_repeats=args.num_repeats)
+               for command_args in args.commands]
+    for result in results:
+        print('{:.3f}s  tfdragonn {}{}'.format(
+            result['seconds'], ' '.join(result['command']),
+            '  imports {}'.format(', '.join(result['heavy_modules']))
+            if result['heavy_modules'] else ''))
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+        _logger.info('Saved results to {}'.format(args.output))
+    failed = [result for result in results
+              if result['seconds'] > args.max_seconds or result['heavy_modules']]
+    if failed:
+        _logger.error('{} of {} commands import heavy modules or take over {}s to start'.format(
+            len(failed), len(results), args.max_seconds))
+        sys.exit(1)
+
+
+def benchmark_startup(command_args, num_repeats=5):
+    """
+    Times a tfdragonn command in new processes, with interpreter startup.
+
+    Returns the fastest wall time of num_repeats runs and the HEAVY_MODULES
+    the command imports.
+    """
+    fd, modules_file = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    cmd = [sys.executable, '-c', STARTUP_SCRIPT, json.dumps(command_args), modules_file]
+    times = []
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(num_repeats):
+                start_time = time.time()
+                subprocess.check_call(cmd, stdout=devnull)
+                times.append(time.time() - start_time)
+        with open(modules_file, 'r') as fp:
+            modules = set(json.load(fp))
+    finally:
+        os.remove(modules_file)
+    return collections.OrderedDict([
+        ('command', command_args),
+        ('seconds', min(times)),
+        ('heavy_modules', [module for module in HEAVY_MODULES if module in modules]),
+    ])
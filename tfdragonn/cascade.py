@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+from tfdragonn.metrics import AMBIG_LABEL, auPRC
+
+# Calibrated cascade thresholds and validation report, in the logdir of the full model
+CASCADE_FNAME = 'cascade.json'
+
+# Default fraction of validation positives of each task passed on to the full model
+DEFAULT_TARGET_RECALL = 0.99
+
+
+def calibrate_thresholds(labels, screen_predictions, target_recall=DEFAULT_TARGET_RECALL):
+    """
+    Returns the highest per task screen thresholds that keep target_recall of positives.
+
+    Tasks without positives get a threshold of 0, every example passes.
+    """
+    thresholds = np.zeros(labels.shape[1], dtype=np.float32)
+    for task_indx, (task_labels, task_predictions) in enumerate(
+            zip(labels.T, screen_predictions.T)):
+        positive_predictions = np.sort(task_predictions[task_labels == 1])[::-1]
+        if len(positive_predictions) == 0:
+            continue
+        num_kept = int(np.ceil(target_recall * len(positive_predictions)))
+        thresholds[task_indx] = positive_predictions[max(num_kept, 1) - 1]
+    return thresholds
+
+
+def screen_mask(screen_predictions, thresholds):
+    """Examples passed on to the full model, those above the threshold of any task."""
+    return (screen_predictions >= thresholds).any(axis=1)
+
+
+def cascade_report(labels, screen_predictions, full_predictions, thresholds):
+    """
+    Returns the skipped fraction and per task recall lost by a cascade on labeled examples.
+
+    Skipped examples get the screen predictions. Recall lost is the fraction
+    of positives the full model recalls at 0.5 but the cascade does not.
+    """
+    passed = screen_mask(screen_predictions, thresholds)
+    cascade_predictions = np.where(passed[:, None], full_predictions, screen_predictions)
+    tasks = []
+    for task_labels, task_full, task_cascade in zip(
+            labels.T, full_predictions.T, cascade_predictions.T):
+        non_ambig = task_labels != AMBIG_LABEL
+        positives = task_labels == 1
+        if not positives.any() or positives.sum() == non_ambig.sum():
+            tasks.append(None)
+            continue
+        tasks.append({
+            'screen_recall': float(passed[positives].mean()),
+            'recall_lost': float(((task_full[positives] > 0.5) &
+                                  (task_cascade[positives] <= 0.5)).mean()),
+            'full_auPRC': float(auPRC(task_labels[non_ambig], task_full[non_ambig])),
+            'cascade_auPRC': float(auPRC(task_labels[non_ambig], task_cascade[non_ambig]))})
+    return {'skipped_fraction': float(1 - passed.mean()),
+            'num_examples': len(passed),
+            'tasks': tasks}
+
+
+def load_cascade(logdir, screen_logdir=None):
+    """
+    Loads the cascade calibrated for the model in logdir.
+
+    Raises a ValueError if there is none, or if screen_logdir is not the
+    screen model it was calibrated with.
+    """
+    cascade_fname = os.path.join(logdir, CASCADE_FNAME)
+    if not os.path.isfile(cascade_fname):
+        raise ValueError('No {} in {}, run calibrate-cascade first'.format(CASCADE_FNAME, logdir))
+    with open(cascade_fname, 'r') as fp:
+        cascade = json.load(fp)
+    if screen_logdir is not None and (
+            os.path.realpath(screen_logdir) != os.path.realpath(cascade['screen_logdir'])):
+        raise ValueError('{} was calibrated for the screen model in {}, not {}'.format(
+            cascade_fname, cascade['screen_logdir'], screen_logdir))
+    return cascade
+
+
+class CascadeClassifier(object):
+    """
+    Gates a full model with a cheap screen model.
+
+    Every example is scored by the screen model, only those above the
+    threshold of any task are predicted by the full model, the rest keep
+    their screen predictions. Has the predict_on_batch interface of
+    Classifier, and counts the examples screened and passed.
+    """
+
+    def __init__(self, screen_model, full_model, thresholds):
+        self.screen_model = screen_model
+        self.full_model = full_model
+        self.thresholds = np.asarray(thresholds, dtype=np.float32)
+        self.num_screened = 0
+        self.num_passed = 0
+
+    @property
+    def get_inputs(self):
+        return sorted(set(self.screen_model.get_inputs) | set(self.full_model.get_inputs))
+
+    def predict_on_batch(self, batch, rc_average=False):
+        predictions = self.screen_model.predict_on_batch(batch, rc_average=rc_average)
+        passed = screen_mask(predictions, self.thresholds)
+        if passed.any():
+            passed_batch = {name: batch[name][passed] for name in self.full_model.get_inputs}
+            predictions[passed] = self.full_model.predict_on_batch(
+                passed_batch, rc_average=rc_average)
+        self.num_screened += len(passed)
+        self.num_passed += int(passed.sum())
+        return predictions
@@ -24,7 +24,13 @@ PROCESSED_INPUT_NAMES = set(['genome_data_dir', 'dnase_data_dir',
                              'tss_counts', 'dhs_counts',
                              'tss_mean_tpm', 'tss_max_tpm',
                              'HelT_data_dir', 'MGW_data_dir', 'OC2_data_dir',
-                             'ProT_data_dir', 'Roll_data_dir'])
+                             'ProT_data_dir', 'Roll_data_dir',
+                             'shape_dnase_data_dir', 'pwm_scores_data_dir'])
+
+# Fused data types, the channels of each are these single track data types in order
+FUSED_INPUT_CHANNELS = {'shape_dnase_data_dir': ['HelT_data_dir', 'MGW_data_dir', 'OC2_data_dir',
+                                                 'ProT_data_dir', 'Roll_data_dir',
+                                                 'dnase_data_dir']}
 
 
 def parse_inputs_and_intervals(processed_inputs_file, processed_intervals_file):
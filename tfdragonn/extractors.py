@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+# Data types stored as per-chromosome arrays, the rest are extracted from beds
+ARRAY_DATA_TYPES = set(['genome_data_dir', 'dnase_data_dir',
+                        'HelT_data_dir', 'MGW_data_dir', 'OC2_data_dir',
+                        'ProT_data_dir', 'Roll_data_dir',
+                        'shape_dnase_data_dir', 'pwm_scores_data_dir'])
+
+# Compression of written bcolz arrays
+BCOLZ_CPARAMS = {'clevel': 5, 'shuffle': 1, 'cname': 'lz4'}
+
+# Bases per chromosome chunk copied at a time when stacking data dirs
+STACK_CHUNK_SIZE = 10**7
+
+
+def load_array_dir(data_dir):
+    """
+    Opens a processed array data directory, returns a dict of per-chromosome arrays.
+
+    The directory has a metadata.json with the array type and the per-chromosome
+    shapes, and a bcolz carray or npy file per chromosome.
+    """
+    with open(os.path.join(data_dir, 'metadata.json'), 'r') as fp:
+        metadata = json.load(fp)
+    if metadata['type'] == 'array_bcolz':
+        import bcolz
+        return {chrom: bcolz.open(os.path.join(data_dir, chrom), mode='r')
+                for chrom in metadata['file_shapes']}
+    elif metadata['type'] == 'array_numpy':
+        return {chrom: np.load(os.path.join(data_dir, chrom + '.npy'), mmap_mode='r')
+                for chrom in metadata['file_shapes']}
+    raise ValueError('Unsupported array type {} in {}'.format(metadata['type'], data_dir))
+
+
+def write_array_dir(data_dir, chrom_arrays, array_type='array_bcolz'):
+    """
+    Writes a dict of per-chromosome arrays as a processed array data directory.
+
+    Arrays are (chrom_size,) for single tracks or (chrom_size, num_channels).
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    for chrom, array in chrom_arrays.items():
+        if array_type == 'array_bcolz':
+            import bcolz
+            bcolz.carray(array, rootdir=os.path.join(data_dir, chrom), mode='w',
+                         cparams=bcolz.cparams(**BCOLZ_CPARAMS)).flush()
+        elif array_type == 'array_numpy':
+            np.save(os.path.join(data_dir, chrom + '.npy'), array)
+        else:
+            raise ValueError('Unsupported array type {}'.format(array_type))
+    write_metadata(data_dir, array_type,
+                    {chrom: array.shape for chrom, array in chrom_arrays.items()})
+
+
+def stack_array_dirs(data_dirs, data_dir, array_type=None, chunk_size=STACK_CHUNK_SIZE):
+    """
+    Stacks single track array data dirs into one with (chrom_size, num_channels) arrays.
+
+    Channels follow the order of data_dirs, all of which must have the same
+    chromosomes and sizes. Chromosomes are copied chunk_size bases at a time,
+    so they are never fully loaded. array_type defaults to the type of the
+    first data dir.
+    """
+    tracks = [load_array_dir(track_dir) for track_dir in data_dirs]
+    if array_type is None:
+        with open(os.path.join(data_dirs[0], 'metadata.json'), 'r') as fp:
+            array_type = json.load(fp)['type']
+    chrom_sizes = {chrom: data.shape for chrom, data in tracks[0].items()}
+    for track_dir, track in zip(data_dirs[1:], tracks[1:]):
+        if {chrom: data.shape for chrom, data in track.items()} != chrom_sizes:
+            raise ValueError('Chromosomes of {} do not match {}'.format(track_dir, data_dirs[0]))
+    if any(len(shape) != 1 for shape in chrom_sizes.values()):
+        raise ValueError('Only single track data dirs can be stacked')
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    file_shapes = {}
+    for chrom, (chrom_size,) in chrom_sizes.items():
+        file_shapes[chrom] = (chrom_size, len(tracks))
+        write_chrom_chunks(
+            data_dir, chrom, file_shapes[chrom], array_type,
+            ((start, np.stack([track[chrom][start:start + chunk_size] for track in tracks], axis=1))
+             for start in range(0, chrom_size, chunk_size)))
+    write_metadata(data_dir, array_type, file_shapes)
+
+
+def write_chrom_chunks(data_dir, chrom, shape, array_type, chunks):
+    """
+    Writes a chromosome array of an array data dir from consecutive chunks.
+
+    chunks yields (start, array) pairs in order, so the chromosome is never
+    fully in memory. Arrays are written as float32.
+    """
+    if array_type == 'array_bcolz':
+        import bcolz
+        out = bcolz.carray(np.empty((0,) + tuple(shape[1:]), dtype=np.float32),
+                           rootdir=os.path.join(data_dir, chrom), mode='w',
+                           expectedlen=shape[0], cparams=bcolz.cparams(**BCOLZ_CPARAMS))
+        for _, chunk in chunks:
+            out.append(chunk.astype(np.float32))
+    elif array_type == 'array_numpy':
+        out = np.lib.format.open_memmap(os.path.join(data_dir, chrom + '.npy'), mode='w+',
+                                        dtype=np.float32, shape=tuple(shape))
+        for start, chunk in chunks:
+            out[start:start + len(chunk)] = chunk
+    else:
+        raise ValueError('Unsupported array type {}'.format(array_type))
+    out.flush()
+    del out
+
+
+def write_metadata(data_dir, array_type, file_shapes, **extra_metadata):
+    metadata = {'type': array_type,
+                'file_shapes': {chrom: list(shape) for chrom, shape in file_shapes.items()}}
+    metadata.update(extra_metadata)
+    with open(os.path.join(data_dir, 'metadata.json'), 'w') as fp:
+        json.dump(metadata, fp, indent=4)
+
+
+class ArrayExtractor(object):
+    """
+    Extracts fixed length intervals from a processed array data directory.
+
+    Outputs match the example queue layout: (num_intervals, interval_length)
+    for single track data and (num_intervals, num_channels, interval_length)
+    for multi-channel data such as one-hot encoded sequence.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._data = load_array_dir(data_dir)
+
+    @property
+    def chrom_sizes(self):
+        return {chrom: data.shape[0] for chrom, data in self._data.items()}
+
+    def output_shape(self, interval_length):
+        chrom_data = next(iter(self._data.values()))
+        return tuple(chrom_data.shape[1:][::-1]) + (interval_length,)
+
+    def __call__(self, chrom, starts, interval_length):
+        """Extracts intervals [start, start + interval_length) on a chromosome."""
+        starts = np.asarray(starts)
+        chrom_data = self._data[chrom]
+        region_start = starts.min()
+        region_end = starts.max() + interval_length
+        if region_end - region_start <= 2 * len(starts) * interval_length:
+            # dense intervals such as genome tiles: read the spanned region once
+            region = chrom_data[region_start:region_end]
+            out = region[(starts - region_start)[:, None] + np.arange(interval_length)]
+        else:
+            out = np.stack([chrom_data[start:start + interval_length] for start in starts])
+        if out.ndim == 3:  # (N, L, C) -> (N, C, L)
+            out = out.transpose((0, 2, 1))
+        return np.ascontiguousarray(out, dtype=np.float32)
+
+
+def get_extractors(inputs, input_names):
+    """
+    Returns a dict of ArrayExtractors keyed by model input name.
+
+    Args:
+        inputs (dict): a dataset's processed inputs, data type -> data dir.
+        input_names (list): model input names, e.g. `data/genome_data_dir`.
+    """
+    extractors = {}
+    for input_name in input_names:
+        data_type = input_name.split('/')[1]
+        if data_type not in ARRAY_DATA_TYPES:
+            raise ValueError('Direct extraction is not supported for {}'.format(data_type))
+        if data_type not in inputs:
+            raise ValueError('Missing {} input in dataset'.format(data_type))
+        extractors[input_name] = ArrayExtractor(inputs[data_type])
+    return extractors
+
+
+def extract_batch(extractors, chrom, starts, interval_length):
+    """Returns a batch dict with an array per model input."""
+    return {input_name: extractor(chrom, starts, interval_length)
+            for input_name, extractor in extractors.items()}
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from tfdragonn import cascade
+from tfdragonn import extractors
+from tfdragonn import loggers
+from tfdragonn import predictions
+from tfdragonn.datasets import PROCESSED_INPUT_NAMES
+from tfdragonn.model_specs import check_rc_average_inputs, model_inputs_from_config
+from tfdragonn.numpy_inference import NUMPY_BUNDLE_FNAME, NumpyClassifier
+
+LOGGER_NAME = 'tfdragonn-predict-genome'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Number of tiles read from the merged chromosome outputs at a time
+MERGE_CHUNK_SIZE = 1000000
+
+# Per process model state, set up once by the pool initializer
+_worker_state = {}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn predict-genome',
+                                     description='Predict on windows tiling each chromosome.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('datasetspec', type=os.path.abspath,
+                        help='Dataset parameters json file path')
+    parser.add_argument('logdir', type=os.path.abspath,
+                        help='Log directory of a trained model')
+    parser.add_argument('chrom_sizes', type=os.path.abspath,
+                        help='Tab delimited chromosome sizes file')
+    parser.add_argument('prefix', type=str,
+                        help='Prefix for files with predictions')
+    parser.add_argument('--visiblegpus', type=str, default='',
+                        help='Visible GPUs string.\nDefault: none.')
+    parser.add_argument('--dataset-ids', type=json.loads, default=None,
+                        help='Datasets to predict on as a json string.\nDefault: all datasets.')
+    parser.add_argument('--chroms', type=json.loads, default=None,
+                        help='Chromosomes to predict on as a json string.\nDefault: all chromosomes.')
+    parser.add_argument('--window', type=int, default=1000,
+                        help='Size of the input windows, including flanks.\nDefault: 1000.')
+    parser.add_argument('--stride', type=int, default=50,
+                        help='Spacing between consecutive windows.\nDefault: 50.')
+    parser.add_argument('--flank-size', type=int, default=400,
+                        help='Size of flank in input windows, flanks are trimmed before writing intervals.'
+                        '\nDefault: 400.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Prediction batch size.\nDefault: 1000.')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='Number of chromosomes predicted in parallel.\nDefault: 1.')
+    parser.add_argument('--output-format', type=str, choices=['tab', 'store'], default='tab',
+                        help='Gzipped per task files (tab) or a prediction store (store).\nDefault: tab.')
+    parser.add_argument('--rc-average', action='store_true',
+                        help='Average predictions on each window and its reverse complement.')
+    parser.add_argument('--engine', type=str, choices=['keras', 'numpy'], default='keras',
+                        help='Run the keras model, or the numpy export of it in <logdir>/{}'
+                        ' without tensorflow.\nDefault: keras.'.format(NUMPY_BUNDLE_FNAME))
+    parser.add_argument('--screen-logdir', type=os.path.abspath, default=None,
+                        help='Log directory of a cheap screen model, only windows it scores above\n'
+                        'the thresholds calibrated by calibrate-cascade are predicted by the model.'
+                        '\nDefault: none.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_predict_genome_from_args(command, args):
+    args = parse_args(args)
+    predict_genome(args.datasetspec, args.logdir, args.chrom_sizes, args.prefix,
+                   visiblegpus=args.visiblegpus, dataset_ids=args.dataset_ids,
+                   chroms=args.chroms, window=args.window, stride=args.stride,
+                   flank_size=args.flank_size, batch_size=args.batch_size,
+                   n_jobs=args.n_jobs, output_format=args.output_format,
+                   rc_average=args.rc_average, engine=args.engine,
+                   screen_logdir=args.screen_logdir)
+
+
+def read_chrom_sizes(chrom_sizes_file):
+    chrom_sizes = collections.OrderedDict()
+    with open(chrom_sizes_file, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                chrom, size = line.split()[:2]
+                chrom_sizes[chrom] = int(size)
+    return chrom_sizes
+
+
+def tile_chrom(chrom_size, window, stride):
+    """Returns the starts of windows tiling a chromosome."""
+    return np.arange(0, chrom_size - window + 1, stride, dtype=np.int64)
+
+
+def filter_chrom_sizes(chrom_sizes, dataset_inputs, input_names):
+    """
+    Returns the chrom_sizes of chromosomes in every data dir of a dataset, and the skipped ones.
+
+    Contigs of a chrom.sizes file missing from the processed data, e.g.
+    chrM or unplaced contigs, are skipped. Raises a ValueError for
+    chromosomes longer in chrom_sizes than in the data.
+    """
+    data_chrom_sizes = [extractor.chrom_sizes for extractor in
+                        extractors.get_extractors(dataset_inputs, input_names).values()]
+    kept_chrom_sizes = collections.OrderedDict()
+    skipped_chroms = []
+    for chrom, chrom_size in chrom_sizes.items():
+        if not all(chrom in sizes for sizes in data_chrom_sizes):
+            skipped_chroms.append(chrom)
+            continue
+        data_size = min(sizes[chrom] for sizes in data_chrom_sizes)
+        if chrom_size > data_size:
+            raise ValueError('{} is {} bp long in the chrom sizes file, but {} bp in the data'.format(
+                chrom, chrom_size, data_size))
+        kept_chrom_sizes[chrom] = chrom_size
+    return kept_chrom_sizes, skipped_chroms
+
+
+def load_dataset_inputs(datasetspec):
+    with open(datasetspec, 'r') as fp:
+        data = json.load(fp)
+    return {dataset_id: {input_id: input_value for input_id, input_value in dataset_dict.items()
+                         if input_id in PROCESSED_INPUT_NAMES}
+            for dataset_id, dataset_dict in data.items()}
+
+
+def _init_worker(logdir, visiblegpus, engine='keras', screen_logdir=None):
+    if engine == 'keras':
+        from tfdragonn.model_runner import BaseModelRunner
+
+        BaseModelRunner.setup_keras_session(visiblegpus)
+    with open(os.path.join(logdir, 'intervalspec.json'), 'r') as fp:
+        task_names = json.load(fp)['task_names']
+    logdirs = [logdir] if screen_logdir is None else [logdir, screen_logdir]
+    _worker_state['logdir'] = logdir
+    _worker_state['screen_logdir'] = screen_logdir
+    _worker_state['input_names'] = sorted(set(
+        input_name for model_logdir in logdirs for input_name in
+        model_inputs_from_config(os.path.join(model_logdir, 'modelspec.json'))))
+    _worker_state['task_names'] = task_names
+    _worker_state['engine'] = engine
+    _worker_state['models'] = {}
+
+
+def _load_worker_model(logdir, input_shapes):
+    if _worker_state['engine'] == 'numpy':
+        model = NumpyClassifier(os.path.join(logdir, NUMPY_BUNDLE_FNAME))
+        input_shapes = {name: input_shapes[name] for name in model.get_inputs}
+        if model.input_shapes != input_shapes:
+            raise ValueError('Model was exported for input shapes {}, got {}, rerun '
+                             'export-model with the window as --interval-length'.format(
+                                 model.input_shapes, input_shapes))
+        return model
+    from tfdragonn import models
+
+    modelspec = os.path.join(logdir, 'modelspec.json')
+    model = models.model_from_minimal_config(
+        modelspec, {name: input_shapes[name] for name in model_inputs_from_config(modelspec)},
+        len(_worker_state['task_names']))
+    model.load_weights(os.path.join(logdir, 'model.weights.h5'))
+    return model
+
+
+def _get_worker_model(input_shapes):
+    """Builds or loads the model once per worker and set of input shapes."""
+    key = tuple(sorted(input_shapes.items()))
+    if key not in _worker_state['models']:
+        model = _load_worker_model(_worker_state['logdir'], input_shapes)
+        if _worker_state['screen_logdir'] is not None:
+            thresholds = cascade.load_cascade(
+                _worker_state['logdir'], _worker_state['screen_logdir'])['thresholds']
+            model = cascade.CascadeClassifier(
+                _load_worker_model(_worker_state['screen_logdir'], input_shapes), model, thresholds)
+        _worker_state['models'][key] = model
+    return _worker_state['models'][key]
+
+
+def predict_chrom(dataset_inputs, chrom, chrom_size, window, stride, batch_size, output_prefix,
+                  rc_average=False):
+    """
+    Predicts on the windows tiling a chromosome, skips chromosomes that are already done.
+
+    Returns the chromosome and the number of windows predicted and passed on
+    by the screen model of a cascade, both 0 for skipped chromosomes.
+    """
+    done_fname = output_prefix + '.done'
+    if os.path.isfile(done_fname):
+        return chrom, 0, 0
+    chrom_extractors = extractors.get_extractors(dataset_inputs, _worker_state['input_names'])
+    input_shapes = {input_name: extractor.output_shape(window)
+                    for input_name, extractor in chrom_extractors.items()}
+    model = _get_worker_model(input_shapes)
+    starts = tile_chrom(chrom_size, window, stride)
+    num_passed = getattr(model, 'num_passed', None)  # counted by cascades only
+    with predictions.StreamingPredictionWriter(output_prefix, _worker_state['task_names']) as writer:
+        for batch_start in range(0, len(starts), batch_size):
+            batch_starts = starts[batch_start:batch_start + batch_size]
+            batch = extractors.extract_batch(chrom_extractors, chrom, batch_starts, window)
+            writer.write(np.repeat(chrom, len(batch_starts)), batch_starts, batch_starts + window,
+                         model.predict_on_batch(batch, rc_average=rc_average))
+    open(done_fname, 'w').close()
+    if num_passed is None:
+        return chrom, len(starts), len(starts)
+    return chrom, len(starts), model.num_passed - num_passed
+
+
+def _predict_chrom_star(args):
+    return predict_chrom(*args)
+
+
+def merge_chrom_predictions(chrom_prefixes, output_prefix, task_names):
+    """Concatenates per chromosome streamed predictions into one."""
+    with predictions.StreamingPredictionWriter(output_prefix, task_names) as writer:
+        for chrom_prefix in chrom_prefixes:
+            chrom_predictions = predictions.StreamedPredictions(chrom_prefix)
+            chroms = np.array(chrom_predictions.chroms, dtype=object)
+            for chunk_start in range(0, chrom_predictions.num_examples, MERGE_CHUNK_SIZE):
+                intervals = chrom_predictions.intervals[chunk_start:chunk_start + MERGE_CHUNK_SIZE]
+                writer.write(chroms[intervals['chrom']], intervals['start'], intervals['end'],
+                             chrom_predictions.predictions[chunk_start:chunk_start + MERGE_CHUNK_SIZE])
+    return predictions.StreamedPredictions(output_prefix)
+
+
+def predict_genome(datasetspec, logdir, chrom_sizes_file, prefix, visiblegpus='',
+                   dataset_ids=None, chroms=None, window=1000, stride=50, flank_size=400,
+                   batch_size=1000, n_jobs=1, output_format='tab', rc_average=False,
+                   engine='keras', screen_logdir=None):
+    """
+    Predicts on windows tiling each chromosome, without an intervals file.
+
+    Chromosomes are predicted in a pool of n_jobs processes. Each finished
+    chromosome is checkpointed in `<prefix>.predict-genome`, so a killed job
+    resumes with the remaining chromosomes. The chromosome outputs are merged
+    into one output per dataset. With engine='numpy' workers run the numpy
+    export of the model and never import tensorflow. With a screen_logdir,
+    the model only predicts windows passed on by the screen model at the
+    thresholds in the cascade.json of the logdir, the rest keep their screen
+    predictions.
+    """
+    loggers.add_logdir(LOGGER_NAME, logdir)
+    if screen_logdir is not None:
+        cascade.load_cascade(logdir, screen_logdir)  # fail early on a missing or mismatched cascade
+    input_names = sorted(set(
+        input_name for model_logdir in ([logdir] if screen_logdir is None else [logdir, screen_logdir])
+        for input_name in model_inputs_from_config(os.path.join(model_logdir, 'modelspec.json'))))
+    if rc_average:
+        check_rc_average_inputs(input_names)
+    chrom_sizes = read_chrom_sizes(chrom_sizes_file)
+    if chroms is not None:
+        chrom_sizes = collections.OrderedDict(
+            (chrom, size) for chrom, size in chrom_sizes.items() if chrom in chroms)
+    with open(os.path.join(logdir, 'intervalspec.json'), 'r') as fp:
+        task_names = json.load(fp)['task_names']
+    dataset_inputs = load_dataset_inputs(datasetspec)
+    if dataset_ids is None:
+        dataset_ids = sorted(dataset_inputs.keys())
+    dataset_chrom_sizes = collections.OrderedDict()
+    for dataset_id in dataset_ids:
+        dataset_chrom_sizes[dataset_id], skipped_chroms = filter_chrom_sizes(
+            chrom_sizes, dataset_inputs[dataset_id], input_names)
+        if skipped_chroms:
+            _logger.info('Skipping {} chromosomes missing from dataset {}: {}'.format(
+                len(skipped_chroms), dataset_id, ', '.join(skipped_chroms)))
+    checkpoint_dir = os.path.abspath('{}.predict-genome'.format(prefix))
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    jobs = [(dataset_inputs[dataset_id], chrom, chrom_size, window, stride, batch_size,
+             os.path.join(checkpoint_dir, '{}.{}'.format(dataset_id, chrom)), rc_average)
+            for dataset_id in dataset_ids
+            for chrom, chrom_size in dataset_chrom_sizes[dataset_id].items()]
+    _logger.info('Predicting on {} chromosomes of {} datasets with {} processes...'.format(
+        len(jobs), len(dataset_ids), n_jobs))
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                initargs=(logdir, visiblegpus, engine, screen_logdir))
+    total_windows = total_passed = 0
+    try:
+        for indx, (chrom, num_windows, num_passed) in enumerate(
+                pool.imap_unordered(_predict_chrom_star, jobs)):
+            total_windows += num_windows
+            total_passed += num_passed
+            _logger.info('Finished {} ({}/{})'.format(chrom, indx + 1, len(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+    if screen_logdir is not None and total_windows > 0:
+        _logger.info('Screen model skipped {} of {} windows ({:.1%})'.format(
+            total_windows - total_passed, total_windows, 1 - total_passed / total_windows))
+
+    for dataset_id in dataset_ids:
+        chrom_prefixes = [os.path.join(checkpoint_dir, '{}.{}'.format(dataset_id, chrom))
+                          for chrom in dataset_chrom_sizes[dataset_id]]
+        streamed_predictions = merge_chrom_predictions(
+            chrom_prefixes, os.path.join(checkpoint_dir, dataset_id), task_names)
+        if output_format == 'store':
+            store_path = '{}.{}.store'.format(prefix, dataset_id)
+            predictions.write_prediction_store(
+                streamed_predictions, store_path, flank_size=flank_size, n_jobs=n_jobs)
+            _logger.info('Saved predictions in dataset {} to {}'.format(dataset_id, store_path))
+        else:
+            prediction_fnames = predictions.write_task_files(
+                streamed_predictions, '{}.{{}}.{}.tab.gz'.format(prefix, dataset_id),
+                flank_size=flank_size)
+            for task_name, prediction_fname in zip(task_names, prediction_fnames):
+                _logger.info('Saved {} predictions in dataset {} to {}'.format(
+                    task_name, dataset_id, prediction_fname))
+        streamed_predictions.remove()
+        for chrom_prefix in chrom_prefixes:
+            predictions.StreamedPredictions(chrom_prefix).remove()
+            os.remove(chrom_prefix + '.done')
+    os.rmdir(checkpoint_dir)
+    _logger.info('Done!')
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import functools
 import os
 
 import numpy as np
@@ -21,6 +23,8 @@ data_type2extractor = {
     'OC2_data_dir': 'bcolz_array',
     'ProT_data_dir': 'bcolz_array',
     'Roll_data_dir': 'bcolz_array',
+    'shape_dnase_data_dir': 'bcolz_array',
+    'pwm_scores_data_dir': 'bcolz_array',
     'tss_counts': 'bed',
     'dhs_counts': 'bed',
     'tss_mean_tpm': 'bed',
@@ -55,7 +59,12 @@ class GenomeFlowInterface(object):
         self.validation_intervalspec = validation_intervalspec
         self.modelspec = modelspec
         self.logdir = logdir
-        input_names = models.model_inputs_from_config(modelspec)
+        # a list of modelspecs shares one set of queues with the union of their inputs
+        modelspecs = modelspec if isinstance(modelspec, (list, tuple)) else [modelspec]
+        input_names = []
+        for spec in modelspecs:
+            input_names += [input_name for input_name in models.model_inputs_from_config(spec)
+                            if input_name not in input_names]
         self.input_names = [input_name.split('/')[1]
                             for input_name in input_names]
         self.shuffle = shuffle
@@ -70,6 +79,7 @@ class GenomeFlowInterface(object):
                 datasetspec, self.validation_intervalspec)
         self.task_names = self.dataset.values()[0]['task_names']
         self.tmp_files = []
+        self._probe_batches = {}
         if self.logger is not None:
             self.logger.info('GenomeFlowInterface Settings:')
             self.logger.info('shuffle: {}'.format(shuffle))
@@ -110,17 +120,79 @@ class GenomeFlowInterface(object):
                 input_names=self.input_names,
                 enqueues_per_thread=enqueues_per_thread)
 
+    def get_validation_queue_fns(self, num_epochs=1, enqueues_per_thread=[128, 1]):
+        """
+        Returns a function per dataset of the validation queue, by dataset id,
+        that builds the example queue of the dataset.
+
+        Queues start their enqueue threads when built, so build each one
+        only when it is consumed.
+        """
+        dataset = self.dataset
+        if self.validation_intervalspec is not None:
+            dataset = self.validation_dataset
+        return collections.OrderedDict(
+            (dataset_id, functools.partial(self.get_example_queue, dataset_values, dataset_id,
+                                           selected_chroms=self.validation_chroms,
+                                           holdout_chroms=self.holdout_chroms,
+                                           num_epochs=num_epochs,
+                                           input_names=self.input_names,
+                                           enqueues_per_thread=enqueues_per_thread))
+            for dataset_id, dataset_values in dataset.items())
+
+    def get_probe_batch(self, batch_size):
+        """
+        Returns a batch of up to batch_size validation examples of the first dataset.
+
+        The probe queue reads a copy of only the first batch_size validation
+        intervals, and the batch is built once per batch size, so timing
+        models costs neither a full copy of the intervals nor a batch of the
+        queues used for evaluation.
+        """
+        if batch_size in self._probe_batches:
+            return self._probe_batches[batch_size]
+        from tfdragonn import autotune
+
+        dataset = self.dataset
+        if self.validation_intervalspec is not None:
+            dataset = self.validation_dataset
+        dataset_id, dataset_values = list(dataset.items())[0]
+        probe_file = os.path.join(
+            self.logdir, '{}.probe{}'.format(os.path.basename(dataset_values['intervals_file']),
+                                             batch_size))
+        self.tmp_files.append(probe_file)
+        source_stream = BedFileStream(
+            dataset_values['intervals_file'], selected_chroms=self.validation_chroms,
+            holdout_chroms=self.holdout_chroms, num_epochs=1)
+        with open(probe_file, 'w') as probe_fp:
+            for _ in range(batch_size):
+                try:
+                    entry = source_stream.read_entry()
+                except tf.errors.OutOfRangeError:
+                    break
+                line = '\t'.join(map(str, map(entry.get, ['chrom', 'start', 'end'])))
+                if 'labels' in entry:
+                    line += '\t' + '\t'.join([str(i) for i in entry['labels'].tolist()])
+                probe_fp.write(line + '\n')
+        probe_queue = self.get_example_queue(
+            dict(dataset_values, intervals_file=probe_file), dataset_id, num_epochs=1,
+            input_names=self.input_names, enqueues_per_thread=[128, 1])
+        self._probe_batches[batch_size] = autotune.get_probe_batch(probe_queue, batch_size)
+        return self._probe_batches[batch_size]
+
     def get_interval_queue(self, dataset, dataset_id, selected_chroms=None,
                            holdout_chroms=None, num_epochs=None,
                            read_batch_size=10000, shuffle=True, pos_sampling_rate=None):
         intervals_file = dataset['intervals_file']
         if pos_sampling_rate is not None:
+            # multi-task intervals are positive if any task is, and negative if
+            # no task is and at least one is observed
             def pos_sampling_fn(record):
-                # single task only
-                return np.array(record[-1], dtype=np.int32)[0] == 1
+                return np.any(np.array(record[-1], dtype=np.int32) == 1)
 
             def neg_sampling_fn(record):
-                return np.array(record[-1], dtype=np.int32)[0] == 0
+                labels = np.array(record[-1], dtype=np.int32)
+                return not np.any(labels == 1) and np.any(labels == 0)
             pos_only_stream = BedFileStream(
                 intervals_file,
                 selected_chroms=selected_chroms,
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from keras import backend as K
+from keras.engine.topology import Layer
+import tensorflow as tf
+
+
+class RevCompConv1D(Layer):
+    """
+    Reverse complement equivariant 1D convolution.
+
+    Learns nb_filter // 2 filters W and outputs them followed by their reverse
+    complements, W reversed along positions, input channels and filters.
+    Inputs are (batch, length, channels) with strand symmetric channels: ACGT
+    one-hot sequence, single tracks such as DNase, or the output of another
+    reverse complement layer. Reverse complementing the input then reverses the
+    output along positions and channels.
+
+    Only the nb_filter // 2 filters are free parameters, half of a
+    Convolution1D with nb_filter filters.
+    """
+
+    def __init__(self, nb_filter, filter_length, init='glorot_uniform', **kwargs):
+        if nb_filter % 2 != 0:
+            raise ValueError('RevCompConv1D needs an even nb_filter, got {}'.format(nb_filter))
+        self.nb_filter = nb_filter
+        self.filter_length = filter_length
+        self.init = init
+        super(RevCompConv1D, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.W = self.add_weight(shape=(self.filter_length, input_shape[-1], self.nb_filter // 2),
+                                 initializer=self.init, name='{}_W'.format(self.name))
+        self.b = self.add_weight(shape=(self.nb_filter // 2,), initializer='zero',
+                                 name='{}_b'.format(self.name))
+        super(RevCompConv1D, self).build(input_shape)
+
+    def call(self, x, mask=None):
+        W = K.concatenate([self.W, self.W[::-1, ::-1, ::-1]], axis=-1)
+        b = K.concatenate([self.b, self.b[::-1]])
+        return tf.nn.conv1d(x, W, stride=1, padding='VALID') + b
+
+    def compute_output_shape(self, input_shape):
+        length = input_shape[1]
+        if length is not None:
+            length = length - self.filter_length + 1
+        return (input_shape[0], length, self.nb_filter)
+
+    get_output_shape_for = compute_output_shape
+
+    def get_config(self):
+        config = {'nb_filter': self.nb_filter,
+                  'filter_length': self.filter_length,
+                  'init': self.init}
+        base_config = super(RevCompConv1D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class RevCompConcatenate(Layer):
+    """
+    Concatenates reverse complement equivariant tensors along channels.
+
+    The forward halves are concatenated in order and the reverse complement
+    halves in reverse order, so the output stays equivariant.
+    """
+
+    def call(self, xs, mask=None):
+        halves = [K.int_shape(x)[-1] // 2 for x in xs]
+        forward = [x[:, :, :half] for x, half in zip(xs, halves)]
+        rev_comp = [x[:, :, half:] for x, half in zip(xs, halves)][::-1]
+        return K.concatenate(forward + rev_comp, axis=-1)
+
+    def compute_output_shape(self, input_shapes):
+        return input_shapes[0][:2] + (sum(shape[-1] for shape in input_shapes),)
+
+    get_output_shape_for = compute_output_shape
+
+
+class RevCompFold(Layer):
+    """
+    Folds a reverse complement equivariant tensor into a strand invariant one.
+
+    Adds the (batch, length, 2 * n) input to itself reversed along positions
+    and channels and keeps the first n channels. Reverse complementing the
+    model input leaves the output unchanged, so any pooling and dense layers
+    after the fold keep the model strand invariant.
+    """
+
+    def call(self, x, mask=None):
+        half = K.int_shape(x)[-1] // 2
+        return x[:, :, :half] + x[:, ::-1, ::-1][:, :, :half]
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:2] + (input_shape[-1] // 2,)
+
+    get_output_shape_for = compute_output_shape
+
+
+class ChannelSlice(Layer):
+    """Selects channels [start, stop) of a (batch, length, channels) tensor."""
+
+    def __init__(self, start, stop, **kwargs):
+        self.start = start
+        self.stop = stop
+        super(ChannelSlice, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return x[:, :, self.start:self.stop]
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:2] + (self.stop - self.start,)
+
+    get_output_shape_for = compute_output_shape
+
+    def get_config(self):
+        config = {'start': self.start, 'stop': self.stop}
+        base_config = super(ChannelSlice, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
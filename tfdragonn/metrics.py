@@ -3,11 +3,25 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import warnings
 from collections import OrderedDict
-from sklearn.metrics import auc, precision_recall_curve, roc_auc_score
 
 AMBIG_LABEL = -1
 
+# Max examples times tasks sorted and counted at once
+METRICS_MAX_ELEMENTS = 2**22
+
+# Precisions of the reported recalls
+RECALL_PRECISIONS = OrderedDict((
+    ('Recall at 5% FDR', 0.95),
+    ('Recall at 10% FDR', 0.9),
+    ('Recall at 25% FDR', 0.75),
+    ('Recall at 50% FDR', 0.5),
+))
+
+# Metrics with bootstrap confidence intervals, all but the counts
+BOOTSTRAP_METRICS = ['Balanced accuracy', 'auROC', 'auPRC'] + list(RECALL_PRECISIONS.keys())
+
 
 def positive_accuracy(labels, predictions, threshold=0.5):
     return 100 * (predictions[labels == 1] > threshold).mean()
@@ -23,49 +37,320 @@ def balanced_accuracy(labels, predictions, threshold=0.5):
 
 
 def auROC(labels, predictions):
-    return roc_auc_score(labels, predictions)
+    return task_metrics(labels[:, None], predictions[:, None])['auROC'][0]
 
 
 def auPRC(labels, predictions):
-    precision, recall = precision_recall_curve(labels, predictions)[:2]
-    return auc(recall, precision)
+    return task_metrics(labels[:, None], predictions[:, None])['auPRC'][0]
 
 
 def recall_at_precision_threshold(labels, predictions, precision_threshold):
-    precision, recall = precision_recall_curve(labels, predictions)[:2]
-    return 100 * recall[np.searchsorted(precision - precision_threshold, 0)]
+    return task_metrics(labels[:, None], predictions[:, None],
+                        recall_precisions={'recall': precision_threshold})['recall'][0]
 
 
-class ClassificationResult(object):
+def sort_tasks(labels, predictions):
+    """
+    Sorts the examples of each task of (examples, tasks) arrays by decreasing prediction.
+
+    Returns the sort order, sorted labels and sorted predictions as
+    (tasks, examples) arrays, with the examples of each task contiguous.
+    """
+    labels = np.ascontiguousarray(labels.T)
+    predictions = np.ascontiguousarray(predictions.T)
+    order = np.argsort(predictions, axis=1)[:, ::-1]
+    task_indxs = np.arange(predictions.shape[0])[:, None]
+    return order, labels[task_indxs, order], predictions[task_indxs, order]
+
+
+def _counts_at(counts, num_examples):
+    """Counts of each task after its first num_examples sorted examples."""
+    last_indxs = np.maximum(num_examples - 1, 0)
+    return np.where(num_examples > 0,
+                    counts[np.arange(counts.shape[0])[:, None], last_indxs], 0)
+
+
+def curve_counts(sorted_labels, sorted_predictions, sorted_weights=None):
+    """
+    Cumulative counts of the sorted examples of each task, and the points of their curves.
+
+    Returns (tasks, examples) arrays of the true and false positives above
+    each example, of those of the previous curve point, and a mask of the
+    curve points: the last example of each distinct prediction with labeled
+    examples. Ambiguous labels count as neither, examples count
+    sorted_weights times if set.
+    """
+    positives = sorted_labels == 1
+    negatives = sorted_labels == 0
+    if sorted_weights is not None:
+        positives = positives * sorted_weights
+        negatives = negatives * sorted_weights
+    tps = np.cumsum(positives, axis=1)
+    fps = np.cumsum(negatives, axis=1)
+    distinct_ends = np.ones(sorted_predictions.shape, dtype=bool)
+    distinct_ends[:, :-1] = sorted_predictions[:, 1:] != sorted_predictions[:, :-1]
+    # counts only increase, those of the previous distinct prediction end are a running max
+    prev_tps = np.zeros_like(tps)
+    prev_fps = np.zeros_like(fps)
+    prev_tps[:, 1:] = np.maximum.accumulate(np.where(distinct_ends, tps, 0), axis=1)[:, :-1]
+    prev_fps[:, 1:] = np.maximum.accumulate(np.where(distinct_ends, fps, 0), axis=1)[:, :-1]
+    points = distinct_ends & ((tps != prev_tps) | (fps != prev_fps))
+    return tps, fps, prev_tps, prev_fps, points
+
+
+def _recall_at_precisions(tps, fps, num_positives, precisions):
+    """
+    Recall of a task at each precision from the counts at its curve points.
+
+    Follows the curve of sklearn's precision_recall_curve, which stops at the
+    first point with full recall, searched as recall_at_precision_threshold
+    did with it.
+    """
+    if num_positives == 0:
+        return [np.nan] * len(precisions)
+    last_indx = np.searchsorted(tps, num_positives)
+    precision = np.r_[(tps / (tps + fps))[last_indx::-1], 1]
+    recall = np.r_[(tps / num_positives)[last_indx::-1], 0]
+    return [100 * recall[np.searchsorted(precision - precision_threshold, 0)]
+            for precision_threshold in precisions]
+
+
+def sorted_task_metrics(sorted_labels, sorted_predictions, sorted_weights=None,
+                        recall_precisions=RECALL_PRECISIONS):
+    """
+    Metrics of each task from its examples sorted by decreasing prediction, see sort_tasks.
+
+    Every metric comes from the same cumulative counts, with no further sort.
+    Returns an OrderedDict from metric names to arrays with a value per task,
+    nan where a metric is undefined, and with a recall per recall_precisions.
+    Without examples every metric is nan and the counts are 0.
+    """
+    if sorted_labels.shape[1] == 0:
+        num_tasks = sorted_labels.shape[0]
+        metrics = OrderedDict((name, np.full(num_tasks, np.nan)) for name in
+                              ['Balanced accuracy', 'auROC', 'auPRC'] + list(recall_precisions.keys()))
+        metrics['Num Positives'] = np.zeros(num_tasks, dtype=np.int64)
+        metrics['Num Negatives'] = np.zeros(num_tasks, dtype=np.int64)
+        return metrics
+    tps, fps, prev_tps, prev_fps, points = curve_counts(
+        sorted_labels, sorted_predictions, sorted_weights)
+    num_positives = tps[:, -1]
+    num_negatives = fps[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive_accuracy = 100 * _counts_at(
+            tps, (sorted_predictions > 0.5).sum(axis=1)[:, None])[:, 0] / num_positives
+        negative_accuracy = 100 * (num_negatives - _counts_at(
+            fps, (sorted_predictions >= 0.5).sum(axis=1)[:, None])[:, 0]) / num_negatives
+        roc_area = np.where(points, (fps - prev_fps) * (tps + prev_tps), 0).sum(axis=1)
+        precision = tps / (tps + fps)
+        prev_precision = np.where(prev_tps + prev_fps > 0,
+                                  prev_tps / (prev_tps + prev_fps), 1)
+        pr_area = np.where(points, (tps - prev_tps) * (precision + prev_precision), 0).sum(axis=1)
+        metrics = OrderedDict((
+            ('Balanced accuracy', (positive_accuracy + negative_accuracy) / 2),
+            ('auROC', roc_area / (2 * num_positives * num_negatives)),
+            ('auPRC', pr_area / (2 * num_positives)),
+        ))
+        recalls = np.array([
+            _recall_at_precisions(task_tps[task_points], task_fps[task_points],
+                                  task_num_positives, recall_precisions.values())
+            for task_tps, task_fps, task_points, task_num_positives in zip(
+                tps, fps, points, num_positives)]).reshape(-1, len(recall_precisions))
+    for name, task_recalls in zip(recall_precisions.keys(), recalls.T):
+        metrics[name] = task_recalls
+    metrics['Num Positives'] = num_positives
+    metrics['Num Negatives'] = num_negatives
+    return metrics
+
+
+def _chunk_task_metrics(labels, predictions, start, stop, recall_precisions):
+    """Metrics of tasks [start, stop), of arrays shared by all chunks."""
+    sorted_labels, sorted_predictions = sort_tasks(
+        labels[:, start:stop], predictions[:, start:stop])[1:]
+    return sorted_task_metrics(sorted_labels, sorted_predictions,
+                               recall_precisions=recall_precisions)
+
+
+def bootstrap_weights(num_examples, sample_indx, seed=0):
+    """
+    Times each example is drawn in a bootstrap resample, multinomial counts summing to num_examples.
+
+    Depends only on seed and sample_indx, so every chunk of tasks gets the
+    same resamples.
+    """
+    if num_examples == 0:
+        return np.zeros(0, dtype=np.int64)
+    rng = np.random.RandomState([seed, sample_indx])
+    return np.bincount(rng.randint(num_examples, size=num_examples), minlength=num_examples)
+
+
+def _chunk_bootstrap_intervals(labels, predictions, start, stop, num_samples, confidence, seed):
+    """Bootstrap intervals of tasks [start, stop), weighting the examples sorted once."""
+    order, sorted_labels, sorted_predictions = sort_tasks(
+        labels[:, start:stop], predictions[:, start:stop])
+    samples = []
+    for sample_indx in range(num_samples):
+        weights = bootstrap_weights(len(labels), sample_indx, seed=seed)
+        sample_metrics = sorted_task_metrics(sorted_labels, sorted_predictions, weights[order])
+        samples.append([sample_metrics[name] for name in BOOTSTRAP_METRICS])
+    # (metrics, tasks, samples) percentiles, nan where a metric is undefined in every sample
+    samples = np.transpose(samples, (1, 2, 0))
+    tail = 50 * (1 - confidence)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bounds = np.nanpercentile(samples, [tail, 100 - tail], axis=2)
+    return OrderedDict((name, bounds[:, indx].T) for indx, name in enumerate(BOOTSTRAP_METRICS))
 
-    def __init__(self, labels, predictions, task_names=None):
-        self.results = []
-        non_ambig_task_names = []
-        for i, (task_labels, task_predictions) in enumerate(zip(labels.T, predictions.T)):
-            non_ambig_label_indxs = np.where(task_labels != AMBIG_LABEL)[0]
-            if len(non_ambig_label_indxs) == 0:  # skip ambiguous tasks
+
+def _chunk_stratified_metrics(labels, predictions, start, stop, strata_codes, recall_precisions):
+    """
+    Metrics of tasks [start, stop) in each stratum, of each stratification in strata_codes.
+
+    The examples of each task are sorted once, then regrouped by stratum with
+    a stable sort of the stratum codes, so each stratum is a slice of
+    examples still sorted by prediction, at the same offsets for all tasks.
+    Returns (tasks, strata) arrays, strata in order of strata_codes.
+    """
+    order, sorted_labels, sorted_predictions = sort_tasks(
+        labels[:, start:stop], predictions[:, start:stop])
+    task_indxs = np.arange(len(order))[:, None]
+    strata_metrics = []
+    for codes in strata_codes:
+        offsets = np.r_[0, np.cumsum(np.bincount(codes))]
+        if len(offsets) == 2:
+            grouped_labels, grouped_predictions = sorted_labels, sorted_predictions
+        else:
+            regroup = np.argsort(codes[order], axis=1, kind='mergesort')
+            grouped_labels = sorted_labels[task_indxs, regroup]
+            grouped_predictions = sorted_predictions[task_indxs, regroup]
+        strata_metrics += [
+            sorted_task_metrics(grouped_labels[:, offset:next_offset],
+                                grouped_predictions[:, offset:next_offset],
+                                recall_precisions=recall_precisions)
+            for offset, next_offset in zip(offsets[:-1], offsets[1:])]
+    return OrderedDict((name, np.stack([metrics[name] for metrics in strata_metrics], axis=1))
+                       for name in strata_metrics[0])
+
+
+def _map_task_chunks(chunk_fn, labels, predictions, chunk_args, n_jobs=1):
+    """
+    Runs chunk_fn on chunks of the tasks of (examples, tasks) labels and predictions.
+
+    Chunks have at most METRICS_MAX_ELEMENTS examples times tasks. If n_jobs
+    > 1, chunks are computed in a joblib process pool, with at least a chunk
+    per process. joblib memory maps the labels and predictions for the
+    workers instead of pickling them. Returns an OrderedDict from each key
+    of the chunk results to the results of all tasks.
+    """
+    num_examples, num_tasks = labels.shape
+    chunk_size = max(METRICS_MAX_ELEMENTS // max(num_examples, 1), 1)
+    if n_jobs > 1:
+        chunk_size = min(chunk_size, -(-num_tasks // n_jobs))
+    chunk_slices = [(start, min(start + chunk_size, num_tasks))
+                    for start in range(0, num_tasks, chunk_size)]
+    if n_jobs > 1 and len(chunk_slices) > 1:
+        from joblib import Parallel, delayed
+
+        chunks = Parallel(n_jobs=min(n_jobs, len(chunk_slices)))(
+            delayed(chunk_fn)(labels, predictions, start, stop, *chunk_args)
+            for start, stop in chunk_slices)
+    else:
+        chunks = [chunk_fn(labels, predictions, start, stop, *chunk_args)
+                  for start, stop in chunk_slices]
+    return OrderedDict((name, np.concatenate([chunk[name] for chunk in chunks]))
+                       for name in chunks[0])
+
+
+def task_metrics(labels, predictions, recall_precisions=RECALL_PRECISIONS, n_jobs=1):
+    """
+    Metrics of each task of (examples, tasks) labels and predictions.
+
+    Tasks are sorted and counted in chunks, in n_jobs processes, see
+    _map_task_chunks. Returns an OrderedDict as sorted_task_metrics.
+    """
+    return _map_task_chunks(_chunk_task_metrics, labels, predictions, (recall_precisions,),
+                            n_jobs=n_jobs)
+
+
+def bootstrap_intervals(labels, predictions, num_samples, confidence=0.95, seed=0, n_jobs=1):
+    """
+    Bootstrap confidence intervals of the BOOTSTRAP_METRICS of each task.
+
+    Each task is sorted once, a resample of the examples is a vector of
+    multinomial counts weighting the sorted examples, so each sample costs
+    a pass over them and no sort. Examples are resampled jointly across
+    tasks. Returns an OrderedDict from metric names to (tasks, 2) arrays
+    of the lower and upper bounds of the percentile intervals.
+    """
+    return _map_task_chunks(_chunk_bootstrap_intervals, labels, predictions,
+                            (num_samples, confidence, seed), n_jobs=n_jobs)
+
+
+def stratified_metrics(labels, predictions, strata, task_names=None,
+                       recall_precisions=RECALL_PRECISIONS, n_jobs=1):
+    """
+    Metrics of each task pooled and within each stratum, as tidy table rows.
+
+    strata maps stratification names, e.g. 'chrom', to arrays with the
+    stratum of each example. Each task is sorted once for all strata, in
+    chunks and n_jobs processes as task_metrics. Returns a list of
+    OrderedDicts with the stratification, stratum and task of each row
+    followed by its metrics, with pooled rows as stratification and stratum
+    'all'. Strata where a task has only ambiguous labels have no row.
+    """
+    if task_names is None:
+        task_names = list(range(labels.shape[1]))
+    row_keys = [('all', 'all')]
+    strata_codes = [np.zeros(len(labels), dtype=np.uint8)]
+    for stratification, values in strata.items():
+        stratum_values, codes = np.unique(values, return_inverse=True)
+        row_keys += [(stratification, stratum) for stratum in stratum_values]
+        # small integer codes are stable sorted in linear time by recent numpy
+        strata_codes.append(codes.ravel().astype(np.min_scalar_type(len(stratum_values) - 1)))
+    metrics = _map_task_chunks(_chunk_stratified_metrics, labels, predictions,
+                               (strata_codes, recall_precisions), n_jobs=n_jobs)
+    rows = []
+    for stratum_indx, (stratification, stratum) in enumerate(row_keys):
+        for task_indx, task_name in enumerate(task_names):
+            if metrics['Num Positives'][task_indx, stratum_indx] + \
+                    metrics['Num Negatives'][task_indx, stratum_indx] == 0:
                 continue
-            task_labels = task_labels[non_ambig_label_indxs]
-            task_predictions = task_predictions[non_ambig_label_indxs]
-            if task_names is not None:
-                non_ambig_task_names.append(task_names[i])
-            self.results.append(OrderedDict((
-                ('Balanced accuracy', balanced_accuracy(
-                    task_labels, task_predictions)),
-                ('auROC', auROC(task_labels, task_predictions)),
-                ('auPRC', auPRC(task_labels, task_predictions)),
-                ('Recall at 5% FDR', recall_at_precision_threshold(
-                    task_labels, task_predictions, 0.95)),
-                ('Recall at 10% FDR', recall_at_precision_threshold(
-                    task_labels, task_predictions, 0.9)),
-                ('Recall at 25% FDR', recall_at_precision_threshold(
-                    task_labels, task_predictions, 0.75)),
-                ('Recall at 50% FDR', recall_at_precision_threshold(
-                    task_labels, task_predictions, 0.5)),
-                ('Num Positives', task_labels.sum()),
-                ('Num Negatives', (1 - task_labels).sum())
-            )))
-        self.task_names = task_names if task_names is None else non_ambig_task_names
+            rows.append(OrderedDict(
+                [('stratification', stratification), ('stratum', stratum), ('task', task_name)] +
+                [(name, values[task_indx, stratum_indx]) for name, values in metrics.items()]))
+    return rows
+
+
+def write_metrics_table(rows, path):
+    """Writes metrics table rows, e.g. of stratified_metrics, as a tab separated file with a header."""
+    with open(path, 'w') as fp:
+        if not rows:
+            return
+        fp.write('\t'.join(rows[0].keys()) + '\n')
+        for row in rows:
+            fp.write('\t'.join(value.decode() if isinstance(value, bytes) else str(value)
+                               for value in row.values()) + '\n')
+
+
+class ClassificationResult(object):
+
+    def __init__(self, labels, predictions, task_names=None, n_jobs=1,
+                 bootstrap_samples=0, confidence=0.95, seed=0):
+        metrics = task_metrics(labels, predictions, n_jobs=n_jobs)
+        # skip ambiguous tasks
+        task_indxs = np.where(metrics['Num Positives'] + metrics['Num Negatives'] > 0)[0]
+        self.results = [OrderedDict((name, values[task_indx]) for name, values in metrics.items())
+                        for task_indx in task_indxs]
+        self.confidence = confidence
+        self.intervals = None
+        if bootstrap_samples > 0:
+            intervals = bootstrap_intervals(labels, predictions, bootstrap_samples,
+                                            confidence=confidence, seed=seed, n_jobs=n_jobs)
+            self.intervals = [OrderedDict((name, tuple(bounds[task_indx]))
+                                          for name, bounds in intervals.items())
+                              for task_indx in task_indxs]
+        self.task_names = task_names if task_names is None else [
+            task_names[task_indx] for task_indx in task_indxs]
         self.multitask = labels.shape[1] > 1
 
     def __str__(self):
@@ -77,8 +362,24 @@ class ClassificationResult(object):
                 '{}: '.format('Task {}'.format(
                     self.task_names[task_index]
                     if self.task_names is not None else task_index))
-                if self.multitask else '', *results.values())
+                if self.multitask else '', *results.values()) +
+            ('' if self.intervals is None else self._format_intervals(task_index))
             for task_index, results in enumerate(self.results))
 
+    def _format_intervals(self, task_index):
+        intervals = self.intervals[task_index]
+        return (
+            '{:.0%} CI Balanced Accuracy: [{:.2f}%, {:.2f}%]\t'
+            'auROC: [{:.3f}, {:.3f}]\t auPRC: [{:.3f}, {:.3f}]\n'
+            'Recall at 5% | 10% | 25% | 50% FDR: [{:.1f}%, {:.1f}%] | [{:.1f}%, {:.1f}%] | '
+            '[{:.1f}%, {:.1f}%] | [{:.1f}%, {:.1f}%]\n'.format(
+                self.confidence, *[bound for bounds in intervals.values() for bound in bounds]))
+
     def __getitem__(self, item):
         return np.array([task_results[item] for task_results in self.results])
+
+    def interval(self, item):
+        """(tasks, 2) array of the bootstrap confidence interval bounds of a metric."""
+        if self.intervals is None:
+            raise ValueError('No bootstrap intervals, set bootstrap_samples')
+        return np.array([task_intervals[item] for task_intervals in self.intervals])
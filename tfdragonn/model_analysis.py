@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import sys
+
+from tfdragonn import loggers
+from tfdragonn import pwms
+from tfdragonn.model_specs import get_config_input_shapes, load_model_config
+
+LOGGER_NAME = 'tfdragonn-analyze-model'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Bytes per activation, models run in float32
+BYTES_PER_ACTIVATION = 4
+
+# Elementwise FLOPs per output of layers without weights
+ELEMENTWISE_FLOPS = {'Activation': 1, 'BatchNormalization': 4, 'Dropout': 0}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn analyze-model',
+                                     description='Statically compute receptive field, parameters,'
+                                     ' FLOPs and activation memory of a model spec.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('modelspec', type=os.path.abspath,
+                        help='Model parameters json file path')
+    parser.add_argument('--interval-length', type=int, default=1000,
+                        help='Length of the input intervals.\nDefault: 1000.')
+    parser.add_argument('--num-tasks', type=int, default=1,
+                        help='Number of tasks.\nDefault: 1.')
+    parser.add_argument('--output', type=os.path.abspath, default=None,
+                        help='Json file to write the analysis to.\nDefault: none.')
+    parser.add_argument('--max-params', type=int, default=None,
+                        help='Fail if the model has more parameters.\nDefault: none.')
+    parser.add_argument('--max-flops-per-base', type=float, default=None,
+                        help='Fail if the model needs more FLOPs per input base.\nDefault: none.')
+    parser.add_argument('--max-activation-mb', type=float, default=None,
+                        help='Fail if the activations of an example need more Mb.\nDefault: none.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_analyze_model_from_args(command, args):
+    args = parse_args(args)
+    analysis = analyze_model_spec(args.modelspec, args.interval_length, args.num_tasks)
+    print(analysis)
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(analysis.to_dict(), fp, indent=4)
+        _logger.info('Saved analysis to {}'.format(args.output))
+    violations = analysis.check_limits(max_params=args.max_params,
+                                       max_flops_per_base=args.max_flops_per_base,
+                                       max_activation_mb=args.max_activation_mb)
+    for violation in violations:
+        _logger.error(violation)
+    if violations:
+        sys.exit(1)
+
+
+LayerStats = collections.namedtuple(
+    'LayerStats', ['name', 'output_shape', 'params', 'flops', 'activation_bytes', 'receptive_field'])
+
+
+class _Tensor(object):
+    """
+    Static description of a layer output.
+
+    length is None for vectors, e.g. after flattening. receptive_field is the
+    number of input bases seen by one output position and jump the distance
+    in bases between consecutive output positions.
+    """
+
+    def __init__(self, length, channels, receptive_field, jump):
+        self.length = length
+        self.channels = channels
+        self.receptive_field = receptive_field
+        self.jump = jump
+
+    @property
+    def shape(self):
+        return (self.channels,) if self.length is None else (self.length, self.channels)
+
+    @property
+    def size(self):
+        return self.channels if self.length is None else self.length * self.channels
+
+
+class ModelAnalysis(object):
+    """
+    Layer by layer accounting of a model, built by calling its layer methods
+    in the order the keras model applies them.
+
+    All counts are per example. FLOPs count a multiply-add as two.
+    """
+
+    def __init__(self, model_class_name, shapes):
+        self.model_class_name = model_class_name
+        self.shapes = shapes
+        self.interval_length = max(shape[-1] for shape in shapes.values())
+        self.layers = []
+        self._layer_counts = collections.Counter()
+
+    def _add(self, layer_type, tensor, params=0, flops=0):
+        self._layer_counts[layer_type] += 1
+        self.layers.append(LayerStats(
+            name='{}_{}'.format(layer_type.lower(), self._layer_counts[layer_type]),
+            output_shape=tensor.shape, params=params, flops=flops,
+            activation_bytes=tensor.size * BYTES_PER_ACTIVATION,
+            receptive_field=tensor.receptive_field))
+        return tensor
+
+    def input(self, input_name):
+        """Input reshaped the way Classifier.reshape_keras_inputs does."""
+        shape = self.shapes[input_name]
+        if len(shape) == 2:  # (C, L) -> (L, C), e.g. sequence
+            tensor = _Tensor(shape[1], shape[0], 1, 1)
+        elif input_name.endswith('_data_dir'):  # (L,) -> (L, 1)
+            tensor = _Tensor(shape[0], 1, 1, 1)
+        else:
+            tensor = _Tensor(None, shape[0], 0, 1)
+        return self._add('Input', tensor)
+
+    @staticmethod
+    def _conv_output(x, nb_filter, filter_length, dilation=1, border_mode='valid', stride=1):
+        span = (filter_length - 1) * dilation + 1
+        if border_mode == 'same':
+            length = (x.length + stride - 1) // stride
+        else:
+            length = (x.length - span) // stride + 1
+        if length < 1:
+            raise ValueError('Convolution of width {} does not fit in length {}'.format(
+                span, x.length))
+        return _Tensor(length, nb_filter, x.receptive_field + (span - 1) * x.jump, x.jump * stride)
+
+    def conv(self, x, nb_filter, filter_length, dilation=1, border_mode='valid', stride=1):
+        tensor = self._conv_output(x, nb_filter, filter_length, dilation, border_mode, stride)
+        weights = filter_length * x.channels * nb_filter
+        return self._add('Convolution1D', tensor, params=weights + nb_filter,
+                         flops=tensor.length * (2 * weights + nb_filter))
+
+    def rc_conv(self, x, nb_filter, filter_length):
+        """RevCompConv1D, odd nb_filter rounded up as the models do."""
+        nb_filter += nb_filter % 2
+        tensor = self._conv_output(x, nb_filter, filter_length)
+        weights = filter_length * x.channels * nb_filter // 2
+        return self._add('RevCompConv1D', tensor, params=weights + nb_filter // 2,
+                         flops=tensor.length * (4 * weights + nb_filter))
+
+    def rc_fold(self, x):
+        tensor = _Tensor(x.length, x.channels // 2, x.receptive_field, x.jump)
+        return self._add('RevCompFold', tensor, flops=tensor.size)
+
+    def pool(self, x, pool_length, stride=None, mode='Average'):
+        stride = pool_length if stride is None else stride
+        length = (x.length - pool_length) // stride + 1
+        if length < 1:
+            raise ValueError('Pooling of width {} does not fit in length {}'.format(
+                pool_length, x.length))
+        tensor = _Tensor(length, x.channels, x.receptive_field + (pool_length - 1) * x.jump,
+                         x.jump * stride)
+        return self._add('{}Pooling1D'.format(mode), tensor,
+                         flops=length * x.channels * pool_length)
+
+    def elementwise(self, x, layer_type, params=0):
+        tensor = _Tensor(x.length, x.channels, x.receptive_field, x.jump)
+        return self._add(layer_type, tensor, params=params,
+                         flops=ELEMENTWISE_FLOPS.get(layer_type, 1) * x.size)
+
+    def activation(self, x):
+        return self.elementwise(x, 'Activation')
+
+    def batch_norm(self, x):
+        # gamma, beta and the running mean and std, as keras counts them
+        return self.elementwise(x, 'BatchNormalization', params=4 * x.channels)
+
+    def dropout(self, x):
+        return self.elementwise(x, 'Dropout')
+
+    def add(self, xs):
+        if len(set((x.length, x.channels) for x in xs)) != 1:
+            raise ValueError('Cannot add shapes {}'.format([x.shape for x in xs]))
+        tensor = _Tensor(xs[0].length, xs[0].channels, max(x.receptive_field for x in xs),
+                         max(x.jump for x in xs))
+        return self._add('Add', tensor, flops=(len(xs) - 1) * xs[0].size)
+
+    def channel_slice(self, x, start, stop):
+        tensor = _Tensor(x.length, stop - start, x.receptive_field, x.jump)
+        return self._add('ChannelSlice', tensor)
+
+    def concat(self, xs):
+        lengths = set(x.length for x in xs)
+        if len(lengths) != 1:
+            raise ValueError('Cannot concatenate lengths {}'.format(sorted(lengths)))
+        tensor = _Tensor(xs[0].length, sum(x.channels for x in xs),
+                         max(x.receptive_field for x in xs), max(x.jump for x in xs))
+        return self._add('Merge', tensor)
+
+    def global_pool(self, x, mode='Average'):
+        tensor = _Tensor(None, x.channels, self.interval_length, x.jump)
+        return self._add('Global{}Pooling1D'.format(mode), tensor, flops=x.size)
+
+    def flatten(self, x):
+        return self._add('Flatten', _Tensor(None, x.size, self.interval_length, x.jump))
+
+    def dense(self, x, output_dim):
+        weights = x.channels * output_dim
+        tensor = _Tensor(None, output_dim, x.receptive_field, x.jump)
+        return self._add('Dense', tensor, params=weights + output_dim,
+                         flops=2 * weights + output_dim)
+
+    @property
+    def total_params(self):
+        return sum(layer.params for layer in self.layers)
+
+    @property
+    def flops_per_example(self):
+        return sum(layer.flops for layer in self.layers)
+
+    @property
+    def flops_per_base(self):
+        return self.flops_per_example / self.interval_length
+
+    @property
+    def activation_bytes_per_example(self):
+        """Memory of all layer outputs, as kept for the backward pass in training."""
+        return sum(layer.activation_bytes for layer in self.layers)
+
+    @property
+    def receptive_field(self):
+        """Largest receptive field of a convolutional or pooled output position."""
+        return max([layer.receptive_field for layer in self.layers if len(layer.output_shape) == 2] +
+                   [0])
+
+    def check_limits(self, max_params=None, max_flops_per_base=None, max_activation_mb=None):
+        """Returns descriptions of the limits the model exceeds."""
+        violations = []
+        if max_params is not None and self.total_params > max_params:
+            violations.append('{} parameters exceed {}'.format(self.total_params, max_params))
+        if max_flops_per_base is not None and self.flops_per_base > max_flops_per_base:
+            violations.append('{:.4g} FLOPs per base exceed {:.4g}'.format(
+                self.flops_per_base, max_flops_per_base))
+        activation_mb = self.activation_bytes_per_example / 10**6
+        if max_activation_mb is not None and activation_mb > max_activation_mb:
+            violations.append('{:.4g} Mb of activations per example exceed {:.4g}'.format(
+                activation_mb, max_activation_mb))
+        return violations
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('model_class', self.model_class_name),
+            ('input_shapes', self.shapes),
+            ('params', self.total_params),
+            ('flops_per_example', self.flops_per_example),
+            ('flops_per_base', self.flops_per_base),
+            ('activation_bytes_per_example', self.activation_bytes_per_example),
+            ('receptive_field', self.receptive_field),
+            ('layers', [layer._asdict() for layer in self.layers]),
+        ])
+
+    def __str__(self):
+        rows = [('layer', 'output shape', 'params', 'FLOPs', 'activations (kb)', 'receptive field')]
+        for layer in self.layers:
+            rows.append((layer.name, str(layer.output_shape), str(layer.params), str(layer.flops),
+                         '{:.1f}'.format(layer.activation_bytes / 10**3), str(layer.receptive_field)))
+        widths = [max(len(row[indx]) for row in rows) for indx in range(len(rows[0]))]
+        lines = ['  '.join([row[0].ljust(widths[0])] +
+                           [value.rjust(width) for value, width in zip(row[1:], widths[1:])])
+                 for row in rows]
+        lines += ['',
+                  '{}: {} parameters, {:.4g} FLOPs per example ({:.4g} per base),'.format(
+                      self.model_class_name, self.total_params, self.flops_per_example,
+                      self.flops_per_base),
+                  '{:.4g} Mb of activations per example, receptive field of {} bases'.format(
+                      self.activation_bytes_per_example / 10**6, self.receptive_field)]
+        return '\n'.join(lines)
+
+
+def _conv_block(analysis, x, num_filters, conv_width, batch_norm, dropout, rc_equivariant=False):
+    """Valid convolutions with optional batch norm, relu and dropout."""
+    conv = analysis.rc_conv if rc_equivariant else analysis.conv
+    for nb_filter, nb_col in zip(num_filters, conv_width):
+        x = conv(x, nb_filter, nb_col)
+        if batch_norm:
+            x = analysis.batch_norm(x)
+        x = analysis.activation(x)
+        if dropout > 0:
+            x = analysis.dropout(x)
+    return x
+
+
+def _fc_block(analysis, x, fc_layer_widths, batch_norm, dropout):
+    for fc_layer_width in fc_layer_widths:
+        x = analysis.dense(x, fc_layer_width)
+        if batch_norm:
+            x = analysis.batch_norm(x)
+        x = analysis.activation(x)
+        if dropout > 0:
+            x = analysis.dropout(x)
+    return x
+
+
+def _pwm_conv(analysis, x, pwm_paths):
+    """Fixed convolution with padded pwms, as in the baseline classifiers."""
+    conv_filters = pwms.pwms2conv_filters(pwm_paths)
+    max_width = max(conv_filter.shape[0] for conv_filter in conv_filters)
+    return analysis.conv(x, len(conv_filters), max_width)
+
+
+def analyze_sequence_classifier(analysis, num_tasks,
+                                num_filters=(15, 15, 15), conv_width=(15, 15, 15),
+                                pool_width=35, dropout=0, batch_norm=False, rc_equivariant=False):
+    x = analysis.input('data/genome_data_dir')
+    x = _conv_block(analysis, x, num_filters, conv_width, batch_norm, dropout, rc_equivariant)
+    if rc_equivariant:
+        x = analysis.rc_fold(x)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_sequence_baseline_classifier(analysis, num_tasks, pwm_paths,
+                                         num_filters=(15, 15, 15), conv_width=(15, 15, 15),
+                                         pool_width=35, dropout=0, batch_norm=False):
+    x = analysis.input('data/genome_data_dir')
+    x = _pwm_conv(analysis, x, pwm_paths)
+    x = analysis.batch_norm(x)
+    x = analysis.activation(x)
+    if dropout > 0:
+        x = analysis.dropout(x)
+    x = _conv_block(analysis, x, num_filters, conv_width, batch_norm, dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_sequence_and_dnase_classifier(analysis, num_tasks, pwm_paths=None,
+                                          num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+                                          num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+                                          num_combined_filters=(55,), combined_conv_width=(25,),
+                                          pool_width=25,
+                                          fc_layer_widths=(100,),
+                                          seq_conv_dropout=0.0,
+                                          dnase_conv_dropout=0.0,
+                                          combined_conv_dropout=0.0,
+                                          fc_layer_dropout=0.0,
+                                          batch_norm=False,
+                                          rc_equivariant=False):
+    # the baseline classifier's pwm convolution is not connected to its output,
+    # so pwm_paths adds no layers
+    seq = analysis.input('data/genome_data_dir')
+    seq = _conv_block(analysis, seq, num_seq_filters, seq_conv_width, batch_norm, seq_conv_dropout,
+                      rc_equivariant)
+    dnase = analysis.input('data/dnase_data_dir')
+    dnase = _conv_block(analysis, dnase, num_dnase_filters, dnase_conv_width, batch_norm,
+                        dnase_conv_dropout, rc_equivariant)
+    x = analysis.concat([seq, dnase])
+    x = _conv_block(analysis, x, num_combined_filters, combined_conv_width, batch_norm,
+                    combined_conv_dropout, rc_equivariant)
+    if rc_equivariant:
+        x = analysis.rc_fold(x)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = _fc_block(analysis, x, fc_layer_widths, batch_norm, fc_layer_dropout)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_pwm_track_baseline_classifier(analysis, num_tasks, pwm_paths,
+                                          num_filters=(15, 15, 15), conv_width=(15, 15, 15),
+                                          pool_width=35, dropout=0, batch_norm=False):
+    x = analysis.input('data/pwm_scores_data_dir')
+    x = analysis.activation(analysis.batch_norm(x))
+    if dropout > 0:
+        x = analysis.dropout(x)
+    x = _conv_block(analysis, x, num_filters, conv_width, batch_norm, dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_pwm_track_and_dnase_baseline_classifier(
+        analysis, num_tasks, pwm_paths,
+        num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+        num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+        num_combined_filters=(55,), combined_conv_width=(25,),
+        pool_width=25, fc_layer_widths=(100,),
+        seq_conv_dropout=0.0, dnase_conv_dropout=0.0,
+        combined_conv_dropout=0.0, fc_layer_dropout=0.0, batch_norm=False):
+    seq = analysis.input('data/pwm_scores_data_dir')
+    seq = analysis.activation(analysis.batch_norm(seq))
+    if seq_conv_dropout > 0:
+        seq = analysis.dropout(seq)
+    seq = _conv_block(analysis, seq, num_seq_filters, seq_conv_width, batch_norm, seq_conv_dropout)
+    dnase = analysis.input('data/dnase_data_dir')
+    dnase = _conv_block(analysis, dnase, num_dnase_filters, dnase_conv_width, batch_norm,
+                        dnase_conv_dropout)
+    x = analysis.concat([seq, dnase])
+    x = _conv_block(analysis, x, num_combined_filters, combined_conv_width, batch_norm,
+                    combined_conv_dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = _fc_block(analysis, x, fc_layer_widths, batch_norm, fc_layer_dropout)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_shape_and_dnase_classifier(analysis, num_tasks, **hyperparameters):
+    shape = analysis.concat([analysis.input(input_name) for input_name in [
+        'data/HelT_data_dir', 'data/MGW_data_dir', 'data/OC2_data_dir',
+        'data/ProT_data_dir', 'data/Roll_data_dir']])
+    dnase = analysis.input('data/dnase_data_dir')
+    return _shape_and_dnase_network(analysis, num_tasks, shape, dnase, **hyperparameters)
+
+
+def analyze_fused_shape_and_dnase_classifier(analysis, num_tasks, **hyperparameters):
+    x = analysis.input('data/shape_dnase_data_dir')
+    shape = analysis.channel_slice(x, 0, x.channels - 1)
+    dnase = analysis.channel_slice(x, x.channels - 1, x.channels)
+    return _shape_and_dnase_network(analysis, num_tasks, shape, dnase, **hyperparameters)
+
+
+def _shape_and_dnase_network(analysis, num_tasks, shape, dnase,
+                             num_shape_filters=(25, 25, 25), shape_conv_width=(25, 25, 25),
+                             num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+                             num_combined_filters=(55,), combined_conv_width=(25,),
+                             pool_width=25,
+                             fc_layer_widths=(100,),
+                             shape_conv_dropout=0.0,
+                             dnase_conv_dropout=0.0,
+                             combined_conv_dropout=0.0,
+                             fc_layer_dropout=0.0,
+                             batch_norm=False):
+    shape = _conv_block(analysis, shape, num_shape_filters, shape_conv_width, batch_norm,
+                        shape_conv_dropout)
+    dnase = _conv_block(analysis, dnase, num_dnase_filters, dnase_conv_width, batch_norm,
+                        dnase_conv_dropout)
+    x = analysis.concat([shape, dnase])
+    x = _conv_block(analysis, x, num_combined_filters, combined_conv_width, batch_norm,
+                    combined_conv_dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = _fc_block(analysis, x, fc_layer_widths, batch_norm, fc_layer_dropout)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_sequence_dnase_tss_dhs_count_and_tss_expression_classifier(
+        analysis, num_tasks,
+        num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+        num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+        num_combined_filters=(55,), combined_conv_width=(25,),
+        pool_width=25,
+        seq_dnase_fc_layer_widths=(100,),
+        final_fc_layer_widths=(100,),
+        seq_conv_dropout=0,
+        dnase_conv_dropout=0,
+        combined_conv_dropout=0,
+        seq_dnase_fc_layer_dropout=0,
+        final_fc_dropout=0,
+        batch_norm=False):
+    seq = analysis.input('data/genome_data_dir')
+    seq = _conv_block(analysis, seq, num_seq_filters, seq_conv_width, batch_norm, seq_conv_dropout)
+    dnase = analysis.input('data/dnase_data_dir')
+    dnase = _conv_block(analysis, dnase, num_dnase_filters, dnase_conv_width, batch_norm,
+                        dnase_conv_dropout)
+    x = analysis.concat([seq, dnase])
+    x = _conv_block(analysis, x, num_combined_filters, combined_conv_width, batch_norm,
+                    combined_conv_dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    x = _fc_block(analysis, x, seq_dnase_fc_layer_widths, batch_norm, seq_dnase_fc_layer_dropout)
+    x = analysis.concat([x] + [analysis.input(input_name) for input_name in [
+        'data/dhs_counts', 'data/tss_counts', 'data/tss_mean_tpm', 'data/tss_max_tpm']])
+    x = _fc_block(analysis, x, final_fc_layer_widths, batch_norm, final_fc_dropout)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_amr_sequence_classifier(analysis, num_tasks,
+                                    num_filters=(32, 32, 32), conv_width=(15, 14, 14),
+                                    batch_norm=True, pool_width=40, pool_stride=20,
+                                    fc_layer_sizes=(10,), dropout=(0.5,), final_dropout=0.5):
+    x = analysis.input('data/genome_data_dir')
+    x = _conv_block(analysis, x, num_filters, conv_width, batch_norm, 0)
+    x = analysis.pool(x, pool_width, pool_stride, mode='Max')
+    x = analysis.flatten(x)
+    for fc_layer_size in fc_layer_sizes:
+        x = analysis.dropout(x)
+        x = analysis.dense(x, fc_layer_size)
+        x = analysis.activation(x)
+    x = analysis.dropout(x)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_dilated_sequence_classifier(analysis, num_tasks,
+                                        num_filters=64, stem_conv_width=15, stem_pool_width=4,
+                                        num_blocks=6, conv_width=3, dilation_base=2,
+                                        pool_width=None, fc_layer_widths=(100,),
+                                        dropout=0, batch_norm=True):
+    x = analysis.input('data/genome_data_dir')
+    x = analysis.conv(x, num_filters, stem_conv_width, border_mode='same')
+    if batch_norm:
+        x = analysis.batch_norm(x)
+    x = analysis.activation(x)
+    x = analysis.pool(x, stem_pool_width, mode='Max')
+    for i in range(num_blocks):
+        y = analysis.conv(x, num_filters, conv_width, dilation=dilation_base ** i,
+                          border_mode='same')
+        if batch_norm:
+            y = analysis.batch_norm(y)
+        y = analysis.activation(y)
+        if dropout > 0:
+            y = analysis.dropout(y)
+        x = analysis.add([x, y])
+    if pool_width is None:
+        x = analysis.global_pool(x)
+    else:
+        x = analysis.pool(x, pool_width)
+        x = analysis.flatten(x)
+    x = _fc_block(analysis, x, fc_layer_widths, False, dropout)
+    x = analysis.dense(x, num_tasks)
+    return analysis.activation(x)
+
+
+def analyze_shared_trunk_classifier(analysis, num_tasks,
+                                    num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+                                    num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+                                    num_combined_filters=(55,), combined_conv_width=(25,),
+                                    pool_width=25, trunk_width=200, head_width=16,
+                                    dropout=0.0, batch_norm=False):
+    seq = analysis.input('data/genome_data_dir')
+    seq = _conv_block(analysis, seq, num_seq_filters, seq_conv_width, batch_norm, dropout)
+    dnase = analysis.input('data/dnase_data_dir')
+    dnase = _conv_block(analysis, dnase, num_dnase_filters, dnase_conv_width, batch_norm, dropout)
+    x = analysis.concat([seq, dnase])
+    x = _conv_block(analysis, x, num_combined_filters, combined_conv_width, batch_norm, dropout)
+    x = analysis.pool(x, pool_width)
+    x = analysis.flatten(x)
+    trunk = _fc_block(analysis, x, [trunk_width], batch_norm, dropout)
+    heads = []
+    for _ in range(num_tasks):
+        head = trunk
+        if head_width:
+            head = analysis.activation(analysis.dense(head, head_width))
+        heads.append(analysis.dense(head, 1))
+    x = analysis.concat(heads) if num_tasks > 1 else heads[0]
+    return analysis.activation(x)
+
+
+# Static analysis of each model class, mirroring its constructor and defaults
+model_analyzers = {
+    'SequenceClassifier': analyze_sequence_classifier,
+    'SequenceBaselineClassifier': analyze_sequence_baseline_classifier,
+    'SequenceAndDnaseClassifier': analyze_sequence_and_dnase_classifier,
+    'SequenceAndDnaseBaselineClassifier': analyze_sequence_and_dnase_classifier,
+    'PwmTrackBaselineClassifier': analyze_pwm_track_baseline_classifier,
+    'PwmTrackAndDnaseBaselineClassifier': analyze_pwm_track_and_dnase_baseline_classifier,
+    'ShapeAndDnaseClassifier': analyze_shape_and_dnase_classifier,
+    'FusedShapeAndDnaseClassifier': analyze_fused_shape_and_dnase_classifier,
+    'SequenceDnaseTssDhsCountAndTssExpressionClassifier':
+        analyze_sequence_dnase_tss_dhs_count_and_tss_expression_classifier,
+    'AmrSequenceClassifier': analyze_amr_sequence_classifier,
+    'DilatedSequenceClassifier': analyze_dilated_sequence_classifier,
+    'SharedTrunkClassifier': analyze_shared_trunk_classifier,
+}
+
+
+def analyze_model_config(config, shapes, num_tasks):
+    """
+    Returns the ModelAnalysis of a model config dict for the given input shapes.
+
+    Raises a ValueError for model classes without an analyzer and for layers
+    that do not fit in the inputs.
+    """
+    config = dict(config)
+    model_class_name = config.pop('model_class')
+    if model_class_name not in model_analyzers:
+        raise ValueError('No static analysis for {}'.format(model_class_name))
+    analysis = ModelAnalysis(model_class_name, shapes)
+    model_analyzers[model_class_name](analysis, num_tasks, **config)
+    return analysis
+
+
+def analyze_model_spec(model_config_file_path, interval_length, num_tasks):
+    """Returns the ModelAnalysis of a model spec file for intervals of a given length."""
+    config = load_model_config(model_config_file_path)
+    return analyze_model_config(config, get_config_input_shapes(config, interval_length), num_tasks)
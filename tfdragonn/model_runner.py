@@ -5,6 +5,8 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
+import functools
 import os
 import json
 import ntpath
@@ -14,12 +16,17 @@ from keras import backend as K
 import numpy as np
 import tensorflow as tf
 
-from tfdragonn import database
+from tfdragonn import autotune
+from tfdragonn import cascade
+from tfdragonn import metrics
+from tfdragonn import model_analysis
 from tfdragonn import models
+from tfdragonn import predictions
 from tfdragonn import trainers
 from tfdragonn import loggers
 
 from .genomeflow_interface import GenomeFlowInterface
+from .model_specs import check_rc_average_inputs, load_model_config
 
 # tf-binding project specific settings (only used if --is-tfbinding-project is
 # specified, or the environment variable 'IS_TFBINDING_PROJECT' is set)
@@ -35,12 +42,23 @@ DEFAULT_VALID_CHROMS = ['chr9']
 DEFAULT_EARLYSTOPPING_KEY = 'auPRC'
 DEFAULT_EARLYSTOPPING_PATIENCE = 4
 
+# Default max number of epochs asynchronous validation can lag behind training
+DEFAULT_MAX_VALIDATION_LAG = 1
+
+# Example metadata test can stratify metrics by
+STRATA = ['chrom', 'dataset']
+
+# Metrics reported by distill, the ClassificationResult keys other than counts
+DISTILLATION_METRICS = ['Balanced accuracy', 'auROC', 'auPRC', 'Recall at 5% FDR',
+                        'Recall at 10% FDR', 'Recall at 25% FDR', 'Recall at 50% FDR']
+
 # Whether to load datasets in memory before training or read from disk
 IN_MEMORY = False
 
 # Default learning parameters
 DEFAULT_BATCH_SIZE = 256
 DEFAULT_EPOCH_SIZE = 2500000
+DEFAULT_NUM_EPOCHS = 100
 DEFAULT_LEARNING_RATE = 0.0003
 
 # TF Session Settings
@@ -91,6 +109,13 @@ class BaseModelRunner(object):
         """Add any class-specific arguments to the parser."""
         pass
 
+    @staticmethod
+    def add_metrics_args(parser):
+        parser.add_argument('--metrics-n-jobs',
+                            type=int,
+                            help='Number of processes computing per task metrics, default: 1',
+                            default=1)
+
     @classmethod
     def parse_args(cls, args):
         parser = cls.get_parser()
@@ -111,17 +136,23 @@ class BaseModelRunner(object):
             IS_TFBINDING_PROJECT = True
             run_id = str(params.logdir.lstrip(TFBINDING_LOGDIR_PREFIX))
             if self.command == 'train':
+                from tfdragonn import database  # needs psycopg2, tf-binding project only
                 database.add_run(run_id, params.datasetspec, params.intervalspec,
                                  params.modelspec, params.logdir)
         self.validate_paths(params)
-        if self.command == 'train' and not os.path.exists(params.logdir):
+        if self.command in ['train', 'sweep', 'distill'] and not os.path.exists(params.logdir):
             os.makedirs(params.logdir)
 	if os.path.exists(os.path.join(params.logdir, "model.weights.h5")):
 	    self._model_exists = True
         loggers.add_logdir(self._logger_name, params.logdir)
+        self.prepare_run(params)
         self.setup_keras_session(params.visiblegpus)
         self.run(params)
 
+    def prepare_run(self, params):
+        """Hook for any setup that has to happen before the TF session is created."""
+        pass
+
     def run(self, params):
         raise NotImplementedError('Model runners must implement run')
 
@@ -161,6 +192,18 @@ class TrainRunner(BaseModelRunner):
 
     @classmethod
     def add_additional_args(cls, parser):
+        cls.add_training_args(parser)
+        parser.add_argument('--async-validation',
+                            action='store_true',
+                            help='Validate weight snapshots in a separate process while training continues')
+        parser.add_argument('--max-validation-lag',
+                            type=int,
+                            help='Max number of epochs asynchronous validation can lag behind training (int), default: {}'.format(
+                                DEFAULT_MAX_VALIDATION_LAG),
+                            default=DEFAULT_MAX_VALIDATION_LAG)
+
+    @staticmethod
+    def add_training_args(parser):
         parser.add_argument('--validation-intervalspec',
                             type=os.path.abspath,
                             help='Heldout celltype intervalspec to use as validation set, default: None',
@@ -187,6 +230,10 @@ class TrainRunner(BaseModelRunner):
                             type=int,
                             help='Epoch size (int), default: {}'.format(DEFAULT_EPOCH_SIZE),
                             default=DEFAULT_EPOCH_SIZE)
+        parser.add_argument('--num-epochs',
+                            type=int,
+                            help='Max number of epochs (int), default: {}'.format(DEFAULT_NUM_EPOCHS),
+                            default=DEFAULT_NUM_EPOCHS)
         parser.add_argument('--early-stopping-metric',
                             type=str,
                             help='Early stopping metric key, default: {}'.format(
@@ -197,6 +244,31 @@ class TrainRunner(BaseModelRunner):
                             help='Early stopping patience (int), default: {}'.format(
                                 DEFAULT_EARLYSTOPPING_PATIENCE),
                             default=DEFAULT_EARLYSTOPPING_PATIENCE)
+        BaseModelRunner.add_metrics_args(parser)
+
+    def prepare_run(self, params):
+        self._async_validator = None
+        if params.async_validation:
+            # fork the validation process before this process sets up its TF session
+            self._async_validator = trainers.AsyncValidator(
+                functools.partial(self.build_validation_model_and_queue, params),
+                snapshot_dir=os.path.join(params.logdir, 'validation_snapshots'),
+                max_lag=params.max_validation_lag,
+                metrics_n_jobs=params.metrics_n_jobs)
+
+    @classmethod
+    def build_validation_model_and_queue(cls, params):
+        """Builds the validation model and queue in the asynchronous validation process."""
+        cls.setup_keras_session(params.visiblegpus)
+        data_interface = GenomeFlowInterface(
+            params.datasetspec, params.intervalspec, params.modelspec, params.logdir,
+            validation_chroms=params.valid_chroms,
+            holdout_chroms=params.holdout_chroms,
+            validation_intervalspec=params.validation_intervalspec)
+        validation_queue = data_interface.get_validation_queue()
+        model = models.model_from_minimal_config(
+            params.modelspec, validation_queue.output_shapes, len(data_interface.task_names))
+        return model, validation_queue, data_interface.task_names
 
     def run(self, params):
         shutil.copyfile(params.datasetspec, os.path.join(
@@ -213,17 +285,20 @@ class TrainRunner(BaseModelRunner):
             validation_intervalspec=params.validation_intervalspec,
             logger=self._logger)
         train_queue = data_interface.get_train_queue()
-        validation_queue = data_interface.get_validation_queue()
+        validation_queue = None
+        if self._async_validator is None:
+            validation_queue = data_interface.get_validation_queue()
 
         trainer = trainers.ClassifierTrainer(task_names=data_interface.task_names,
                                              optimizer='adam',
                                              lr=params.learning_rate,
                                              batch_size=params.batch_size,
                                              epoch_size=params.epoch_size,
-                                             num_epochs=100,
+                                             num_epochs=params.num_epochs,
                                              early_stopping_metric=params.early_stopping_metric,
                                              early_stopping_patience=params.early_stopping_patience,
-                                             logger=self._logger)
+                                             logger=self._logger,
+                                             metrics_n_jobs=params.metrics_n_jobs)
 
         model = models.model_from_minimal_config(
             params.modelspec, train_queue.output_shapes, len(data_interface.task_names))
@@ -235,79 +310,524 @@ class TrainRunner(BaseModelRunner):
 	    prefix = 'newmodel'
 
         trainer.train(model, train_queue, validation_queue,
-                      save_best_model_to_prefix=os.path.join(params.logdir, prefix))
+                      save_best_model_to_prefix=os.path.join(params.logdir, prefix),
+                      async_validator=self._async_validator)
+
+
+class SweepRunner(BaseModelRunner):
+    """Trains many model specs and/or seeds against one shared data stream."""
+    command = 'sweep'
+
+    @classmethod
+    def get_parser(cls):
+        parser = argparse.ArgumentParser('tfdragonn {}'.format(cls.command))
+        parser.add_argument('datasetspec', type=os.path.abspath,
+                            help='Dataset parameters json file path')
+        parser.add_argument('intervalspec', type=os.path.abspath,
+                            help='Interval parameters json file path')
+        parser.add_argument('modelspecs', type=os.path.abspath, nargs='+',
+                            help='Model parameters json file paths')
+        parser.add_argument('logdir', type=os.path.abspath,
+                            help='Sweep log directory, each model is saved to its own subdirectory')
+        parser.add_argument('--visiblegpus', type=str,
+                            required=True, help='Visible GPUs string')
+        parser.add_argument('--maxexs', type=int,
+                            help='max number of examples', default=None)
+        parser.add_argument('--is-tfbinding-project', action='store_true',
+                            help='Use tf-binding project specific settings')
+        parser.add_argument('--seeds',
+                            type=json.loads,
+                            help='Random seeds to train each model spec with as a json string, default: None',
+                            default=None)
+        TrainRunner.add_training_args(parser)
+        return parser
+
+    @classmethod
+    def validate_paths(cls, params):
+        for specfile in [params.datasetspec, params.intervalspec] + params.modelspecs:
+            cls.validate_specfile(specfile)
+        if IS_TFBINDING_PROJECT:
+            assert(params.logdir.startswith(TFBINDING_LOGDIR_PREFIX))
+
+    @staticmethod
+    def get_sweep_runs(modelspecs, seeds):
+        """Returns a list of (run name, modelspec, seed) tuples."""
+        runs = []
+        for indx, modelspec in enumerate(modelspecs):
+            name = 'model{}.{}'.format(indx, os.path.splitext(os.path.basename(modelspec))[0])
+            if seeds is None:
+                runs.append((name, modelspec, None))
+            else:
+                runs += [('{}.seed{}'.format(name, seed), modelspec, seed) for seed in seeds]
+        return runs
+
+    def run(self, params):
+        runs = self.get_sweep_runs(params.modelspecs, params.seeds)
+        data_interface = GenomeFlowInterface(
+            params.datasetspec, params.intervalspec, params.modelspecs, params.logdir,
+            validation_chroms=params.valid_chroms,
+            holdout_chroms=params.holdout_chroms,
+            validation_intervalspec=params.validation_intervalspec,
+            logger=self._logger)
+        train_queue = data_interface.get_train_queue()
+        validation_queue = data_interface.get_validation_queue()
+
+        trainer = trainers.ClassifierTrainer(task_names=data_interface.task_names,
+                                             optimizer='adam',
+                                             lr=params.learning_rate,
+                                             batch_size=params.batch_size,
+                                             epoch_size=params.epoch_size,
+                                             num_epochs=params.num_epochs,
+                                             early_stopping_metric=params.early_stopping_metric,
+                                             early_stopping_patience=params.early_stopping_patience,
+                                             logger=self._logger,
+                                             metrics_n_jobs=params.metrics_n_jobs)
+
+        sweep_models = []
+        prefixes = []
+        for name, modelspec, seed in runs:
+            run_logdir = os.path.join(params.logdir, name)
+            if not os.path.exists(run_logdir):
+                os.makedirs(run_logdir)
+            shutil.copyfile(params.datasetspec, os.path.join(run_logdir, 'datasetspec.json'))
+            shutil.copyfile(params.intervalspec, os.path.join(run_logdir, 'intervalspec.json'))
+            shutil.copyfile(modelspec, os.path.join(run_logdir, 'modelspec.json'))
+            if seed is not None:
+                np.random.seed(seed)
+            self._logger.info('model {}: {} (logdir: {})'.format(len(sweep_models), name, run_logdir))
+            sweep_models.append(models.model_from_minimal_config(
+                modelspec, train_queue.output_shapes, len(data_interface.task_names)))
+            prefixes.append(os.path.join(run_logdir, 'model'))
+
+        trainer.train_many(sweep_models, train_queue, validation_queue,
+                           save_best_model_to_prefixes=prefixes)
+
+
+class DistillRunner(BaseModelRunner):
+    """Trains a student model spec on the predictions of a trained teacher."""
+    command = 'distill'
+
+    @classmethod
+    def add_additional_args(cls, parser):
+        parser.add_argument('--teacher-logdir',
+                            type=os.path.abspath,
+                            required=True,
+                            help='Log directory of the trained teacher, with its modelspec.json')
+        parser.add_argument('--pos-sampling-rate',
+                            type=float,
+                            help='Rate of positive training intervals, default: None, intervals are sampled uniformly as when scanning',
+                            default=None)
+        parser.add_argument('--inference-batch-size',
+                            type=int,
+                            help='Batch size to time teacher and student predictions with, default: 1000',
+                            default=1000)
+        TrainRunner.add_training_args(parser)
+
+    @classmethod
+    def validate_paths(cls, params):
+        super(DistillRunner, cls).validate_paths(params)
+        cls.validate_specfile(os.path.join(params.teacher_logdir, 'modelspec.json'))
+
+    def run(self, params):
+        teacher_modelspec = os.path.join(params.teacher_logdir, 'modelspec.json')
+        shutil.copyfile(params.datasetspec, os.path.join(params.logdir, 'datasetspec.json'))
+        shutil.copyfile(params.intervalspec, os.path.join(params.logdir, 'intervalspec.json'))
+        shutil.copyfile(params.modelspec, os.path.join(params.logdir, 'modelspec.json'))
+        shutil.copyfile(teacher_modelspec, os.path.join(params.logdir, 'teacher_modelspec.json'))
+
+        data_interface = GenomeFlowInterface(
+            params.datasetspec, params.intervalspec, [params.modelspec, teacher_modelspec],
+            params.logdir,
+            pos_sampling_rate=params.pos_sampling_rate,
+            validation_chroms=params.valid_chroms,
+            holdout_chroms=params.holdout_chroms,
+            validation_intervalspec=params.validation_intervalspec,
+            logger=self._logger)
+        train_queue = data_interface.get_train_queue()
+        validation_queue = data_interface.get_validation_queue()
+        num_tasks = len(data_interface.task_names)
+
+        trainer = trainers.ClassifierTrainer(task_names=data_interface.task_names,
+                                             optimizer='adam',
+                                             lr=params.learning_rate,
+                                             batch_size=params.batch_size,
+                                             epoch_size=params.epoch_size,
+                                             num_epochs=params.num_epochs,
+                                             early_stopping_metric=params.early_stopping_metric,
+                                             early_stopping_patience=params.early_stopping_patience,
+                                             logger=self._logger,
+                                             metrics_n_jobs=params.metrics_n_jobs)
+        teacher = models.model_from_minimal_config(
+            teacher_modelspec, train_queue.output_shapes, num_tasks)
+        teacher.load_weights(os.path.join(params.teacher_logdir, 'model.weights.h5'))
+        student = models.model_from_minimal_config(
+            params.modelspec, train_queue.output_shapes, num_tasks)
+        prefix = os.path.join(params.logdir, 'model')
+        trainer.distill(student, teacher, train_queue, validation_queue,
+                        save_best_model_to_prefix=prefix)
+
+        student.load_weights(prefix + '.weights.h5')
+        report = self.compare_models(params, data_interface, teacher, student, trainer)
+        with open(os.path.join(params.logdir, 'distillation.json'), 'w') as fp:
+            json.dump(report, fp, indent=4)
+        self._logger.info('Student speedup: {:.2f}x'.format(report['speedup']))
+        for metric, delta in report['metric_deltas'].items():
+            self._logger.info('Student {} delta: {:+.4f}'.format(metric, delta))
+
+    def compare_models(self, params, data_interface, teacher, student, trainer):
+        """
+        Returns a report of the speed and validation metrics of teacher and student.
+
+        Both models are validated in a single pass over a new validation queue
+        and timed on the probe batch of the data interface.
+        """
+        teacher_result, student_result = trainer.test_many(
+            [teacher, student], data_interface.get_validation_queue(),
+            batch_size=params.inference_batch_size)
+        batch = data_interface.get_probe_batch(params.inference_batch_size)
+        report = {}
+        for name, model, modelspec, result in [
+                ('teacher', teacher, os.path.join(params.teacher_logdir, 'modelspec.json'),
+                 teacher_result),
+                ('student', student, params.modelspec, student_result)]:
+            examples_per_sec = autotune.time_batch_sizes([model], batch, [len(batch['labels'])])
+            analysis = model_analysis.analyze_model_config(
+                load_model_config(modelspec),
+                {input_name: batch[input_name].shape[1:] for input_name in model.get_inputs},
+                len(data_interface.task_names))
+            report[name] = {'params': model.model.count_params(),
+                            'flops_per_example': analysis.flops_per_example,
+                            'examples_per_sec': list(examples_per_sec.values())[0],
+                            'metrics': {metric: float(result[metric].mean())
+                                        for metric in DISTILLATION_METRICS}}
+        report['speedup'] = (report['student']['examples_per_sec'] /
+                             report['teacher']['examples_per_sec'])
+        report['metric_deltas'] = {
+            metric: report['student']['metrics'][metric] - report['teacher']['metrics'][metric]
+            for metric in DISTILLATION_METRICS}
+        return report
 
 
 
 class TestRunner(BaseModelRunner):
     command = 'test'
 
+    @classmethod
+    def add_additional_args(cls, parser):
+        cls.add_inference_args(parser)
+        cls.add_metrics_args(parser)
+        parser.add_argument('--bootstrap-samples',
+                            type=int,
+                            help='Number of bootstrap resamples for confidence intervals of the metrics, default: 0 (no intervals)',
+                            default=0)
+        parser.add_argument('--confidence',
+                            type=float,
+                            help='Confidence level of the bootstrap intervals, default: 0.95',
+                            default=0.95)
+        parser.add_argument('--strata',
+                            type=str,
+                            nargs='+',
+                            choices=STRATA,
+                            help='Also compute metrics per chromosome and/or per dataset, written to --metrics-table, default: None',
+                            default=[])
+        parser.add_argument('--metrics-table',
+                            type=os.path.abspath,
+                            help='Tab separated file for the metrics of each model, stratum and task, default: <logdir>/test_metrics.tsv',
+                            default=None)
+
+    @staticmethod
+    def add_inference_args(parser):
+        """Arguments shared by test and predict."""
+        parser.add_argument('--rc-average',
+                            action='store_true',
+                            help='Average predictions on each example and its reverse complement')
+        parser.add_argument('--extra-logdirs',
+                            type=os.path.abspath,
+                            nargs='+',
+                            help='Log directories of more models to run on the same data, each with its modelspec.json, default: None',
+                            default=[])
+        parser.add_argument('--ensemble',
+                            action='store_true',
+                            help='Also evaluate the average of the predictions of all models')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            help='Inference batch size, default: 1000',
+                            default=1000)
+        parser.add_argument('--autotune-batch-size',
+                            action='store_true',
+                            help='Time candidate batch sizes on a probe batch and use the fastest, the choice is cached in the logdir')
+
+    @staticmethod
+    def get_logdirs_and_modelspecs(params):
+        """Returns (logdir, modelspec) of the main model followed by the extra models."""
+        return [(params.logdir, params.modelspec)] + [
+            (logdir, os.path.join(logdir, 'modelspec.json')) for logdir in params.extra_logdirs]
+
+    def load_models(self, params, shapes, num_tasks):
+        loaded_models = []
+        for logdir, modelspec in self.get_logdirs_and_modelspecs(params):
+            model = models.model_from_minimal_config(modelspec, shapes, num_tasks)
+            if params.rc_average:
+                check_rc_average_inputs(model.get_inputs)
+            model.load_weights(os.path.join(logdir, 'model.weights.h5'))
+            loaded_models.append(model)
+        return loaded_models
+
+    def get_batch_size(self, params, inference_models, data_interface):
+        """Returns the inference batch size, autotuned on the probe batch of the data interface."""
+        if not params.autotune_batch_size:
+            return params.batch_size
+        return autotune.autotune_batch_size(
+            inference_models, data_interface.get_probe_batch, params.logdir,
+            rc_average=params.rc_average, logger=self._logger)
+
     def run(self, params):
+        logdirs, modelspecs = zip(*self.get_logdirs_and_modelspecs(params))
         data_interface = GenomeFlowInterface(
-            params.datasetspec, params.intervalspec, params.modelspec, params.logdir)
-        validation_queue = data_interface.get_validation_queue()
-        model = models.model_from_minimal_config(
-            params.modelspec, validation_queue.output_shapes, len(data_interface.task_names))
-        model.load_weights(os.path.join(
-            params.logdir, 'model.weights.h5'))
+            params.datasetspec, params.intervalspec, list(modelspecs), params.logdir)
+        if params.strata:
+            validation_queue_fns = data_interface.get_validation_queue_fns()
+            # only the first dataset's queue is built up front, for the model input shapes
+            first_queue = list(validation_queue_fns.values())[0]()
+            output_shapes = first_queue.output_shapes
+        else:
+            validation_queue = data_interface.get_validation_queue()
+            output_shapes = validation_queue.output_shapes
+        test_models = self.load_models(params, output_shapes, len(data_interface.task_names))
+        batch_size = self.get_batch_size(params, test_models, data_interface)
         trainer = trainers.ClassifierTrainer(
-            task_names=data_interface.task_names)
-        classification_result = trainer.test(model, validation_queue, test_size=params.maxexs)
-        self._logger.info('\n{}'.format(classification_result))
+            task_names=data_interface.task_names, metrics_n_jobs=params.metrics_n_jobs)
+        if params.strata:
+            classification_results = self.test_stratified(
+                params, trainer, test_models, validation_queue_fns, first_queue, batch_size,
+                list(logdirs))
+        else:
+            classification_results = trainer.test_many(
+                test_models, validation_queue, batch_size=batch_size, test_size=params.maxexs,
+                rc_average=params.rc_average, ensemble=params.ensemble,
+                bootstrap_samples=params.bootstrap_samples, confidence=params.confidence)
+        if len(test_models) == 1 and not params.ensemble:
+            self._logger.info('\n{}'.format(classification_results[0]))
+            return
+        for name, classification_result in zip(
+                list(logdirs) + ['ensemble'], classification_results):
+            self._logger.info('\n{}:\n{}'.format(name, classification_result))
+
+    def test_stratified(self, params, trainer, test_models, validation_queue_fns, first_queue,
+                        batch_size, names):
+        """
+        Tests models on the validation queue of each dataset and writes metrics per stratum.
+
+        Each dataset is extracted once, its queue is built when it is reached,
+        first_queue is the already built queue of the first one. Predictions
+        keep the chromosome and dataset of each example and the metrics of
+        all strata are computed from them, see metrics.stratified_metrics.
+        maxexs caps the total number of examples: it is split evenly across
+        datasets, and the share a dataset does not use goes to the next ones.
+        Returns a pooled ClassificationResult per model, and of the ensemble,
+        as test_many.
+        """
+        labels = []
+        model_predictions = [[] for _ in test_models]
+        strata = collections.defaultdict(list)
+        remaining_size = params.maxexs
+        for indx, (dataset_id, queue_fn) in enumerate(validation_queue_fns.items()):
+            test_size = None
+            if remaining_size is not None:
+                test_size = int(np.ceil(remaining_size / (len(validation_queue_fns) - indx)))
+                if test_size <= 0:
+                    break
+            self._logger.info('testing on dataset {}'.format(dataset_id))
+            validation_queue = first_queue if indx == 0 else queue_fn()
+            dataset_labels, dataset_predictions, intervals = trainer.predict_labeled_many(
+                test_models, validation_queue, batch_size=batch_size, test_size=test_size,
+                rc_average=params.rc_average, return_intervals=True)
+            if remaining_size is not None:
+                remaining_size -= len(dataset_labels)
+            labels.append(dataset_labels)
+            for predictions_list, predictions_array in zip(model_predictions, dataset_predictions):
+                predictions_list.append(predictions_array)
+            strata['chrom'].append(intervals['chrom'])
+            strata['dataset'].append(np.repeat(dataset_id, len(dataset_labels)))
+        labels = np.vstack(labels)
+        model_predictions = [np.vstack(predictions_list) for predictions_list in model_predictions]
+        if params.ensemble:
+            model_predictions.append(np.mean(model_predictions, axis=0))
+        strata = collections.OrderedDict((stratification, np.concatenate(strata[stratification]))
+                                         for stratification in params.strata)
+
+        rows = []
+        for name, predictions_array in zip(names + ['ensemble'], model_predictions):
+            rows += [collections.OrderedDict([('model', name)] + list(row.items()))
+                     for row in metrics.stratified_metrics(
+                         labels, predictions_array, strata, task_names=trainer.task_names,
+                         n_jobs=params.metrics_n_jobs)]
+        metrics_table = params.metrics_table or os.path.join(params.logdir, 'test_metrics.tsv')
+        metrics.write_metrics_table(rows, metrics_table)
+        self._logger.info('Saved metrics of {} rows to {}'.format(len(rows), metrics_table))
+        return [trainer.evaluate(labels, predictions_array,
+                                 bootstrap_samples=params.bootstrap_samples,
+                                 confidence=params.confidence)
+                for predictions_array in model_predictions]
 
     @classmethod
     def validate_paths(cls, params):
         for specfile in [params.datasetspec, params.intervalspec, params.modelspec]:
             cls.validate_specfile(specfile)
         assert(os.path.exists(params.logdir))
+        for logdir in params.extra_logdirs:
+            cls.validate_specfile(os.path.join(logdir, 'modelspec.json'))
         if IS_TFBINDING_PROJECT:
             assert(params.logdir.startswith(TFBINDING_LOGDIR_PREFIX))
 
 
+class CascadeRunner(BaseModelRunner):
+    """Calibrates the thresholds of a screen model gating a trained model."""
+    command = 'calibrate-cascade'
+
+    @classmethod
+    def add_additional_args(cls, parser):
+        parser.add_argument('--screen-logdir',
+                            type=os.path.abspath,
+                            required=True,
+                            help='Log directory of the trained screen model, with its modelspec.json')
+        parser.add_argument('--target-recall',
+                            type=float,
+                            help='Fraction of validation positives of each task the screen passes on, default: {}'.format(
+                                cascade.DEFAULT_TARGET_RECALL),
+                            default=cascade.DEFAULT_TARGET_RECALL)
+        parser.add_argument('--batch-size',
+                            type=int,
+                            help='Inference batch size, default: 1000',
+                            default=1000)
+
+    @classmethod
+    def validate_paths(cls, params):
+        for specfile in [params.datasetspec, params.intervalspec, params.modelspec,
+                         os.path.join(params.screen_logdir, 'modelspec.json')]:
+            cls.validate_specfile(specfile)
+        assert(os.path.exists(params.logdir))
+
+    def run(self, params):
+        screen_modelspec = os.path.join(params.screen_logdir, 'modelspec.json')
+        data_interface = GenomeFlowInterface(
+            params.datasetspec, params.intervalspec, [params.modelspec, screen_modelspec],
+            params.logdir)
+        validation_queue = data_interface.get_validation_queue()
+        num_tasks = len(data_interface.task_names)
+        screen_model, full_model = [
+            models.model_from_minimal_config(modelspec, validation_queue.output_shapes, num_tasks)
+            for modelspec in [screen_modelspec, params.modelspec]]
+        screen_model.load_weights(os.path.join(params.screen_logdir, 'model.weights.h5'))
+        full_model.load_weights(os.path.join(params.logdir, 'model.weights.h5'))
+        trainer = trainers.ClassifierTrainer(task_names=data_interface.task_names)
+        labels, (screen_predictions, full_predictions) = trainer.predict_labeled_many(
+            [screen_model, full_model], validation_queue, batch_size=params.batch_size,
+            test_size=params.maxexs)
+
+        thresholds = cascade.calibrate_thresholds(labels, screen_predictions, params.target_recall)
+        report = cascade.cascade_report(labels, screen_predictions, full_predictions, thresholds)
+        batch = data_interface.get_probe_batch(params.batch_size)
+        screen_time, full_time = [
+            1 / list(autotune.time_batch_sizes([model], batch, [len(batch['labels'])]).values())[0]
+            for model in [screen_model, full_model]]
+        # per example time of the cascade relative to the full model on every example
+        report['estimated_speedup'] = full_time / (
+            screen_time + (1 - report['skipped_fraction']) * full_time)
+        report.update({'screen_logdir': params.screen_logdir,
+                       'target_recall': params.target_recall,
+                       'task_names': data_interface.task_names,
+                       'thresholds': thresholds.tolist()})
+        with open(os.path.join(params.logdir, cascade.CASCADE_FNAME), 'w') as fp:
+            json.dump(report, fp, indent=4)
+
+        self._logger.info('Skipped fraction: {:.3f}, estimated speedup: {:.2f}x'.format(
+            report['skipped_fraction'], report['estimated_speedup']))
+        for task_name, task_report in zip(data_interface.task_names, report['tasks']):
+            if task_report is not None:
+                self._logger.info(
+                    '{}: screen recall: {screen_recall:.4f}\t recall lost: {recall_lost:.4f}\t'
+                    ' auPRC: {full_auPRC:.3f} -> {cascade_auPRC:.3f}'.format(task_name, **task_report))
+
+
 class PredictRunner(TestRunner):
     command = 'predict'
 
     @classmethod
     def add_additional_args(cls, parser):
+        cls.add_inference_args(parser)
         parser.add_argument('prefix',
                             type=str,
-                            help='Prefix for files with predictions')
+                            help='Prefix for files with predictions, predictions of extra models and the ensemble are written to <prefix>.model<index>.<logdir name>, indexed from 1 in the order of --extra-logdirs, and <prefix>.ensemble')
         parser.add_argument('--flank-size',
                             type=int,
                             help='Size of flank in input intervals, flanks are trimmed before writing intervals to file. default: 400',
                             default=400)
+        parser.add_argument('--output-format',
+                            type=str,
+                            choices=['tab', 'store'],
+                            help='Write gzipped per task files (tab) or one chunked columnar prediction store per dataset (store). default: tab',
+                            default='tab')
+        parser.add_argument('--n-jobs',
+                            type=int,
+                            help='Number of compression workers for the prediction store. default: 1',
+                            default=1)
+
+    def write_predictions(self, streaming_prefix, prefix, dataset_id, params):
+        """Writes sorted streamed predictions in the requested output format."""
+        streamed_predictions = predictions.StreamedPredictions(streaming_prefix)
+        if params.output_format == 'store':
+            store_path = '{}.{}.store'.format(prefix, dataset_id)
+            predictions.write_prediction_store(
+                streamed_predictions, store_path, flank_size=params.flank_size,
+                n_jobs=params.n_jobs)
+            self._logger.info("\nSaved predictions in dataset {} to {}".format(
+                dataset_id, store_path))
+        else:
+            # write sorted intervals and per task predictions to file, trim flanks
+            prediction_fnames = predictions.write_task_files(
+                streamed_predictions, "{}.{{}}.{}.tab.gz".format(prefix, dataset_id),
+                flank_size=params.flank_size)
+            for task_name, prediction_fname in zip(streamed_predictions.task_names, prediction_fnames):
+                self._logger.info("\nSaved {} predictions in dataset {} to {}".format(
+                    task_name, dataset_id, prediction_fname))
+        streamed_predictions.remove()
 
     def run(self, params):
+        modelspecs = [modelspec for _, modelspec in self.get_logdirs_and_modelspecs(params)]
         data_interface = GenomeFlowInterface(
-            params.datasetspec, params.intervalspec, params.modelspec, params.logdir, shuffle=False, pos_sampling_rate=None)
-        example_queues = {dataset_id: data_interface.get_example_queue(dataset_values, dataset_id,
-                                                                       num_epochs=1,
-                                                                       input_names=data_interface.input_names,
-                                                                       enqueues_per_thread=[128, 1])
-                          for dataset_id, dataset_values in data_interface.dataset.items()}
-        model = models.model_from_minimal_config(
-            params.modelspec, example_queues.values()[0].output_shapes, len(data_interface.task_names))
-        model.load_weights(os.path.join(
-            params.logdir, 'model.weights.h5'))
+            params.datasetspec, params.intervalspec, modelspecs, params.logdir, shuffle=False, pos_sampling_rate=None)
+
+        def get_example_queue(dataset_id):
+            return data_interface.get_example_queue(data_interface.dataset[dataset_id], dataset_id,
+                                                    num_epochs=1,
+                                                    input_names=data_interface.input_names,
+                                                    enqueues_per_thread=[128, 1])
+        example_queues = {dataset_id: get_example_queue(dataset_id)
+                          for dataset_id in data_interface.dataset}
+        predict_models = self.load_models(
+            params, example_queues.values()[0].output_shapes, len(data_interface.task_names))
+        batch_size = self.get_batch_size(params, predict_models, data_interface)
         trainer = trainers.ClassifierTrainer(
             task_names=data_interface.task_names)
+        # logdirs can share a basename, the model index keeps output names unique
+        prefixes = [params.prefix] + ['{}.model{}.{}'.format(params.prefix, indx, os.path.basename(logdir))
+                                      for indx, logdir in enumerate(params.extra_logdirs, 1)]
+        if params.ensemble:
+            prefixes.append('{}.ensemble'.format(params.prefix))
 
         for dataset_id, example_queue in example_queues.items():
             self._logger.info('generating predictions for dataset {}'.format(dataset_id))
-            intervals, predictions = trainer.predict(model, example_queue)
-
-            # trim flanks
-            intervals['start'] += params.flank_size
-            intervals['end'] -= params.flank_size
-
-            # write intervals and per task predictions to file
-            for task_indx, task_name in enumerate(data_interface.task_names):
-                prediction_data = np.column_stack((intervals['chrom'],
-                                                   intervals['start'],
-                                                   intervals['end'],
-                                                   predictions[:, task_indx]))
-                prediction_fname = "{}.{}.{}.tab.gz".format(params.prefix, task_name, dataset_id)
-                np.savetxt(prediction_fname, prediction_data, delimiter='\t', fmt='%s')
-                self._logger.info("\nSaved {} predictions in dataset {} to {}".format(
-                    task_name, dataset_id, prediction_fname))
+            streaming_prefixes = [os.path.join(params.logdir, '{}.{}'.format(os.path.basename(prefix), dataset_id))
+                                  for prefix in prefixes]
+            writers = [predictions.StreamingPredictionWriter(streaming_prefix, data_interface.task_names)
+                       for streaming_prefix in streaming_prefixes]
+            try:
+                trainer.predict_many(predict_models, example_queue, batch_size=batch_size, writers=writers,
+                                     rc_average=params.rc_average, ensemble=params.ensemble)
+            finally:
+                for writer in writers:
+                    writer.close()
+            for streaming_prefix, prefix in zip(streaming_prefixes, prefixes):
+                self.write_predictions(streaming_prefix, prefix, dataset_id, params)
             self._logger.info('Done!')
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+
+from tfdragonn.datasets import FUSED_INPUT_CHANNELS
+
+# Inputs of each model class, kept free of keras so tools that only read
+# model specs, e.g. static model analysis, run without importing it
+model_inputs = {
+    "SequenceClassifier": [
+        "data/genome_data_dir"],
+    "AmrSequenceClassifier": [
+        "data/genome_data_dir"],
+    "DilatedSequenceClassifier": [
+        "data/genome_data_dir"],
+    "SequenceBaselineClassifier": [
+        "data/genome_data_dir"],
+    "SequenceAndDnaseClassifier": [
+        "data/genome_data_dir",
+        "data/dnase_data_dir"],
+    "SequenceAndDnaseBaselineClassifier": [
+        "data/genome_data_dir",
+        "data/dnase_data_dir"],
+    "ShapeAndDnaseClassifier": [
+        "data/HelT_data_dir",
+        "data/MGW_data_dir",
+        "data/OC2_data_dir",
+        "data/ProT_data_dir",
+        "data/Roll_data_dir",
+        "data/dnase_data_dir"],
+    "FusedShapeAndDnaseClassifier": [
+        "data/shape_dnase_data_dir"],
+    "PwmTrackBaselineClassifier": [
+        "data/pwm_scores_data_dir"],
+    "PwmTrackAndDnaseBaselineClassifier": [
+        "data/pwm_scores_data_dir",
+        "data/dnase_data_dir"],
+    "SharedTrunkClassifier": [
+        "data/genome_data_dir",
+        "data/dnase_data_dir"],
+    "SequenceDnaseTssDhsCountAndTssExpressionClassifier": [
+        "data/genome_data_dir",
+        "data/dnase_data_dir",
+        "data/dhs_counts",
+        "data/tss_counts",
+        "data/tss_mean_tpm",
+        "data/tss_max_tpm"]
+
+}
+
+
+def reverse_complement_sequence(x):
+    """Reverse complements (batch, 4, interval_size) one-hot ACGT arrays."""
+    return x[:, ::-1, ::-1]
+
+
+def reverse_track(x):
+    """Reverses per-base tracks along the last (interval_size) axis."""
+    return x[..., ::-1]
+
+
+input_reverse_complement_funcs = {
+    "data/genome_data_dir": reverse_complement_sequence,
+    "data/HelT_data_dir": reverse_track,
+    "data/MGW_data_dir": reverse_track,
+    "data/OC2_data_dir": reverse_track,
+    "data/ProT_data_dir": reverse_track,
+    "data/Roll_data_dir": reverse_track,
+    "data/dnase_data_dir": reverse_track,
+    "data/shape_dnase_data_dir": reverse_track
+}
+
+# Inputs without a strand, repeated as is in the reverse complement batch.
+# Strand specific inputs missing from both, e.g. pwm score tracks scanned on
+# one strand, cannot be reverse complemented.
+strandless_inputs = {
+    "data/dhs_counts",
+    "data/tss_counts",
+    "data/tss_max_tpm",
+    "data/tss_mean_tpm"
+}
+
+
+def check_rc_average_inputs(input_names):
+    """Raises a ValueError if any input cannot be reverse complemented."""
+    unsupported = [name for name in input_names
+                   if name not in input_reverse_complement_funcs and name not in strandless_inputs]
+    if unsupported:
+        raise ValueError('rc_average is not supported for inputs without a reverse complement: '
+                         '{}'.format(', '.join(unsupported)))
+
+
+def predict_rc_average(predict, batch, input_names):
+    """
+    Returns predict(batch) averaged with the predictions on its reverse complement.
+
+    The batch is stacked with its reverse complement into one doubled batch,
+    so predict runs once. Inputs without a strand, e.g. counts, are repeated
+    as is. Raises a ValueError for inputs that cannot be reverse complemented.
+    """
+    check_rc_average_inputs(input_names)
+    doubled_batch = {}
+    for name in input_names:
+        rc_func = input_reverse_complement_funcs.get(name)
+        rc_inputs = batch[name] if rc_func is None else rc_func(batch[name])
+        doubled_batch[name] = np.concatenate([batch[name], rc_inputs])
+    predictions = predict(doubled_batch)
+    batch_size = len(predictions) // 2
+    predictions[:batch_size] += predictions[batch_size:]
+    predictions[:batch_size] /= 2
+    return predictions[:batch_size]
+
+
+def load_model_config(model_config_file_path):
+    with open(model_config_file_path, 'r') as fp:
+        return json.load(fp)
+
+
+def model_inputs_from_config(model_config_file_path):
+    config = load_model_config(model_config_file_path)
+    return model_inputs[config['model_class']]
+
+
+def get_input_shapes(input_names, interval_length, num_pwms=None):
+    """Shapes of the example queue outputs of each model input."""
+    shapes = {}
+    for input_name in input_names:
+        data_type = input_name.split('/')[-1]
+        if input_name == 'data/genome_data_dir':
+            shapes[input_name] = (4, interval_length)
+        elif input_name == 'data/pwm_scores_data_dir':
+            if num_pwms is None:
+                raise ValueError('The shape of {} depends on the number of pwms'.format(input_name))
+            shapes[input_name] = (num_pwms, interval_length)
+        elif data_type in FUSED_INPUT_CHANNELS:
+            shapes[input_name] = (len(FUSED_INPUT_CHANNELS[data_type]), interval_length)
+        elif input_name.endswith('_data_dir'):
+            shapes[input_name] = (interval_length,)
+        else:  # per interval counts and expression
+            shapes[input_name] = (1,)
+    return shapes
+
+
+def get_config_input_shapes(config, interval_length):
+    """Shapes of the inputs of a model config dict, pwm score tracks have a channel per pwm_paths."""
+    return get_input_shapes(model_inputs[config['model_class']], interval_length,
+                            num_pwms=len(config['pwm_paths']) if 'pwm_paths' in config else None)
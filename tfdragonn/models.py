@@ -9,14 +9,17 @@ import sys
 
 from keras import backend as K
 from keras.layers import (
-    Activation, AveragePooling1D, BatchNormalization,
-    Convolution1D, Dense, Dropout, Flatten, Input,
+    Activation, AtrousConvolution1D, AveragePooling1D, BatchNormalization,
+    Convolution1D, Dense, Dropout, Flatten, GlobalAveragePooling1D, Input,
     MaxPooling1D, Merge, Permute, Reshape,
     PReLU
 )
 from keras.models import Model
 
 from tfdragonn import pwms
+from tfdragonn.datasets import FUSED_INPUT_CHANNELS
+from tfdragonn.layers import ChannelSlice, RevCompConcatenate, RevCompConv1D, RevCompFold
+from tfdragonn.model_specs import model_inputs, model_inputs_from_config, predict_rc_average  # NOQA
 
 def model_from_config(model_config_file_path):
     """Load a model from a json config file."""
@@ -76,45 +79,30 @@ _input_reshape_func = {
     "data/OC2_data_dir": reshape_bigwig_input,
     "data/ProT_data_dir": reshape_bigwig_input,
     "data/Roll_data_dir": reshape_bigwig_input,
-    "data/dnase_data_dir": reshape_bigwig_input
+    "data/dnase_data_dir": reshape_bigwig_input,
+    # (channels, interval_size) stacked tracks
+    "data/shape_dnase_data_dir": Permute((2, 1)),
+    "data/pwm_scores_data_dir": Permute((2, 1))
 }
 
 
-model_inputs = {
-    "SequenceClassifier": [
-        "data/genome_data_dir"],
-    "AmrSequenceClassifier": [
-        "data/genome_data_dir"],
-    "SequenceBaselineClassifier": [
-        "data/genome_data_dir"],
-    "SequenceAndDnaseClassifier": [
-        "data/genome_data_dir",
-        "data/dnase_data_dir"],
-    "SequenceAndDnaseBaselineClassifier": [
-        "data/genome_data_dir",
-        "data/dnase_data_dir"],
-    "ShapeAndDnaseClassifier": [
-        "data/HelT_data_dir",
-        "data/MGW_data_dir",
-        "data/OC2_data_dir",
-        "data/ProT_data_dir",
-        "data/Roll_data_dir",
-        "data/dnase_data_dir"],
-    "SequenceDnaseTssDhsCountAndTssExpressionClassifier": [
-        "data/genome_data_dir",
-        "data/dnase_data_dir",
-        "data/dhs_counts",
-        "data/tss_counts",
-        "data/tss_mean_tpm",
-        "data/tss_max_tpm"]
+def check_rc_equivariant(rc_equivariant, batch_norm):
+    """Batch norm learns separate scales for a filter and its reverse complement."""
+    if rc_equivariant and batch_norm:
+        raise ValueError('rc_equivariant models do not support batch_norm')
 
-}
 
+def check_pwm_scores_shape(shapes, pwm_paths):
+    """Score tracks need a channel per pwm, in the order of pwm_paths."""
+    num_channels = shapes["data/pwm_scores_data_dir"][0]
+    if num_channels != len(pwm_paths):
+        raise ValueError('pwm score tracks have {} channels, expected one per pwm in pwm_paths '
+                         '({})'.format(num_channels, len(pwm_paths)))
 
-def model_inputs_from_config(model_config_file_path):
-    with open(model_config_file_path, 'r') as fp:
-        config = json.load(fp)
-    return model_inputs[config['model_class']]
+
+def even_nb_filter(nb_filter):
+    """RevCompConv1D splits its filters between strands, odd counts are rounded up."""
+    return nb_filter + nb_filter % 2
 
 
 class Classifier(object):
@@ -145,6 +133,18 @@ class Classifier(object):
     def load_weights(self, filepath):
         self.model.load_weights(filepath)
 
+    def predict_on_batch(self, batch, rc_average=False):
+        """
+        Returns (batch_size, num_tasks) predictions.
+
+        If rc_average, predictions are averaged with the reverse complement's,
+        see model_specs.predict_rc_average.
+        """
+        if not rc_average:
+            return np.vstack(self.model.predict_on_batch(batch))
+        return predict_rc_average(lambda doubled_batch: np.vstack(
+            self.model.predict_on_batch(doubled_batch)), batch, self.get_inputs)
+
     def get_keras_inputs(self, shapes):
         """Returns dictionary of named keras inputs"""
         return collections.OrderedDict(
@@ -167,8 +167,9 @@ class SequenceClassifier(Classifier):
 
     def __init__(self, shapes, num_tasks,
                  num_filters=(15, 15, 15), conv_width=(15, 15, 15),
-                 pool_width=35, dropout=0, batch_norm=False):
+                 pool_width=35, dropout=0, batch_norm=False, rc_equivariant=False):
         assert len(num_filters) == len(conv_width)
+        check_rc_equivariant(rc_equivariant, batch_norm)
 
         # configure inputs
         keras_inputs = self.get_keras_inputs(shapes)
@@ -177,13 +178,18 @@ class SequenceClassifier(Classifier):
         # convolve sequence
         seq_preds = inputs["data/genome_data_dir"]
         for i, (nb_filter, nb_col) in enumerate(zip(num_filters, conv_width)):
-            seq_preds = Convolution1D(
-                nb_filter, nb_col)(seq_preds) #had to delete 'he_normal' name
+            if rc_equivariant:
+                seq_preds = RevCompConv1D(even_nb_filter(nb_filter), nb_col)(seq_preds)
+            else:
+                seq_preds = Convolution1D(
+                    nb_filter, nb_col)(seq_preds) #had to delete 'he_normal' name
             if batch_norm:
                 seq_preds = BatchNormalization()(seq_preds)
             seq_preds = Activation('relu')(seq_preds)
             if dropout > 0:
                 seq_preds = Dropout(dropout)(seq_preds)
+        if rc_equivariant:
+            seq_preds = RevCompFold()(seq_preds)
 
         # pool and fully connect
         seq_preds = AveragePooling1D((pool_width))(seq_preds)
@@ -254,10 +260,13 @@ class SequenceAndDnaseClassifier(Classifier):
                  dnase_conv_dropout=0.0,
                  combined_conv_dropout=0.0,
                  fc_layer_dropout=0.0,
-                 batch_norm=False):
+                 batch_norm=False,
+                 rc_equivariant=False):
         assert len(num_seq_filters) == len(seq_conv_width)
         assert len(num_dnase_filters) == len(dnase_conv_width)
         assert len(num_combined_filters) == len(combined_conv_width)
+        check_rc_equivariant(rc_equivariant, batch_norm)
+        conv_layer = RevCompConv1D if rc_equivariant else Convolution1D
 
         # configure inputs
         keras_inputs = self.get_keras_inputs(shapes)
@@ -266,7 +275,9 @@ class SequenceAndDnaseClassifier(Classifier):
         # convolve sequence
         seq_preds = inputs["data/genome_data_dir"]
         for nb_filter, nb_col in zip(num_seq_filters, seq_conv_width):
-            seq_preds = Convolution1D(
+            if rc_equivariant:
+                nb_filter = even_nb_filter(nb_filter)
+            seq_preds = conv_layer(
                 nb_filter, nb_col, 'he_normal')(seq_preds)
             if batch_norm:
                 seq_preds = BatchNormalization()(seq_preds)
@@ -277,7 +288,9 @@ class SequenceAndDnaseClassifier(Classifier):
         # convolve dnase
         dnase_preds = inputs["data/dnase_data_dir"]
         for nb_filter, nb_col in zip(num_dnase_filters, dnase_conv_width):
-            dnase_preds = Convolution1D(
+            if rc_equivariant:
+                nb_filter = even_nb_filter(nb_filter)
+            dnase_preds = conv_layer(
                 nb_filter, nb_col, 'he_normal')(dnase_preds)
             if batch_norm:
                 dnase_preds = BatchNormalization()(dnase_preds)
@@ -286,14 +299,21 @@ class SequenceAndDnaseClassifier(Classifier):
                 dnase_preds = Dropout(dnase_conv_dropout)(dnase_preds)
 
         # stack and convolve
-        logits = Merge(mode='concat', concat_axis=-1)([seq_preds, dnase_preds])
+        if rc_equivariant:
+            logits = RevCompConcatenate()([seq_preds, dnase_preds])
+        else:
+            logits = Merge(mode='concat', concat_axis=-1)([seq_preds, dnase_preds])
         for nb_filter, nb_col in zip(num_combined_filters, combined_conv_width):
-            logits = Convolution1D(nb_filter, nb_col, 'he_normal')(logits)
+            if rc_equivariant:
+                nb_filter = even_nb_filter(nb_filter)
+            logits = conv_layer(nb_filter, nb_col, 'he_normal')(logits)
             if batch_norm:
                 logits = BatchNormalization()(logits)
             logits = Activation('relu')(logits)
             if combined_conv_dropout > 0:
                 logits = Dropout(combined_conv_dropout)(logits)
+        if rc_equivariant:
+            logits = RevCompFold()(logits)
 
         # pool and fully connect
         logits = AveragePooling1D((pool_width))(logits)
@@ -398,6 +418,130 @@ class SequenceAndDnaseBaselineClassifier(Classifier):
         self.model = Model(input=keras_inputs.values(), output=logits)
 
 
+class PwmTrackBaselineClassifier(Classifier):
+    """
+    SequenceBaselineClassifier on precomputed pwm score tracks.
+
+    Reads the output of the frozen pwm convolution from score tracks written
+    by scanpwms with the same pwm_paths, instead of recomputing it for every
+    example in every epoch.
+    """
+
+    def __init__(self, shapes, num_tasks, pwm_paths,
+                 num_filters=(15, 15, 15), conv_width=(15, 15, 15),
+                 pool_width=35, dropout=0, batch_norm=False):
+        assert len(num_filters) == len(conv_width)
+        check_pwm_scores_shape(shapes, pwm_paths)
+
+        # configure inputs
+        keras_inputs = self.get_keras_inputs(shapes)
+        inputs = self.reshape_keras_inputs(keras_inputs)
+
+        # normalize pwm scores
+        seq_preds = inputs["data/pwm_scores_data_dir"]
+        seq_preds = BatchNormalization()(seq_preds)  # this is necessary
+        seq_preds = Activation('relu')(seq_preds)
+        if dropout > 0:
+            seq_preds = Dropout(dropout)(seq_preds)
+
+        # de novo convolutions
+        for nb_filter, nb_col in zip(num_filters, conv_width):
+            seq_preds = Convolution1D(
+                nb_filter, nb_col, 'he_normal')(seq_preds)
+            if batch_norm:
+                seq_preds = BatchNormalization()(seq_preds)
+            seq_preds = Activation('relu')(seq_preds)
+            if dropout > 0:
+                seq_preds = Dropout(dropout)(seq_preds)
+
+        # pool and fully connect
+        seq_preds = AveragePooling1D((pool_width))(seq_preds)
+        seq_preds = Flatten()(seq_preds)
+        seq_preds = Dense(output_dim=num_tasks)(seq_preds)
+        seq_preds = Activation('sigmoid')(seq_preds)
+        self.model = Model(input=keras_inputs.values(), output=seq_preds)
+
+
+class PwmTrackAndDnaseBaselineClassifier(Classifier):
+    """
+    Sequence and DNase baseline on precomputed pwm score tracks.
+
+    The de novo sequence convolutions run on the normalized pwm scores.
+    """
+
+    def __init__(self, shapes, num_tasks, pwm_paths,
+                 num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+                 num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+                 num_combined_filters=(55,), combined_conv_width=(25,),
+                 pool_width=25,
+                 fc_layer_widths=(100,),
+                 seq_conv_dropout=0.0,
+                 dnase_conv_dropout=0.0,
+                 combined_conv_dropout=0.0,
+                 fc_layer_dropout=0.0,
+                 batch_norm=False):
+        assert len(num_seq_filters) == len(seq_conv_width)
+        assert len(num_dnase_filters) == len(dnase_conv_width)
+        assert len(num_combined_filters) == len(combined_conv_width)
+        check_pwm_scores_shape(shapes, pwm_paths)
+
+        # configure inputs
+        keras_inputs = self.get_keras_inputs(shapes)
+        inputs = self.reshape_keras_inputs(keras_inputs)
+
+        # normalize pwm scores
+        seq_preds = inputs["data/pwm_scores_data_dir"]
+        seq_preds = BatchNormalization()(seq_preds)  # this is necessary
+        seq_preds = Activation('relu')(seq_preds)
+        if seq_conv_dropout > 0:
+            seq_preds = Dropout(seq_conv_dropout)(seq_preds)
+
+        # convolve with de novo convolutions
+        for nb_filter, nb_col in zip(num_seq_filters, seq_conv_width):
+            seq_preds = Convolution1D(
+                nb_filter, nb_col, 'he_normal')(seq_preds)
+            if batch_norm:
+                seq_preds = BatchNormalization()(seq_preds)
+            seq_preds = Activation('relu')(seq_preds)
+            if seq_conv_dropout > 0:
+                seq_preds = Dropout(seq_conv_dropout)(seq_preds)
+
+        # convolve dnase
+        dnase_preds = inputs["data/dnase_data_dir"]
+        for nb_filter, nb_col in zip(num_dnase_filters, dnase_conv_width):
+            dnase_preds = Convolution1D(
+                nb_filter, nb_col, 'he_normal')(dnase_preds)
+            if batch_norm:
+                dnase_preds = BatchNormalization()(dnase_preds)
+            dnase_preds = Activation('relu')(dnase_preds)
+            if dnase_conv_dropout > 0:
+                dnase_preds = Dropout(dnase_conv_dropout)(dnase_preds)
+
+        # stack and convolve
+        logits = Merge(mode='concat', concat_axis=-1)([seq_preds, dnase_preds])
+        for nb_filter, nb_col in zip(num_combined_filters, combined_conv_width):
+            logits = Convolution1D(nb_filter, nb_col, 'he_normal')(logits)
+            if batch_norm:
+                logits = BatchNormalization()(logits)
+            logits = Activation('relu')(logits)
+            if combined_conv_dropout > 0:
+                logits = Dropout(combined_conv_dropout)(logits)
+
+        # pool and fully connect
+        logits = AveragePooling1D((pool_width))(logits)
+        logits = Flatten()(logits)
+        for fc_layer_width in fc_layer_widths:
+            logits = Dense(fc_layer_width)(logits)
+            if batch_norm:
+                logits = BatchNormalization()(logits)
+            logits = Activation('relu')(logits)
+            if fc_layer_dropout > 0:
+                logits = Dropout(fc_layer_dropout)(logits)
+        logits = Dense(num_tasks)(logits)
+        logits = Activation('sigmoid')(logits)
+        self.model = Model(input=keras_inputs.values(), output=logits)
+
+
 class ShapeAndDnaseClassifier(Classifier):
 
     def __init__(self, shapes, num_tasks,
@@ -420,10 +564,7 @@ class ShapeAndDnaseClassifier(Classifier):
         inputs = self.reshape_keras_inputs(keras_inputs)
 
         # convolve sequence
-        shape_preds = Merge(mode='concat', concat_axis=-1)([
-            inputs[k] for k in ["data/HelT_data_dir", "data/MGW_data_dir",
-                                "data/OC2_data_dir", "data/ProT_data_dir",
-                                "data/Roll_data_dir"]])
+        shape_preds, dnase_preds = self.get_shape_and_dnase_inputs(inputs)
         for i, (nb_filter, nb_col) in enumerate(zip(num_shape_filters, shape_conv_width)):
             shape_preds = Convolution1D(
                 nb_filter, nb_col, 'he_normal')(shape_preds)
@@ -434,7 +575,6 @@ class ShapeAndDnaseClassifier(Classifier):
                 shape_preds = Dropout(shape_conv_dropout)(shape_preds)
 
         # convolve dnase
-        dnase_preds = inputs["data/dnase_data_dir"]
         for nb_filter, nb_col in zip(num_dnase_filters, dnase_conv_width):
             dnase_preds = Convolution1D(
                 nb_filter, nb_col, 'he_normal')(dnase_preds)
@@ -469,6 +609,33 @@ class ShapeAndDnaseClassifier(Classifier):
         logits = Activation('sigmoid')(logits)
         self.model = Model(input=keras_inputs.values(), output=logits)
 
+    @staticmethod
+    def get_shape_and_dnase_inputs(inputs):
+        """Returns the (interval_size, 5) shape and (interval_size, 1) dnase tensors."""
+        shape_inputs = Merge(mode='concat', concat_axis=-1)([
+            inputs[k] for k in ["data/HelT_data_dir", "data/MGW_data_dir",
+                                "data/OC2_data_dir", "data/ProT_data_dir",
+                                "data/Roll_data_dir"]])
+        return shape_inputs, inputs["data/dnase_data_dir"]
+
+
+class FusedShapeAndDnaseClassifier(ShapeAndDnaseClassifier):
+    """
+    ShapeAndDnaseClassifier on a single shape_dnase_data_dir input.
+
+    The shape and dnase tracks are extracted in one read and queued as one
+    tensor, then sliced into the same inputs ShapeAndDnaseClassifier stacks.
+    """
+
+    @staticmethod
+    def get_shape_and_dnase_inputs(inputs):
+        channels = FUSED_INPUT_CHANNELS['shape_dnase_data_dir']
+        dnase_channel = channels.index('dnase_data_dir')
+        assert dnase_channel == len(channels) - 1
+        fused_inputs = inputs["data/shape_dnase_data_dir"]
+        return (ChannelSlice(0, dnase_channel)(fused_inputs),
+                ChannelSlice(dnase_channel, dnase_channel + 1)(fused_inputs))
+
 
 class SequenceDnaseTssDhsCountAndTssExpressionClassifier(Classifier):
 
@@ -588,3 +755,127 @@ class AmrSequenceClassifier(Classifier):
         seq_preds = Dense(output_dim=num_tasks)(seq_preds)
         seq_preds = Activation('sigmoid')(seq_preds)
         self.model = Model(input=keras_inputs.values(), output=seq_preds)
+
+
+class DilatedSequenceClassifier(Classifier):
+    """
+    Residual blocks of exponentially dilated convolutions for long sequences.
+
+    A strided pool after the first convolution shrinks the sequence early,
+    then block i convolves with dilation dilation_base ** i, so the receptive
+    field grows exponentially with depth while the cost grows linearly.
+    Without pool_width, positions are averaged globally and the number of
+    parameters does not depend on the interval length.
+    """
+
+    def __init__(self, shapes, num_tasks,
+                 num_filters=64, stem_conv_width=15, stem_pool_width=4,
+                 num_blocks=6, conv_width=3, dilation_base=2,
+                 pool_width=None, fc_layer_widths=(100,),
+                 dropout=0, batch_norm=True):
+        # configure inputs
+        keras_inputs = self.get_keras_inputs(shapes)
+        inputs = self.reshape_keras_inputs(keras_inputs)
+
+        # convolve and pool sequence
+        seq_preds = inputs["data/genome_data_dir"]
+        seq_preds = Convolution1D(
+            num_filters, stem_conv_width, border_mode='same')(seq_preds)
+        if batch_norm:
+            seq_preds = BatchNormalization()(seq_preds)
+        seq_preds = Activation('relu')(seq_preds)
+        seq_preds = MaxPooling1D(stem_pool_width)(seq_preds)
+
+        # dilated residual blocks
+        for i in range(num_blocks):
+            block_preds = AtrousConvolution1D(
+                num_filters, conv_width, atrous_rate=dilation_base ** i,
+                border_mode='same')(seq_preds)
+            if batch_norm:
+                block_preds = BatchNormalization()(block_preds)
+            block_preds = Activation('relu')(block_preds)
+            if dropout > 0:
+                block_preds = Dropout(dropout)(block_preds)
+            seq_preds = Merge(mode='sum')([seq_preds, block_preds])
+
+        # pool and fully connect
+        if pool_width is None:
+            seq_preds = GlobalAveragePooling1D()(seq_preds)
+        else:
+            seq_preds = AveragePooling1D(pool_width)(seq_preds)
+            seq_preds = Flatten()(seq_preds)
+        for fc_layer_width in fc_layer_widths:
+            seq_preds = Dense(fc_layer_width)(seq_preds)
+            seq_preds = Activation('relu')(seq_preds)
+            if dropout > 0:
+                seq_preds = Dropout(dropout)(seq_preds)
+        seq_preds = Dense(output_dim=num_tasks)(seq_preds)
+        seq_preds = Activation('sigmoid')(seq_preds)
+        self.model = Model(input=keras_inputs.values(), output=seq_preds)
+
+
+class SharedTrunkClassifier(Classifier):
+    """
+    Sequence and DNase trunk shared by many tasks, with a small head per task.
+
+    Meant for multi-task intervals from mergeintervals: one extraction and one
+    trunk forward pass serve every task, and each task's head learns its own
+    readout of the shared features. Tasks not observed in a bin are masked out
+    of the loss by their AMBIG_LABEL labels. Without head_width each head is a
+    single logit.
+    """
+
+    def __init__(self, shapes, num_tasks,
+                 num_seq_filters=(25, 25, 25), seq_conv_width=(25, 25, 25),
+                 num_dnase_filters=(25, 25, 25), dnase_conv_width=(25, 25, 25),
+                 num_combined_filters=(55,), combined_conv_width=(25,),
+                 pool_width=25, trunk_width=200, head_width=16,
+                 dropout=0.0, batch_norm=False):
+        assert len(num_seq_filters) == len(seq_conv_width)
+        assert len(num_dnase_filters) == len(dnase_conv_width)
+        assert len(num_combined_filters) == len(combined_conv_width)
+
+        # configure inputs
+        keras_inputs = self.get_keras_inputs(shapes)
+        inputs = self.reshape_keras_inputs(keras_inputs)
+
+        def conv_block(x, num_filters, conv_width):
+            for nb_filter, nb_col in zip(num_filters, conv_width):
+                x = Convolution1D(nb_filter, nb_col, 'he_normal')(x)
+                if batch_norm:
+                    x = BatchNormalization()(x)
+                x = Activation('relu')(x)
+                if dropout > 0:
+                    x = Dropout(dropout)(x)
+            return x
+
+        # convolve sequence and dnase, stack and convolve
+        seq_preds = conv_block(inputs["data/genome_data_dir"], num_seq_filters, seq_conv_width)
+        dnase_preds = conv_block(inputs["data/dnase_data_dir"], num_dnase_filters, dnase_conv_width)
+        logits = Merge(mode='concat', concat_axis=-1)([seq_preds, dnase_preds])
+        logits = conv_block(logits, num_combined_filters, combined_conv_width)
+
+        # pool and fully connect the shared features
+        logits = AveragePooling1D((pool_width))(logits)
+        logits = Flatten()(logits)
+        logits = Dense(trunk_width)(logits)
+        if batch_norm:
+            logits = BatchNormalization()(logits)
+        trunk = Activation('relu')(logits)
+        if dropout > 0:
+            trunk = Dropout(dropout)(trunk)
+
+        # per task heads
+        task_logits = []
+        for _ in range(num_tasks):
+            head = trunk
+            if head_width:
+                head = Dense(head_width)(head)
+                head = Activation('relu')(head)
+            task_logits.append(Dense(1)(head))
+        if num_tasks > 1:
+            logits = Merge(mode='concat', concat_axis=-1)(task_logits)
+        else:
+            logits = task_logits[0]
+        logits = Activation('sigmoid')(logits)
+        self.model = Model(input=keras_inputs.values(), output=logits)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from tfdragonn import loggers
+from tfdragonn.model_specs import get_config_input_shapes, load_model_config, predict_rc_average
+
+LOGGER_NAME = 'tfdragonn-export-model'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Exported model bundle in a logdir
+NUMPY_BUNDLE_FNAME = 'model.npz'
+BUNDLE_FORMAT_VERSION = 1
+
+# Max number of im2col matrix elements, convolutions of larger batches run in chunks
+IM2COL_MAX_ELEMENTS = 2**24
+
+# Max absolute difference from keras predictions accepted by the export check
+DEFAULT_TOLERANCE = 1e-4
+
+CONV_LAYER_CLASSES = set(['Convolution1D', 'Conv1D', 'AtrousConvolution1D'])
+POOL_LAYER_CLASSES = {'MaxPooling1D': 'max', 'AveragePooling1D': 'average'}
+GLOBAL_POOL_LAYER_CLASSES = {'GlobalMaxPooling1D': 'max', 'GlobalAveragePooling1D': 'average'}
+IDENTITY_LAYER_CLASSES = set(['Dropout', 'SpatialDropout1D', 'GaussianNoise', 'GaussianDropout'])
+# keras 2 merge layers and their keras 1 Merge modes
+MERGE_LAYER_CLASSES = {'Concatenate': 'concat', 'Add': 'sum', 'Multiply': 'mul',
+                       'Average': 'ave', 'Maximum': 'max'}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn export-model',
+                                     description='Export a trained model for inference with numpy.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('logdir', type=os.path.abspath,
+                        help='Log directory of a trained model')
+    parser.add_argument('--output', type=os.path.abspath, default=None,
+                        help='Bundle file path.\nDefault: <logdir>/{}.'.format(NUMPY_BUNDLE_FNAME))
+    parser.add_argument('--interval-length', type=int, default=1000,
+                        help='Length of the input intervals.\nDefault: 1000.')
+    parser.add_argument('--visiblegpus', type=str, default='',
+                        help='Visible GPUs string.\nDefault: none.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Max absolute difference from keras predictions on a random batch.'
+                        '\nDefault: {}.'.format(DEFAULT_TOLERANCE))
+    args = parser.parse_args(args)
+    return args
+
+
+def run_export_model_from_args(command, args):
+    args = parse_args(args)
+    export_model_from_logdir(args.logdir, output=args.output,
+                             interval_length=args.interval_length,
+                             visiblegpus=args.visiblegpus, tolerance=args.tolerance)
+
+
+def export_model_from_logdir(logdir, output=None, interval_length=1000, visiblegpus='',
+                             tolerance=DEFAULT_TOLERANCE):
+    """
+    Exports the model of a logdir and checks it against keras on a random batch.
+
+    Raises a ValueError if the predictions differ by more than tolerance.
+    """
+    from tfdragonn import models
+    from tfdragonn.benchmarks.model_benchmark import synthetic_batch
+    from tfdragonn.model_runner import BaseModelRunner
+
+    BaseModelRunner.setup_keras_session(visiblegpus)
+    if output is None:
+        output = os.path.join(logdir, NUMPY_BUNDLE_FNAME)
+    modelspec = os.path.join(logdir, 'modelspec.json')
+    with open(os.path.join(logdir, 'intervalspec.json'), 'r') as fp:
+        num_tasks = len(json.load(fp)['task_names'])
+    shapes = get_config_input_shapes(load_model_config(modelspec), interval_length)
+    model = models.model_from_minimal_config(modelspec, shapes, num_tasks)
+    model.load_weights(os.path.join(logdir, 'model.weights.h5'))
+    export_model(model, output, shapes)
+    _logger.info('Exported model to {}'.format(output))
+
+    batch = synthetic_batch(shapes, 64, np.random.RandomState(0))
+    max_diff = np.abs(model.predict_on_batch(batch) -
+                      NumpyClassifier(output).predict_on_batch(batch)).max()
+    _logger.info('Max absolute difference from keras predictions: {:.3g}'.format(max_diff))
+    if max_diff > tolerance:
+        raise ValueError('Numpy predictions differ from keras by {:.3g} > {:.3g}'.format(
+            max_diff, tolerance))
+    return output
+
+
+def _get_config_value(config, keras1_name, keras2_name, default=None):
+    value = config.get(keras1_name, config.get(keras2_name, default))
+    if isinstance(value, (list, tuple)) and len(value) == 1:  # keras 2 1D tuples
+        return value[0]
+    return value
+
+
+def _inbound_layer_names(layer):
+    nodes = getattr(layer, 'inbound_nodes', None)
+    if nodes is None:
+        nodes = layer._inbound_nodes
+    if len(nodes) != 1:
+        raise ValueError('Layer {} is applied {} times, shared layers are not supported'.format(
+            layer.name, len(nodes)))
+    return [inbound_layer.name for inbound_layer in nodes[0].inbound_layers]
+
+
+def _export_layer(layer):
+    """Returns the spec and weights of a keras layer in the numpy engine's terms."""
+    class_name = layer.__class__.__name__
+    config = layer.get_config()
+    weights = [np.asarray(weight, dtype=np.float32) for weight in layer.get_weights()]
+    if class_name == 'InputLayer':
+        return {'type': 'input'}, []
+    elif class_name in CONV_LAYER_CLASSES:
+        # keras 1 kernels are (k, 1, in, out), keras 2 kernels are (k, in, out)
+        W = weights[0].reshape((weights[0].shape[0],) + weights[0].shape[-2:])
+        b = weights[1] if len(weights) > 1 else np.zeros(W.shape[-1], dtype=np.float32)
+        return {'type': 'conv',
+                'stride': _get_config_value(config, 'subsample_length', 'strides', 1),
+                'dilation': _get_config_value(config, 'atrous_rate', 'dilation_rate', 1),
+                'padding': _get_config_value(config, 'border_mode', 'padding', 'valid'),
+                'activation': config.get('activation', 'linear')}, [W, b]
+    elif class_name == 'RevCompConv1D':
+        W, b = weights
+        return {'type': 'conv', 'stride': 1, 'dilation': 1, 'padding': 'valid',
+                'activation': 'linear'}, [np.concatenate([W, W[::-1, ::-1, ::-1]], axis=-1),
+                                          np.concatenate([b, b[::-1]])]
+    elif class_name == 'Dense':
+        b = weights[1] if len(weights) > 1 else np.zeros(weights[0].shape[-1], dtype=np.float32)
+        return {'type': 'dense', 'activation': config.get('activation', 'linear')}, [weights[0], b]
+    elif class_name == 'BatchNormalization':
+        if config.get('mode', 0) != 0 or config.get('axis', -1) not in (-1, len(layer.input_shape) - 1):
+            raise ValueError('Only feature-wise batch norm over the last axis is supported')
+        # gamma and beta are missing if keras 2 scale or center is off, the last
+        # two weights are the moving mean and variance in keras 1 and 2
+        mean, variance = weights[-2:]
+        gamma = weights[0] if config.get('scale', True) else np.ones_like(mean)
+        beta = weights[int(config.get('scale', True))] if config.get('center', True) \
+            else np.zeros_like(mean)
+        scale = gamma / np.sqrt(variance + config['epsilon'])
+        return {'type': 'scale_shift'}, [scale, beta - mean * scale]
+    elif class_name == 'Activation':
+        return {'type': 'activation', 'activation': config['activation']}, []
+    elif class_name == 'PReLU':
+        return {'type': 'prelu'}, weights
+    elif class_name in IDENTITY_LAYER_CLASSES:
+        return {'type': 'identity'}, []
+    elif class_name == 'Permute':
+        return {'type': 'permute', 'dims': list(config['dims'])}, []
+    elif class_name == 'Reshape':
+        return {'type': 'reshape', 'target_shape': list(config['target_shape'])}, []
+    elif class_name == 'Flatten':
+        return {'type': 'flatten'}, []
+    elif class_name in POOL_LAYER_CLASSES:
+        pool_length = _get_config_value(config, 'pool_length', 'pool_size')
+        padding = _get_config_value(config, 'border_mode', 'padding', 'valid')
+        if padding != 'valid':
+            raise ValueError('Only valid pooling is supported, {} uses {}'.format(
+                layer.name, padding))
+        return {'type': 'pool', 'mode': POOL_LAYER_CLASSES[class_name],
+                'pool_length': pool_length,
+                'stride': _get_config_value(config, 'stride', 'strides') or pool_length}, []
+    elif class_name in GLOBAL_POOL_LAYER_CLASSES:
+        return {'type': 'global_pool', 'mode': GLOBAL_POOL_LAYER_CLASSES[class_name]}, []
+    elif class_name == 'Merge':
+        return {'type': 'merge', 'mode': config['mode'],
+                'axis': config.get('concat_axis', -1)}, []
+    elif class_name in MERGE_LAYER_CLASSES:
+        return {'type': 'merge', 'mode': MERGE_LAYER_CLASSES[class_name],
+                'axis': config.get('axis', -1)}, []
+    elif class_name == 'RevCompConcatenate':
+        return {'type': 'rc_concat'}, []
+    elif class_name == 'RevCompFold':
+        return {'type': 'rc_fold'}, []
+    elif class_name == 'ChannelSlice':
+        return {'type': 'channel_slice', 'start': config['start'], 'stop': config['stop']}, []
+    raise ValueError('Layer {} of class {} is not supported by the numpy engine'.format(
+        layer.name, class_name))
+
+
+def _fold_batch_norms(layers, weights):
+    """
+    Folds batch norms into the convolution or dense layer before them.
+
+    Only linear layers whose output is used by the batch norm alone are folded,
+    the batch norm then becomes an identity.
+    """
+    num_consumers = {}
+    for layer in layers:
+        for name in layer['inbound']:
+            num_consumers[name] = num_consumers.get(name, 0) + 1
+    layers_by_name = {layer['name']: layer for layer in layers}
+    for layer in layers:
+        if layer['type'] != 'scale_shift' or len(layer['inbound']) != 1:
+            continue
+        inbound = layers_by_name[layer['inbound'][0]]
+        if (inbound['type'] not in ('conv', 'dense') or inbound['activation'] != 'linear' or
+                num_consumers[inbound['name']] != 1):
+            continue
+        scale, shift = weights[layer['name']]
+        W, b = weights[inbound['name']]
+        weights[inbound['name']] = [W * scale, b * scale + shift]
+        weights[layer['name']] = []
+        layer['type'] = 'identity'
+
+
+def export_model(model, bundle_path, input_shapes):
+    """
+    Writes a Classifier as a numpy engine bundle.
+
+    The bundle is an npz file with the layer graph as json and the weights of
+    each layer, batch norms folded into the layers before them where possible.
+    """
+    keras_model = model.model
+    layers = []
+    weights = {}
+    for layer in keras_model.layers:
+        spec, layer_weights = _export_layer(layer)
+        spec['name'] = layer.name
+        spec['inbound'] = [] if spec['type'] == 'input' else _inbound_layer_names(layer)
+        layers.append(spec)
+        weights[layer.name] = layer_weights
+    _fold_batch_norms(layers, weights)
+    if len(keras_model.output_layers) != 1:
+        raise ValueError('Only single output models are supported')
+    graph = {'format_version': BUNDLE_FORMAT_VERSION,
+             'model_class': model.__class__.__name__,
+             'input_names': list(model.get_inputs),
+             'input_shapes': {name: list(input_shapes[name]) for name in model.get_inputs},
+             'output': keras_model.output_layers[0].name,
+             'layers': layers}
+    arrays = {}
+    for layer_indx, layer in enumerate(layers):
+        layer['num_weights'] = len(weights[layer['name']])
+        for weight_indx, weight in enumerate(weights[layer['name']]):
+            arrays['{}.{}'.format(layer_indx, weight_indx)] = weight
+    arrays['graph'] = np.array(json.dumps(graph))
+    with open(bundle_path, 'wb') as fp:
+        np.savez(fp, **arrays)
+
+
+def _activation(x, activation):
+    if activation == 'linear':
+        return x
+    elif activation == 'relu':
+        return np.maximum(x, 0)
+    elif activation == 'sigmoid':
+        return np.exp(-np.logaddexp(0, -x))
+    elif activation == 'tanh':
+        return np.tanh(x)
+    raise ValueError('Unsupported activation {}'.format(activation))
+
+
+def _windows(x, window, stride, dilation=1):
+    """(N, L, C) -> (N, num_windows, window, C) view of strided windows."""
+    num_windows = (x.shape[1] - (window - 1) * dilation - 1) // stride + 1
+    if num_windows < 1:
+        raise ValueError('Window of {} does not fit in length {}'.format(window, x.shape[1]))
+    x = np.ascontiguousarray(x)
+    return np.lib.stride_tricks.as_strided(
+        x, shape=(x.shape[0], num_windows, window, x.shape[2]),
+        strides=(x.strides[0], stride * x.strides[1], dilation * x.strides[1], x.strides[2]))
+
+
+def conv1d(x, W, b, stride=1, dilation=1, padding='valid'):
+    """
+    Convolves (N, L, C) inputs with (k, C, F) kernels via im2col and a GEMM.
+
+    Examples are convolved in chunks, so the im2col matrix has at most
+    IM2COL_MAX_ELEMENTS elements.
+    """
+    k = W.shape[0]
+    if padding == 'same':  # padded as tensorflow does, the extra base on the right
+        out_length = (x.shape[1] + stride - 1) // stride
+        total_pad = max((out_length - 1) * stride + (k - 1) * dilation + 1 - x.shape[1], 0)
+        x = np.pad(x, ((0, 0), (total_pad // 2, total_pad - total_pad // 2), (0, 0)),
+                   mode='constant')
+    elif padding != 'valid':
+        raise ValueError('Unsupported padding {}'.format(padding))
+    kernel = W.reshape(-1, W.shape[-1])
+    windows = _windows(x, k, stride, dilation)
+    num_examples, out_length = windows.shape[:2]
+    chunk_size = max(1, IM2COL_MAX_ELEMENTS // (out_length * kernel.shape[0]))
+    out = np.empty((num_examples, out_length, W.shape[-1]), dtype=np.float32)
+    for start in range(0, num_examples, chunk_size):
+        cols = windows[start:start + chunk_size].reshape(-1, kernel.shape[0])
+        out[start:start + chunk_size] = np.dot(cols, kernel).reshape(-1, out_length, W.shape[-1])
+    out += b
+    return out
+
+
+def _merge(xs, mode, axis):
+    if mode == 'concat':
+        return np.concatenate(xs, axis=axis)
+    elif mode == 'sum':
+        return np.sum(xs, axis=0)
+    elif mode == 'mul':
+        return np.prod(xs, axis=0)
+    elif mode == 'ave':
+        return np.mean(xs, axis=0)
+    elif mode == 'max':
+        return np.max(xs, axis=0)
+    raise ValueError('Unsupported merge mode {}'.format(mode))
+
+
+def _rc_concat(xs):
+    halves = [x.shape[-1] // 2 for x in xs]
+    forward = [x[:, :, :half] for x, half in zip(xs, halves)]
+    rev_comp = [x[:, :, half:] for x, half in zip(xs, halves)][::-1]
+    return np.concatenate(forward + rev_comp, axis=-1)
+
+
+def _apply_layer(layer, inputs, weights):
+    layer_type = layer['type']
+    x = inputs[0]
+    if layer_type == 'identity':
+        return x
+    elif layer_type == 'conv':
+        return _activation(conv1d(x, weights[0], weights[1], layer['stride'],
+                                  layer['dilation'], layer['padding']), layer['activation'])
+    elif layer_type == 'dense':
+        return _activation(np.dot(x, weights[0]) + weights[1], layer['activation'])
+    elif layer_type == 'scale_shift':
+        return x * weights[0] + weights[1]
+    elif layer_type == 'activation':
+        return _activation(x, layer['activation'])
+    elif layer_type == 'prelu':
+        return np.maximum(x, 0) + weights[0] * np.minimum(x, 0)
+    elif layer_type == 'permute':
+        return np.transpose(x, [0] + list(layer['dims']))
+    elif layer_type == 'reshape':
+        return x.reshape([len(x)] + list(layer['target_shape']))
+    elif layer_type == 'flatten':
+        return x.reshape(len(x), -1)
+    elif layer_type == 'pool':
+        windows = _windows(x, layer['pool_length'], layer['stride'])
+        return windows.max(axis=2) if layer['mode'] == 'max' else windows.mean(axis=2)
+    elif layer_type == 'global_pool':
+        return x.max(axis=1) if layer['mode'] == 'max' else x.mean(axis=1)
+    elif layer_type == 'merge':
+        return _merge(inputs, layer['mode'], layer['axis'])
+    elif layer_type == 'rc_concat':
+        return _rc_concat(inputs)
+    elif layer_type == 'rc_fold':
+        half = x.shape[-1] // 2
+        return x[:, :, :half] + x[:, ::-1, ::-1][:, :, :half]
+    elif layer_type == 'channel_slice':
+        return x[:, :, layer['start']:layer['stop']]
+    raise ValueError('Unsupported layer type {}'.format(layer_type))
+
+
+class NumpyClassifier(object):
+    """
+    Runs an exported Classifier bundle with numpy only.
+
+    Has the predict_on_batch interface of Classifier, so it can replace a
+    keras model wherever batches are predicted directly, without importing
+    tensorflow or keras.
+    """
+
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        with np.load(bundle_path) as bundle:
+            self.graph = json.loads(str(bundle['graph']))
+            if self.graph['format_version'] != BUNDLE_FORMAT_VERSION:
+                raise ValueError('Unsupported bundle format version {} in {}'.format(
+                    self.graph['format_version'], bundle_path))
+            self.layers = self.graph['layers']
+            self.weights = [[bundle['{}.{}'.format(layer_indx, weight_indx)]
+                             for weight_indx in range(layer['num_weights'])]
+                            for layer_indx, layer in enumerate(self.layers)]
+
+    @property
+    def get_inputs(self):
+        return self.graph['input_names']
+
+    @property
+    def input_shapes(self):
+        return {name: tuple(shape) for name, shape in self.graph['input_shapes'].items()}
+
+    def predict_on_batch(self, batch, rc_average=False):
+        """Returns (batch_size, num_tasks) predictions, see Classifier.predict_on_batch."""
+        if not rc_average:
+            return self._forward(batch)
+        return predict_rc_average(self._forward, batch, self.get_inputs)
+
+    def _forward(self, batch):
+        outputs = {}
+        for layer, weights in zip(self.layers, self.weights):
+            if layer['type'] == 'input':
+                outputs[layer['name']] = np.asarray(batch[layer['name']], dtype=np.float32)
+            else:
+                outputs[layer['name']] = _apply_layer(
+                    layer, [outputs[name] for name in layer['inbound']], weights)
+        return outputs[self.graph['output']]
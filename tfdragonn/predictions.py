@@ -0,0 +1,382 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import gzip
+import json
+import os
+import zlib
+
+import numpy as np
+
+INTERVAL_DTYPE = np.dtype([('chrom', np.int32), ('start', np.int64), ('end', np.int64)])
+PREDICTION_DTYPE = np.dtype(np.float32)
+
+# Number of intervals formatted at a time when writing text outputs
+TEXT_CHUNK_SIZE = 100000
+
+# Number of intervals read at a time when grouping them by chromosome
+SORT_CHUNK_SIZE = 1000000
+
+# Prediction store settings
+STORE_CHUNK_SIZE = 100000
+STORE_PREDICTION_DTYPE = np.dtype(np.float16)
+STORE_COMPRESSION_LEVEL = 6
+
+
+def _to_str(chrom):
+    return chrom if isinstance(chrom, str) else chrom.decode()
+
+
+class StreamingPredictionWriter(object):
+    """
+    Writes predictions to disk as batches arrive.
+
+    Intervals are appended to `<prefix>.intervals.bin` with integer chromosome
+    codes and predictions for all tasks to `<prefix>.predictions.bin`, so
+    memory does not grow with the number of intervals. The chromosome names,
+    task names and number of examples are written to `<prefix>.metadata.json`
+    on close.
+
+    Args:
+        prefix (str): prefix of the output files.
+        task_names (list): names of the prediction columns.
+    """
+
+    def __init__(self, prefix, task_names):
+        self.prefix = prefix
+        self.task_names = list(task_names)
+        self.num_examples = 0
+        self._chrom2code = OrderedDict()
+        self._intervals_fp = open(prefix + '.intervals.bin', 'wb')
+        self._predictions_fp = open(prefix + '.predictions.bin', 'wb')
+
+    def encode_chroms(self, chroms):
+        """Returns integer codes of chromosome names, new names get the next code."""
+        unique_chroms, inverse = np.unique(chroms, return_inverse=True)
+        codes = np.array([self._chrom2code.setdefault(_to_str(chrom), len(self._chrom2code))
+                          for chrom in unique_chroms], dtype=np.int32)
+        return codes[inverse]
+
+    def write(self, chroms, starts, ends, predictions):
+        assert predictions.shape == (len(chroms), len(self.task_names))
+        records = np.empty(len(chroms), dtype=INTERVAL_DTYPE)
+        records['chrom'] = self.encode_chroms(chroms)
+        records['start'] = starts
+        records['end'] = ends
+        records.tofile(self._intervals_fp)
+        predictions.astype(PREDICTION_DTYPE).tofile(self._predictions_fp)
+        self.num_examples += len(records)
+
+    def close(self):
+        self._intervals_fp.close()
+        self._predictions_fp.close()
+        metadata = {'chroms': list(self._chrom2code.keys()),
+                    'task_names': self.task_names,
+                    'num_examples': self.num_examples}
+        with open(self.prefix + '.metadata.json', 'w') as fp:
+            json.dump(metadata, fp, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StreamedPredictions(object):
+    """
+    Memory mapped view of the files written by a StreamingPredictionWriter.
+
+    Attributes:
+        chroms (list): chromosome names indexed by chromosome code.
+        task_names (list)
+        intervals: (num_examples,) memmap with chrom, start and end fields.
+        predictions: (num_examples, num_tasks) memmap.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + '.metadata.json', 'r') as fp:
+            metadata = json.load(fp)
+        self.chroms = metadata['chroms']
+        self.task_names = metadata['task_names']
+        self.num_examples = metadata['num_examples']
+        if self.num_examples == 0:  # np.memmap can't map empty files
+            self.intervals = np.empty(0, dtype=INTERVAL_DTYPE)
+            self.predictions = np.empty((0, len(self.task_names)), dtype=PREDICTION_DTYPE)
+        else:
+            self.intervals = np.memmap(prefix + '.intervals.bin', dtype=INTERVAL_DTYPE,
+                                       mode='r', shape=(self.num_examples,))
+            self.predictions = np.memmap(prefix + '.predictions.bin', dtype=PREDICTION_DTYPE,
+                                         mode='r', shape=(self.num_examples, len(self.task_names)))
+
+    def iter_sorted_chrom_blocks(self, chunk_size=SORT_CHUNK_SIZE):
+        """
+        Yields the indices of the intervals of each chromosome, sorted by start.
+
+        Chromosomes are yielded in name order. The indices are first grouped
+        by chromosome into `<prefix>.order.bin`, chunk_size intervals at a
+        time, so only one chromosome's indices are in memory at a time.
+        """
+        num_chroms = len(self.chroms)
+        chrom_counts = np.zeros(num_chroms, dtype=np.int64)
+        for chunk_start in range(0, self.num_examples, chunk_size):
+            chrom_counts += np.bincount(
+                self.intervals['chrom'][chunk_start:chunk_start + chunk_size], minlength=num_chroms)
+        chrom_offsets = np.concatenate([[0], np.cumsum(chrom_counts)])
+        if self.num_examples == 0:
+            return
+        order_fname = self.prefix + '.order.bin'
+        chrom_order = np.memmap(order_fname, dtype=np.int64, mode='w+', shape=(self.num_examples,))
+        try:
+            fill_offsets = chrom_offsets[:-1].copy()
+            for chunk_start in range(0, self.num_examples, chunk_size):
+                chunk_chroms = np.asarray(self.intervals['chrom'][chunk_start:chunk_start + chunk_size])
+                chunk_order = np.argsort(chunk_chroms, kind='mergesort')
+                chunk_counts = np.bincount(chunk_chroms, minlength=num_chroms)
+                chunk_offsets = np.concatenate([[0], np.cumsum(chunk_counts)])
+                for code in np.flatnonzero(chunk_counts):
+                    chrom_order[fill_offsets[code]:fill_offsets[code] + chunk_counts[code]] = (
+                        chunk_start + chunk_order[chunk_offsets[code]:chunk_offsets[code + 1]])
+                fill_offsets += chunk_counts
+            for code in np.argsort(self.chroms):
+                block = np.array(chrom_order[chrom_offsets[code]:chrom_offsets[code + 1]])
+                if len(block):
+                    # indices are ascending within a chromosome, a stable sort keeps ties in order
+                    yield block[np.argsort(self.intervals['start'][block], kind='mergesort')]
+        finally:
+            del chrom_order
+            os.remove(order_fname)
+
+    def remove(self):
+        del self.intervals, self.predictions
+        for suffix in ['.intervals.bin', '.predictions.bin', '.metadata.json']:
+            os.remove(self.prefix + suffix)
+
+
+def _write_text_chunk(fps, chroms, intervals, predictions, flank_size=0):
+    """Writes a chunk of intervals and per task predictions to open task files."""
+    interval_strs = ['{}\t{}\t{}\t'.format(chrom, start, end) for chrom, start, end in
+                     zip(chroms[intervals['chrom']],
+                         intervals['start'] + flank_size,
+                         intervals['end'] - flank_size)]
+    for task_indx, fp in enumerate(fps):
+        fp.write(''.join(['{}{:.6g}\n'.format(interval_str, prediction)
+                          for interval_str, prediction in
+                          zip(interval_strs, predictions[:, task_indx])]).encode())
+
+
+def write_task_files(streamed_predictions, fname_template, flank_size=0,
+                     chunk_size=TEXT_CHUNK_SIZE):
+    """
+    Writes sorted, gzipped per task prediction files in a single pass.
+
+    Args:
+        streamed_predictions (StreamedPredictions)
+        fname_template (str): output file name with a `{}` for the task name.
+        flank_size (int): trimmed from both ends of each interval.
+        chunk_size (int): number of intervals formatted at a time.
+
+    Returns:
+        list of written file names, ordered like the tasks.
+    """
+    chroms = np.array(streamed_predictions.chroms, dtype=object)
+    fnames = [fname_template.format(task_name)
+              for task_name in streamed_predictions.task_names]
+    fps = [gzip.open(fname, 'wb') for fname in fnames]
+    try:
+        for chrom_order in streamed_predictions.iter_sorted_chrom_blocks():
+            for chunk_start in range(0, len(chrom_order), chunk_size):
+                chunk_indxs = chrom_order[chunk_start:chunk_start + chunk_size]
+                _write_text_chunk(fps, chroms,
+                                  streamed_predictions.intervals[chunk_indxs],
+                                  streamed_predictions.predictions[chunk_indxs],
+                                  flank_size=flank_size)
+    finally:
+        for fp in fps:
+            fp.close()
+    return fnames
+
+
+def _compress_store_chunk(streamed_predictions, chunk_indxs, flank_size, compression_level):
+    """Returns the compressed interval index and per task columns of a chunk."""
+    intervals = streamed_predictions.intervals[chunk_indxs]
+    intervals['start'] += flank_size
+    intervals['end'] -= flank_size
+    predictions = streamed_predictions.predictions[chunk_indxs].astype(STORE_PREDICTION_DTYPE)
+    index_blob = zlib.compress(intervals.tobytes(), compression_level)
+    task_blobs = [zlib.compress(np.ascontiguousarray(predictions[:, task_indx]).tobytes(),
+                                compression_level)
+                  for task_indx in range(predictions.shape[1])]
+    chunk_metadata = {'chrom': int(intervals['chrom'][0]),
+                      'num_rows': len(intervals),
+                      'min_start': int(intervals['start'].min()),
+                      'max_end': int(intervals['end'].max())}
+    return chunk_metadata, index_blob, task_blobs
+
+
+def write_prediction_store(streamed_predictions, path, flank_size=0, chunk_size=STORE_CHUNK_SIZE,
+                           n_jobs=1, compression_level=STORE_COMPRESSION_LEVEL):
+    """
+    Writes streamed predictions to a chunked, compressed columnar store.
+
+    The store is a directory with a shared interval index (`index.bin`) and
+    a float16 task matrix (`tasks.bin`), both split into row chunks that never
+    span chromosomes. Each chunk of the index and each task column of a chunk
+    is compressed separately, so a reader can load a single task or a genomic
+    slice without decompressing the rest. Chunks are compressed by n_jobs
+    worker threads, one chromosome at a time, so memory does not grow with
+    the number of intervals. flank_size is trimmed from both ends of each
+    interval.
+
+    Returns:
+        the PredictionStore.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    num_tasks = len(streamed_predictions.task_names)
+    index_offsets = []
+    task_offsets = []
+    chunks = []
+    pool = ThreadPool(n_jobs)
+    try:
+        with open(os.path.join(path, 'index.bin'), 'wb') as index_fp, \
+                open(os.path.join(path, 'tasks.bin'), 'wb') as tasks_fp:
+            # chunks of at most chunk_size rows never span chromosomes
+            for chrom_order in streamed_predictions.iter_sorted_chrom_blocks():
+                compressed_chunks = pool.imap(
+                    lambda chunk_start: _compress_store_chunk(
+                        streamed_predictions, chrom_order[chunk_start:chunk_start + chunk_size],
+                        flank_size, compression_level),
+                    range(0, len(chrom_order), chunk_size))
+                for chunk_metadata, index_blob, task_blobs in compressed_chunks:
+                    chunks.append(chunk_metadata)
+                    index_offsets.append((index_fp.tell(), len(index_blob)))
+                    index_fp.write(index_blob)
+                    task_offsets.append([])
+                    for task_blob in task_blobs:
+                        task_offsets[-1].append((tasks_fp.tell(), len(task_blob)))
+                        tasks_fp.write(task_blob)
+    finally:
+        pool.close()
+        pool.join()
+    np.save(os.path.join(path, 'index_offsets.npy'),
+            np.array(index_offsets, dtype=np.int64).reshape((len(chunks), 2)))
+    np.save(os.path.join(path, 'task_offsets.npy'),
+            np.array(task_offsets, dtype=np.int64).reshape((len(chunks), num_tasks, 2)))
+    metadata = {'chroms': streamed_predictions.chroms,
+                'task_names': streamed_predictions.task_names,
+                'num_examples': streamed_predictions.num_examples,
+                'chunks': chunks}
+    with open(os.path.join(path, 'metadata.json'), 'w') as fp:
+        json.dump(metadata, fp, indent=4)
+    return PredictionStore(path)
+
+
+class PredictionStore(object):
+    """
+    Reader for a store written by write_prediction_store.
+
+    Example:
+        store = PredictionStore('predictions.GM12878.store')
+        intervals, values = store.read_task('CTCF', chrom='chr9', start=0, end=10**6)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as fp:
+            metadata = json.load(fp)
+        self.chroms = metadata['chroms']
+        self.task_names = metadata['task_names']
+        self.num_examples = metadata['num_examples']
+        self.chunks = metadata['chunks']
+        self.index_offsets = np.load(os.path.join(path, 'index_offsets.npy'))
+        self.task_offsets = np.load(os.path.join(path, 'task_offsets.npy'))
+
+    def _read_blob(self, fname, offset, size, dtype):
+        with open(os.path.join(self.path, fname), 'rb') as fp:
+            fp.seek(offset)
+            return np.frombuffer(zlib.decompress(fp.read(size)), dtype=dtype)
+
+    def select_chunks(self, chrom=None, start=None, end=None):
+        """Returns the indices of chunks that may overlap the genomic slice."""
+        if chrom is None:
+            return list(range(len(self.chunks)))
+        if chrom not in self.chroms:
+            return []
+        chrom_code = self.chroms.index(chrom)
+        return [chunk_indx for chunk_indx, chunk in enumerate(self.chunks)
+                if chunk['chrom'] == chrom_code and
+                (end is None or chunk['min_start'] < end) and
+                (start is None or chunk['max_end'] > start)]
+
+    def read_chunk_intervals(self, chunk_indx):
+        offset, size = self.index_offsets[chunk_indx]
+        return self._read_blob('index.bin', offset, size, INTERVAL_DTYPE)
+
+    def read_chunk_task(self, chunk_indx, task_indx):
+        offset, size = self.task_offsets[chunk_indx, task_indx]
+        return self._read_blob('tasks.bin', offset, size, STORE_PREDICTION_DTYPE)
+
+    def read_intervals(self, chrom=None, start=None, end=None):
+        """Returns the intervals overlapping the genomic slice, chroms are integer codes."""
+        return self.read_task(None, chrom=chrom, start=start, end=end)[0]
+
+    def read_task(self, task_name, chrom=None, start=None, end=None):
+        """
+        Returns intervals and predictions of a task in a genomic slice.
+
+        Only the index chunks overlapping the slice and the task's column
+        in those chunks are decompressed. If task_name is None, only
+        intervals are read and None is returned for the predictions.
+        """
+        task_indx = None if task_name is None else self.task_names.index(task_name)
+        intervals = []
+        values = []
+        for chunk_indx in self.select_chunks(chrom=chrom, start=start, end=end):
+            chunk_intervals = self.read_chunk_intervals(chunk_indx)
+            mask = np.ones(len(chunk_intervals), dtype=bool)
+            if start is not None:
+                mask &= chunk_intervals['end'] > start
+            if end is not None:
+                mask &= chunk_intervals['start'] < end
+            intervals.append(chunk_intervals[mask])
+            if task_indx is not None:
+                values.append(self.read_chunk_task(chunk_indx, task_indx)[mask])
+        intervals = (np.concatenate(intervals) if len(intervals) > 0
+                     else np.empty(0, dtype=INTERVAL_DTYPE))
+        if task_indx is None:
+            return intervals, None
+        values = (np.concatenate(values) if len(values) > 0
+                  else np.empty(0, dtype=STORE_PREDICTION_DTYPE))
+        return intervals, values
+
+
+def export_tab_gz(store, fname_template, flank_size=0):
+    """
+    Exports a PredictionStore to gzipped per task files,
+    the layout written by `tfdragonn predict`.
+
+    Returns:
+        list of written file names, ordered like the tasks.
+    """
+    chroms = np.array(store.chroms, dtype=object)
+    # chunks are sorted within chromosomes, write chromosomes in name order
+    chunk_order = sorted(range(len(store.chunks)),
+                         key=lambda chunk_indx: (store.chroms[store.chunks[chunk_indx]['chrom']],
+                                                 chunk_indx))
+    fnames = [fname_template.format(task_name) for task_name in store.task_names]
+    fps = [gzip.open(fname, 'wb') for fname in fnames]
+    try:
+        for chunk_indx in chunk_order:
+            predictions = np.column_stack([store.read_chunk_task(chunk_indx, task_indx)
+                                           for task_indx in range(len(store.task_names))])
+            _write_text_chunk(fps, chroms, store.read_chunk_intervals(chunk_indx),
+                              predictions, flank_size=flank_size)
+    finally:
+        for fp in fps:
+            fp.close()
+    return fnames
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+
+from tfdragonn import loggers
+from tfdragonn.datasets import FUSED_INPUT_CHANNELS
+from tfdragonn.extractors import stack_array_dirs
+
+LOGGER_NAME = 'tfdragonn-fuse-inputs'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn fuseinputs',
+                                     description='Stack single track data dirs of each dataset'
+                                     ' into multi-channel data dirs.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('datasetspec', type=os.path.abspath,
+                        help='Dataset parameters json file path')
+    parser.add_argument('output_datasetspec', type=os.path.abspath,
+                        help='Json file path for the datasetspec with the fused data dirs')
+    parser.add_argument('output_dir', type=os.path.abspath,
+                        help='Directory for the fused data dirs')
+    parser.add_argument('--data-types', type=json.loads,
+                        default=sorted(FUSED_INPUT_CHANNELS.keys()),
+                        help='Fused data types as a json string.\nDefault: {}.'.format(
+                            json.dumps(sorted(FUSED_INPUT_CHANNELS.keys()))))
+    parser.add_argument('--array-type', type=str, default=None,
+                        choices=['array_bcolz', 'array_numpy'],
+                        help='Array type of the fused data dirs, array_numpy is memory mapped.'
+                        '\nDefault: the type of the stacked data dirs.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_fuse_inputs_from_args(command, args):
+    args = parse_args(args)
+    fuse_inputs(args.datasetspec, args.output_datasetspec, args.output_dir,
+                data_types=args.data_types, array_type=args.array_type)
+
+
+def fuse_inputs(datasetspec, output_datasetspec, output_dir,
+                data_types=None, array_type=None):
+    """
+    Writes the fused data dirs of each dataset and a datasetspec with them added.
+
+    Datasets missing any of the stacked data types are left as they are. Fused
+    data dirs that already exist are reused.
+    """
+    if data_types is None:
+        data_types = sorted(FUSED_INPUT_CHANNELS.keys())
+    with open(datasetspec, 'r') as fp:
+        datasets = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    for dataset_id, dataset_dict in datasets.items():
+        for data_type in data_types:
+            channels = FUSED_INPUT_CHANNELS[data_type]
+            missing = [channel for channel in channels if channel not in dataset_dict]
+            if missing:
+                _logger.info('Skipping {} for dataset {}, missing {}'.format(
+                    data_type, dataset_id, ', '.join(missing)))
+                continue
+            data_dir = os.path.join(output_dir, '{}.{}'.format(dataset_id, data_type))
+            if os.path.isfile(os.path.join(data_dir, 'metadata.json')):
+                _logger.info('{} already exists, skipping!'.format(data_dir))
+            else:
+                _logger.info('Writing {} for dataset {}...'.format(data_type, dataset_id))
+                stack_array_dirs([dataset_dict[channel] for channel in channels], data_dir,
+                                 array_type=array_type)
+            dataset_dict[data_type] = data_dir
+    with open(output_datasetspec, 'w') as fp:
+        json.dump(datasets, fp, indent=4)
+    _logger.info('Saved datasetspec to {}'.format(output_datasetspec))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import gzip
+import json
+import os
+
+import numpy as np
+
+from tfdragonn import loggers
+from tfdragonn.metrics import AMBIG_LABEL
+
+LOGGER_NAME = 'tfdragonn-merge-intervals'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn mergeintervals',
+                                     description='Merge intervalspecs into one multi-task'
+                                     ' intervalspec with a label per task of each.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('intervalspecs', type=os.path.abspath, nargs='+',
+                        help='Intervalspec json file paths, from labelregions with the same'
+                        '\nbin size, flank size and stride')
+    parser.add_argument('prefix', type=str, help='prefix of output files')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the shuffling of merged intervals.\nDefault: 0.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_merge_intervals_from_args(command, args):
+    args = parse_args(args)
+    merge_intervals(args.intervalspecs, args.prefix, seed=args.seed)
+
+
+def read_intervals_file(intervals_file):
+    """Yields (chrom, start, end) and the labels of each interval in a gzipped intervals file."""
+    with gzip.open(intervals_file, 'rb') as fp:
+        for line in fp:
+            fields = line.decode('ascii').rstrip('\n').split('\t')
+            yield ((fields[0], int(fields[1]), int(fields[2])),
+                   [int(float(label)) for label in fields[3:]])
+
+
+def merge_intervals_files(intervals_files, task_indxs, num_tasks):
+    """
+    Returns the union of the intervals of several files and a labels array.
+
+    intervals_files[i] has labels for the tasks task_indxs[i] of the merged
+    tasks. Labels of tasks without an interval in their file are AMBIG_LABEL.
+    """
+    interval_indxs = collections.OrderedDict()
+    labels = []
+    for intervals_file, file_task_indxs in zip(intervals_files, task_indxs):
+        for interval, interval_labels in read_intervals_file(intervals_file):
+            if len(interval_labels) != len(file_task_indxs):
+                raise ValueError('{} has {} labels for {} tasks'.format(
+                    intervals_file, len(interval_labels), len(file_task_indxs)))
+            if interval not in interval_indxs:
+                interval_indxs[interval] = len(labels)
+                labels.append(np.full(num_tasks, AMBIG_LABEL, dtype=np.int8))
+            labels[interval_indxs[interval]][file_task_indxs] = interval_labels
+    return list(interval_indxs.keys()), np.array(labels, dtype=np.int8).reshape(-1, num_tasks)
+
+
+def merge_intervals(intervalspecs, prefix, seed=0):
+    """
+    Merges intervalspecs into a multi-task intervalspec.
+
+    The merged tasks are the tasks of each intervalspec in order, the
+    intervals of each dataset the union of its intervals in every
+    intervalspec, with AMBIG_LABEL for tasks observed in other datasets or
+    intervals only. Intervals must come from the same binning to align.
+    Writes an intervals file per dataset and `<prefix>.json`.
+    """
+    specs = []
+    for intervalspec in intervalspecs:
+        with open(intervalspec, 'r') as fp:
+            specs.append(json.load(fp, object_pairs_hook=collections.OrderedDict))
+    task_names = [task_name for spec in specs for task_name in spec['task_names']]
+    duplicates = sorted(set(task_name for task_name in task_names
+                            if task_names.count(task_name) > 1))
+    if duplicates:
+        raise ValueError('Tasks {} are in more than one intervalspec'.format(', '.join(duplicates)))
+    spec_task_indxs = []
+    for spec in specs:
+        start = sum(len(task_indxs) for task_indxs in spec_task_indxs)
+        spec_task_indxs.append(list(range(start, start + len(spec['task_names']))))
+    dataset_ids = []
+    for spec in specs:
+        dataset_ids.extend(dataset_id for dataset_id in spec
+                           if dataset_id != 'task_names' and dataset_id not in dataset_ids)
+
+    rng = np.random.RandomState(seed)
+    merged_intervalspec = collections.OrderedDict([('task_names', task_names)])
+    for dataset_id in dataset_ids:
+        intervals_file = os.path.abspath('{}.{}.intervals_file.tsv.gz'.format(prefix, dataset_id))
+        merged_intervalspec[dataset_id] = {'intervals_file': intervals_file}
+        if os.path.isfile(intervals_file):
+            _logger.info('intervals_file file {} already exists. skipping dataset {}!'.format(
+                intervals_file, dataset_id))
+            continue
+        _logger.info('Merging intervals of dataset {}...'.format(dataset_id))
+        in_specs = [indx for indx, spec in enumerate(specs) if dataset_id in spec]
+        intervals, labels = merge_intervals_files(
+            [specs[indx][dataset_id]['intervals_file'] for indx in in_specs],
+            [spec_task_indxs[indx] for indx in in_specs], len(task_names))
+        # shuffled as labelregions does, interval queues stream files in order
+        with gzip.open(intervals_file, 'wb') as fp:
+            for indx in rng.permutation(len(intervals)):
+                fp.write('\t'.join(map(str, list(intervals[indx]) + labels[indx].tolist()))
+                         .encode('ascii') + b'\n')
+        _logger.info('Saved {} intervals with {:.1%} ambiguous labels to {}'.format(
+            len(intervals), (labels == AMBIG_LABEL).mean() if len(labels) else 0,
+            intervals_file))
+
+    merged_intervalspec_file = os.path.abspath('{}.json'.format(prefix))
+    with open(merged_intervalspec_file, 'w') as fp:
+        json.dump(merged_intervalspec, fp, indent=4)
+    _logger.info('Wrote merged intervalspec to {}'.format(merged_intervalspec_file))
+    return merged_intervalspec_file
@@ -3,10 +3,6 @@ from builtins import zip
 import collections
 import json
 
-from genomedatalayer.extractors import (
-    MemmappedBigwigExtractor, MemmappedFastaExtractor
-)
-
 
 class Dataset(object):
 
@@ -236,6 +232,9 @@ class Datasets(object):
         return datasets_dict
 
     def get_dataset2extractors(self, local_norm_halfwidth=None):
+        from genomedatalayer.extractors import (
+            MemmappedBigwigExtractor, MemmappedFastaExtractor
+        )
         if self.memmaped:
             sequence_input = False
             dnase_input = False
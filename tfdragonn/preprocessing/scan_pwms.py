@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import functools
+import json
+import multiprocessing
+import os
+
+from tfdragonn import loggers
+from tfdragonn import pwms
+from tfdragonn.extractors import load_array_dir, write_chrom_chunks, write_metadata
+
+LOGGER_NAME = 'tfdragonn-scan-pwms'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Bases per chromosome chunk scanned and written at a time
+SCAN_CHUNK_SIZE = 10**7
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn scanpwms',
+                                     description='Write pwm score tracks of the genome of each'
+                                     ' dataset as data dirs.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('datasetspec', type=os.path.abspath,
+                        help='Dataset parameters json file path')
+    parser.add_argument('output_datasetspec', type=os.path.abspath,
+                        help='Json file path for the datasetspec with the pwm score data dirs')
+    parser.add_argument('output_dir', type=os.path.abspath,
+                        help='Directory for the pwm score data dirs')
+    parser.add_argument('--pwm-paths', type=json.loads, required=True,
+                        help='CIS-BP pwm file paths as a json string, as in baseline modelspecs')
+    parser.add_argument('--window', type=int, default=1,
+                        help='Positions of the max score of each pwm at each base, [i, i + window).'
+                        '\nDefault: 1, the per base scores.')
+    parser.add_argument('--both-strands', action='store_true',
+                        help='Score each pwm and its reverse complement and keep the max.')
+    parser.add_argument('--array-type', type=str, default='array_numpy',
+                        choices=['array_bcolz', 'array_numpy'],
+                        help='Array type of the score data dirs, array_numpy is memory mapped.'
+                        '\nDefault: array_numpy.')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='Number of chromosomes scanned in parallel.\nDefault: 1.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_scan_pwms_from_args(command, args):
+    args = parse_args(args)
+    scan_pwms_datasets(args.datasetspec, args.output_datasetspec, args.output_dir,
+                       args.pwm_paths, window=args.window, both_strands=args.both_strands,
+                       array_type=args.array_type, n_jobs=args.n_jobs)
+
+
+def _scan_chrom_chunks(chrom_sequence, conv_weights, window, both_strands, chunk_size):
+    """Yields (start, scores) of consecutive chunks of a chromosome."""
+    overlap = conv_weights.shape[1] - 1 + window - 1
+    for start in range(0, len(chrom_sequence), chunk_size):
+        scores = pwms.scan_pwms(chrom_sequence[start:start + chunk_size + overlap], conv_weights,
+                                both_strands=both_strands)
+        if window > 1:
+            scores = pwms.window_max(scores, window)
+        yield start, scores[:chunk_size]
+
+
+def scan_chrom(chrom, genome_data_dir, data_dir, conv_weights, window=1, both_strands=False,
+               array_type='array_numpy', chunk_size=SCAN_CHUNK_SIZE):
+    chrom_sequence = load_array_dir(genome_data_dir)[chrom]
+    shape = (len(chrom_sequence), conv_weights.shape[0])
+    write_chrom_chunks(data_dir, chrom, shape, array_type, _scan_chrom_chunks(
+        chrom_sequence, conv_weights, window, both_strands, chunk_size))
+    return chrom, shape
+
+
+def scan_genome(genome_data_dir, data_dir, pwm_paths, window=1, both_strands=False,
+                array_type='array_numpy', n_jobs=1):
+    """
+    Writes a (chrom_size, num_pwms) pwm score data dir of a genome data dir.
+
+    Each chromosome is scanned SCAN_CHUNK_SIZE bases at a time, in a pool of
+    n_jobs processes. Scores at base i are those of the baseline classifiers'
+    frozen pwm convolution at i, or their max over [i, i + window).
+    """
+    conv_weights = pwms.pwms2conv_weights(pwm_paths)
+    chroms = sorted(load_array_dir(genome_data_dir).keys())
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    scan_fn = functools.partial(_scan_chrom_star, genome_data_dir, data_dir, conv_weights,
+                                window, both_strands, array_type)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        file_shapes = dict(pool.map(scan_fn, chroms))
+    finally:
+        pool.close()
+        pool.join()
+    write_metadata(data_dir, array_type, file_shapes, pwm_paths=list(pwm_paths),
+                   window=window, both_strands=both_strands)
+
+
+def _scan_chrom_star(genome_data_dir, data_dir, conv_weights, window, both_strands, array_type,
+                     chrom):
+    return scan_chrom(chrom, genome_data_dir, data_dir, conv_weights, window=window,
+                      both_strands=both_strands, array_type=array_type)
+
+
+def scan_pwms_datasets(datasetspec, output_datasetspec, output_dir, pwm_paths, window=1,
+                       both_strands=False, array_type='array_numpy', n_jobs=1):
+    """
+    Writes the pwm score data dirs of each dataset and a datasetspec with them added.
+
+    Datasets sharing a genome data dir share its scores, datasets without one
+    are left as they are. Score data dirs that already exist are reused.
+    """
+    with open(datasetspec, 'r') as fp:
+        datasets = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    score_dirs = {}
+    for dataset_id, dataset_dict in datasets.items():
+        genome_data_dir = dataset_dict.get('genome_data_dir')
+        if genome_data_dir is None:
+            _logger.info('Skipping dataset {}, missing genome_data_dir'.format(dataset_id))
+            continue
+        if genome_data_dir not in score_dirs:
+            data_dir = os.path.join(output_dir, '{}.pwm_scores'.format(dataset_id))
+            if os.path.isfile(os.path.join(data_dir, 'metadata.json')):
+                _logger.info('{} already exists, skipping!'.format(data_dir))
+            else:
+                _logger.info('Scanning {} pwms for dataset {}...'.format(
+                    len(pwm_paths), dataset_id))
+                scan_genome(genome_data_dir, data_dir, pwm_paths, window=window,
+                            both_strands=both_strands, array_type=array_type, n_jobs=n_jobs)
+            score_dirs[genome_data_dir] = data_dir
+        dataset_dict['pwm_scores_data_dir'] = score_dirs[genome_data_dir]
+    with open(output_datasetspec, 'w') as fp:
+        json.dump(datasets, fp, indent=4)
+    _logger.info('Saved datasetspec to {}'.format(output_datasetspec))
@@ -1,5 +1,8 @@
 import numpy as np
 
+# Positions scored at a time when scanning pwms, bounds the window matrix
+SCAN_BLOCK_SIZE = 2**18
+
 
 def read_cisbp_pwm(pwm_path):
     return np.loadtxt(pwm_path, skiprows=1, dtype=float,
@@ -29,3 +32,52 @@ def pwms2conv_weights(pwm_paths):
     normalized_conv_weights = np.log((0.0001 + padded_conv_filters) / 1.0004)
 
     return normalized_conv_weights
+
+
+def scan_pwms(sequence, conv_weights, block_size=SCAN_BLOCK_SIZE, both_strands=False):
+    """
+    Scores pwms at every position of a (length, 4) one-hot sequence.
+
+    conv_weights are (num_pwms, width, 4), as from pwms2conv_weights. Returns
+    (length, num_pwms) scores of the windows [i, i + width), the frozen pwm
+    convolution of the baseline classifiers, with the last width - 1
+    positions scored as if the sequence ended in Ns. Windows of block_size
+    positions are scored as one matrix product. If both_strands, each score
+    is the max of the pwm and its reverse complement.
+    """
+    num_pwms, width = conv_weights.shape[:2]
+    kernel = conv_weights.transpose((1, 2, 0)).reshape(width * 4, num_pwms).astype(np.float32)
+    if both_strands:
+        rc_kernel = conv_weights[:, ::-1, ::-1].transpose((1, 2, 0)).reshape(width * 4, num_pwms)
+        kernel = np.concatenate([kernel, rc_kernel.astype(np.float32)], axis=1)
+    scores = np.zeros((len(sequence), num_pwms), dtype=np.float32)
+    for start in range(0, len(sequence), block_size):
+        block = np.zeros((min(block_size, len(sequence) - start) + width - 1, 4), dtype=np.float32)
+        block_sequence = sequence[start:start + len(block)]
+        block[:len(block_sequence)] = block_sequence
+        windows = np.lib.stride_tricks.as_strided(
+            block, shape=(len(block) - width + 1, width * 4),
+            strides=(block.strides[0], block.strides[1]))
+        block_scores = np.dot(windows, kernel)
+        if both_strands:
+            block_scores = np.maximum(block_scores[:, :num_pwms], block_scores[:, num_pwms:])
+        scores[start:start + len(block_scores)] = block_scores
+    return scores
+
+
+def window_max(scores, window):
+    """
+    Returns the max of scores over the positions [i, i + window) of each i.
+
+    Takes log2(window) passes over the (length, num_pwms) scores, positions
+    past the end are left out of the max.
+    """
+    out = scores.copy()
+    span = 1
+    while 2 * span <= window:
+        out[:-span] = np.maximum(out[:-span], out[span:])
+        span *= 2
+    if span < window:  # cover the rest with a second, overlapping span
+        shift = window - span
+        out[:-shift] = np.maximum(out[:-shift], out[shift:])
+    return out
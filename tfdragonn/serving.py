@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import six.moves
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from tfdragonn import extractors
+from tfdragonn import loggers
+from tfdragonn.genome_prediction import load_dataset_inputs
+from tfdragonn.model_specs import check_rc_average_inputs
+
+LOGGER_NAME = 'tfdragonn-serve'
+_logger = loggers.get_logger(LOGGER_NAME)
+
+# Seconds the batching thread waits for a request, and callers for their
+# predictions, before checking for shutdown
+POLL_INTERVAL = 0.1
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser('tfdragonn serve',
+                                     description='Serve a trained model on localhost.',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('datasetspec', type=os.path.abspath,
+                        help='Dataset parameters json file path')
+    parser.add_argument('logdir', type=os.path.abspath,
+                        help='Log directory of a trained model')
+    parser.add_argument('--visiblegpus', type=str, default='',
+                        help='Visible GPUs string.\nDefault: none.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on.\nDefault: 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on.\nDefault: 8765.')
+    parser.add_argument('--interval-length', type=int, default=1000,
+                        help='Length of the scored intervals, including flanks.\nDefault: 1000.')
+    parser.add_argument('--max-batch-size', type=int, default=1000,
+                        help='Max number of intervals in a batch.\nDefault: 1000.')
+    parser.add_argument('--max-latency', type=float, default=0.01,
+                        help='Max seconds a request waits for others to batch with.\nDefault: 0.01.')
+    parser.add_argument('--rc-average', action='store_true',
+                        help='Average predictions on each interval and its reverse complement.')
+    args = parser.parse_args(args)
+    return args
+
+
+def run_serve_from_args(command, args):
+    args = parse_args(args)
+    loggers.add_logdir(LOGGER_NAME, args.logdir)
+    model_server = ModelServer(args.datasetspec, args.logdir,
+                               interval_length=args.interval_length,
+                               max_batch_size=args.max_batch_size,
+                               max_latency=args.max_latency,
+                               rc_average=args.rc_average,
+                               visiblegpus=args.visiblegpus)
+    model_server.start()
+    http_server = make_http_server(model_server, args.host, args.port)
+    _logger.info('Serving {} on http://{}:{}'.format(args.logdir, *http_server.server_address))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        model_server.stop()
+
+
+class _Request(object):
+    """Intervals of one scoring request and a slot for its predictions."""
+
+    def __init__(self, dataset_id, chroms, starts):
+        self.dataset_id = dataset_id
+        self.chroms = chroms
+        self.starts = starts
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class ModelServer(object):
+    """
+    Keeps a trained model and its dataset extractors loaded, scores intervals.
+
+    Requests from concurrent callers are queued and coalesced by a batching
+    thread into batches of up to max_batch_size intervals; the first request
+    of a batch waits at most max_latency seconds for others. The batching
+    thread owns the keras session, all model building and prediction happen
+    there.
+    """
+
+    def __init__(self, datasetspec, logdir, interval_length=1000, max_batch_size=1000,
+                 max_latency=0.01, rc_average=False, visiblegpus=''):
+        self.logdir = logdir
+        self.interval_length = interval_length
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.rc_average = rc_average
+        self.visiblegpus = visiblegpus
+        self.dataset_inputs = load_dataset_inputs(datasetspec)
+        with open(os.path.join(logdir, 'intervalspec.json'), 'r') as fp:
+            self.task_names = json.load(fp)['task_names']
+        self.num_requests = 0
+        self.num_batches = 0
+        self._requests = six.moves.queue.Queue()
+        self._extractors = {}
+        self._models = {}
+        self._stopped = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self._startup_error = None
+
+    def start(self):
+        """Starts the batching thread and waits for the model to load."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if self._startup_error is not None:
+            raise self._startup_error
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def predict(self, dataset_id, intervals):
+        """
+        Returns (num_intervals, num_tasks) predictions.
+
+        Args:
+            dataset_id (str): a dataset in the datasetspec.
+            intervals (list): (chrom, start, end) tuples, all interval_length long.
+        """
+        if dataset_id not in self.dataset_inputs:
+            raise ValueError('Unknown dataset {}'.format(dataset_id))
+        thread = self._thread
+        if thread is None:
+            raise RuntimeError('Model server is not running')
+        chroms = np.array([chrom for chrom, _, _ in intervals], dtype=object)
+        starts = np.array([start for _, start, _ in intervals], dtype=np.int64)
+        ends = np.array([end for _, _, end in intervals], dtype=np.int64)
+        if np.any(ends - starts != self.interval_length):
+            raise ValueError('All intervals must be {} bp long'.format(self.interval_length))
+        if len(intervals) == 0:
+            return np.zeros((0, len(self.task_names)), dtype=np.float32)
+        request = _Request(dataset_id, chroms, starts)
+        self._requests.put(request)
+        # requests queued after the batching thread drained the queue on stop are never answered
+        while not request.done.wait(POLL_INTERVAL):
+            if not thread.is_alive() and not request.done.is_set():
+                raise RuntimeError('Model server stopped')
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def status(self):
+        return {'logdir': self.logdir,
+                'task_names': self.task_names,
+                'datasets': sorted(self.dataset_inputs.keys()),
+                'interval_length': self.interval_length,
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches}
+
+    def _run(self):
+        try:
+            self._load()
+        except Exception as e:
+            self._startup_error = e
+            self._thread = None
+            self._ready.set()
+            return
+        self._ready.set()
+        while not self._stopped.is_set():
+            requests = self._next_requests()
+            if requests:
+                self._predict_requests(requests)
+        # answer the requests left in the queue, their callers are waiting on them
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except six.moves.queue.Empty:
+                break
+            request.error = RuntimeError('Model server stopped')
+            request.done.set()
+
+    def _load(self):
+        from tfdragonn import models
+        from tfdragonn.model_runner import BaseModelRunner
+
+        BaseModelRunner.setup_keras_session(self.visiblegpus)
+        input_names = models.model_inputs_from_config(os.path.join(self.logdir, 'modelspec.json'))
+        if self.rc_average:
+            check_rc_average_inputs(input_names)
+        self._extractors = {dataset_id: extractors.get_extractors(dataset_inputs, input_names)
+                            for dataset_id, dataset_inputs in self.dataset_inputs.items()}
+        for dataset_id in self._extractors:
+            self._get_model(dataset_id)
+
+    def _get_model(self, dataset_id):
+        """Builds the model once per set of input shapes."""
+        from tfdragonn import models
+
+        input_shapes = {input_name: extractor.output_shape(self.interval_length)
+                        for input_name, extractor in self._extractors[dataset_id].items()}
+        key = tuple(sorted(input_shapes.items()))
+        if key not in self._models:
+            model = models.model_from_minimal_config(
+                os.path.join(self.logdir, 'modelspec.json'), input_shapes, len(self.task_names))
+            model.load_weights(os.path.join(self.logdir, 'model.weights.h5'))
+            self._models[key] = model
+        return self._models[key]
+
+    def _next_requests(self):
+        """Waits for a request, then collects more until the batch is full or the latency bound."""
+        try:
+            requests = [self._requests.get(timeout=POLL_INTERVAL)]
+        except six.moves.queue.Empty:
+            return []
+        num_intervals = len(requests[0])
+        deadline = time.time() + self.max_latency
+        while num_intervals < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except six.moves.queue.Empty:
+                break
+            requests.append(request)
+            num_intervals += len(request)
+        return requests
+
+    def _predict_requests(self, requests):
+        self.num_requests += len(requests)
+        for dataset_id in set(request.dataset_id for request in requests):
+            dataset_requests = [request for request in requests if request.dataset_id == dataset_id]
+            try:
+                self._predict_dataset_requests(dataset_id, dataset_requests)
+            except Exception as e:
+                _logger.exception('Failed to score {} requests'.format(len(dataset_requests)))
+                for request in dataset_requests:
+                    request.error = e
+            for request in dataset_requests:
+                request.done.set()
+
+    def _predict_dataset_requests(self, dataset_id, requests):
+        model = self._get_model(dataset_id)
+        chroms = np.concatenate([request.chroms for request in requests])
+        starts = np.concatenate([request.starts for request in requests])
+        # extract each chromosome once, in sorted order so dense reads stay dense
+        order = np.lexsort((starts, chroms.astype(str)))
+        predictions = np.empty((len(starts), len(self.task_names)), dtype=np.float32)
+        for batch_start in range(0, len(order), self.max_batch_size):
+            batch_order = order[batch_start:batch_start + self.max_batch_size]
+            batch_chroms = chroms[batch_order]
+            chrom_batches = []
+            for chrom in np.unique(batch_chroms):
+                chrom_starts = starts[batch_order[batch_chroms == chrom]]
+                chrom_batches.append(extractors.extract_batch(
+                    self._extractors[dataset_id], chrom, chrom_starts, self.interval_length))
+            batch = {input_name: np.concatenate([chrom_batch[input_name] for chrom_batch in chrom_batches])
+                     for input_name in chrom_batches[0]}
+            # np.unique sorts, so grouping by chrom keeps the lexsort order
+            predictions[batch_order] = model.predict_on_batch(batch, rc_average=self.rc_average)
+            self.num_batches += 1
+        offset = 0
+        for request in requests:
+            request.predictions = predictions[offset:offset + len(request)]
+            offset += len(request)
+
+
+class _ModelServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON endpoints of a ModelServer.
+
+    POST /predict {"dataset_id": ..., "intervals": [[chrom, start, end], ...]}
+    returns {"task_names": [...], "predictions": [[...], ...]}.
+    GET /status returns the server status.
+    """
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self._send_json({'error': 'Unknown path {}'.format(self.path)}, status=404)
+        self._send_json(self.server.model_server.status())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._send_json({'error': 'Unknown path {}'.format(self.path)}, status=404)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            predictions = self.server.model_server.predict(
+                request['dataset_id'], request['intervals'])
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_json({'error': str(e)}, status=400)
+        except Exception as e:
+            return self._send_json({'error': str(e)}, status=500)
+        self._send_json({'task_names': self.server.model_server.task_names,
+                         'predictions': predictions.tolist()})
+
+    def _send_json(self, response, status=200):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug(format % args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_http_server(model_server, host='127.0.0.1', port=0):
+    """Returns an HTTP server for a started ModelServer, port 0 picks a free port."""
+    http_server = _ThreadingHTTPServer((host, port), _ModelServerHandler)
+    http_server.model_server = model_server
+    return http_server
+
+
+def start_http_server(model_server, host='127.0.0.1', port=0):
+    """Serves a started ModelServer from a background thread, returns the HTTP server."""
+    http_server = make_http_server(model_server, host, port)
+    thread = threading.Thread(target=http_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return http_server
+
+
+class ModelClient(object):
+    """Client of a served model, e.g. ModelClient('http://127.0.0.1:8765')."""
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def predict(self, dataset_id, intervals):
+        """Returns (num_intervals, num_tasks) predictions for (chrom, start, end) intervals."""
+        body = json.dumps({'dataset_id': dataset_id,
+                           'intervals': [[chrom, int(start), int(end)]
+                                         for chrom, start, end in intervals]})
+        response = self._open(six.moves.urllib.request.Request(
+            self.url + '/predict', data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'}))
+        return np.array(response['predictions'], dtype=np.float32).reshape(
+            (len(intervals), len(response['task_names'])))
+
+    def status(self):
+        return self._open(six.moves.urllib.request.Request(self.url + '/status'))
+
+    def _open(self, request):
+        try:
+            fp = six.moves.urllib.request.urlopen(request, timeout=self.timeout)
+        except six.moves.urllib.error.HTTPError as e:
+            raise ValueError(json.loads(e.read().decode('utf-8'))['error'])
+        try:
+            return json.loads(fp.read().decode('utf-8'))
+        finally:
+            fp.close()
@@ -2,10 +2,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
 import numpy as np
 import os
 import psutil
+import shutil
 import six.moves
+import traceback
 
 from keras import backend as K, optimizers
 from keras.objectives import binary_crossentropy
@@ -16,6 +19,8 @@ from tfdragonn import gf_io_utils
 
 BATCH_FREQ_UPDATE_MEM_USAGE = 100
 BATCH_FREQ_UPDATE_PROGBAR = 50
+# Seconds between checks that the validation process is alive while waiting for results
+ASYNC_VALIDATION_POLL_INTERVAL = 5
 
 def build_masked_loss(loss_function, mask_value=AMBIG_LABEL):
     def binary_crossentropy(y_true, y_pred):
@@ -29,12 +34,150 @@ def masked_binary_crossentropy(mask_value=AMBIG_LABEL):
     return build_masked_loss(binary_crossentropy, mask_value=mask_value)
 
 
+class EarlyStoppingMonitor(object):
+    """
+    Tracks the best validation metric and the early stopping patience.
+
+    Args:
+        metric (str): ClassificationResult key to monitor, averaged across tasks.
+        patience (int): number of non-improving epochs tolerated before stopping.
+    """
+
+    def __init__(self, metric='auPRC', patience=5):
+        self.metric = metric
+        self.patience = patience
+        self.best_metric = np.inf if metric == 'Loss' else -np.inf
+        self.best_epoch = None
+        self.wait = 0
+        self.stop = False
+
+    def update(self, epoch, classification_result):
+        """Returns True if the epoch has the best metric so far."""
+        current_metric = classification_result[self.metric].mean()
+        if (self.metric == 'Loss') == (current_metric <= self.best_metric):
+            self.best_metric = current_metric
+            self.best_epoch = epoch
+            self.wait = 0
+            return True
+        if self.wait >= self.patience:
+            self.stop = True
+        self.wait += 1
+        return False
+
+
+def _async_validation_worker(build_fn, batch_size, metrics_n_jobs, tasks, results):
+    """Validation process loop: evaluates weight snapshots until it receives None."""
+    try:
+        model, queue, task_names = build_fn()
+        trainer = ClassifierTrainer(task_names=task_names, metrics_n_jobs=metrics_n_jobs)
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, weights_fname = task
+        try:
+            model.load_weights(weights_fname)
+            result = trainer.test(model, queue, batch_size=batch_size, verbose=False)
+        except Exception:
+            results.put((epoch, weights_fname, traceback.format_exc()))
+            break
+        results.put((epoch, weights_fname, result))
+
+
+class AsyncValidator(object):
+    """
+    Runs validation in a separate process on snapshots of the model weights.
+
+    The validation process builds its own model and validation queue, so
+    training continues on the next epoch while the previous one is evaluated.
+    Create it before the training process sets up its TF session, the
+    validation process is forked.
+
+    Args:
+        build_fn: callable run in the validation process, returns a
+            (model, validation_queue, task_names) tuple.
+        snapshot_dir (str): directory for the weight snapshots.
+        max_lag (int): max number of epochs validation can fall behind training,
+            submitting beyond it blocks until the oldest result arrives.
+        batch_size (int): validation batch size.
+        metrics_n_jobs (int): number of processes computing validation metrics.
+    """
+
+    def __init__(self, build_fn, snapshot_dir, max_lag=1, batch_size=1000, metrics_n_jobs=1):
+        self.snapshot_dir = snapshot_dir
+        self.max_lag = max_lag
+        self.num_pending = 0
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_async_validation_worker,
+            args=(build_fn, batch_size, metrics_n_jobs, self._tasks, self._results))
+        self._process.daemon = True
+        self._process.start()
+
+    def submit(self, model, epoch):
+        """Snapshots the model weights and queues them for validation."""
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        weights_fname = os.path.join(
+            self.snapshot_dir, 'epoch{}.weights.h5'.format(epoch))
+        model.model.save_weights(weights_fname, overwrite=True)
+        self._tasks.put((epoch, weights_fname))
+        self.num_pending += 1
+
+    def get_results(self, max_pending=None):
+        """
+        Returns a list of finished (epoch, weights_fname, ClassificationResult).
+
+        Blocks until at most max_pending validations are pending,
+        if max_pending is None only returns results that already arrived.
+        Raises a RuntimeError if the validation process exited with
+        validations pending.
+        """
+        finished = []
+        while self.num_pending > 0:
+            block = max_pending is not None and self.num_pending > max_pending
+            try:
+                epoch, weights_fname, result = self._get_result(block)
+            except six.moves.queue.Empty:
+                break
+            if not isinstance(result, ClassificationResult):
+                raise RuntimeError(
+                    'Asynchronous validation failed:\n{}'.format(result))
+            self.num_pending -= 1
+            finished.append((epoch, weights_fname, result))
+        return finished
+
+    def _get_result(self, block):
+        """Gets a result, polling the validation process while blocked."""
+        while True:
+            is_alive = self._process.is_alive()
+            try:
+                # results put before the process exited may still be in the pipe
+                return self._results.get(block=block or not is_alive,
+                                         timeout=ASYNC_VALIDATION_POLL_INTERVAL)
+            except six.moves.queue.Empty:
+                if not is_alive:
+                    raise RuntimeError(
+                        'Asynchronous validation process exited with code {} and {} '
+                        'validations pending'.format(self._process.exitcode, self.num_pending))
+                if not block:
+                    raise
+
+    def close(self):
+        self._tasks.put(None)
+        self._process.join()
+
+
 class ClassifierTrainer(object):
 
     def __init__(self, optimizer='adam', lr=0.0003, batch_size=128,
                  epoch_size=250000, num_epochs=100,
                  early_stopping_metric='auPRC', early_stopping_patience=5,
-                 task_names=None, logger=None):
+                 task_names=None, logger=None, metrics_n_jobs=1):
         self.optimizer = optimizer
         self.lr = lr
         self.batch_size = batch_size
@@ -44,6 +187,7 @@ class ClassifierTrainer(object):
         self.early_stopping_patience = early_stopping_patience
         self.task_names = task_names
         self.logger = logger
+        self.metrics_n_jobs = metrics_n_jobs
 
     def compile(self, model):
         loss_func = masked_binary_crossentropy()
@@ -52,7 +196,17 @@ class ClassifierTrainer(object):
         model.model.compile(optimizer=optimizer, loss=loss_func)
 
     def train(self, model, train_queue, valid_queue,
-              save_best_model_to_prefix=None, verbose=True):
+              save_best_model_to_prefix=None, verbose=True, async_validator=None,
+              teacher=None):
+        """
+        Trains the model with early stopping on the validation metric.
+
+        If async_validator is set, valid_queue is ignored and each epoch is
+        validated by the AsyncValidator while training continues. Early stopping
+        and best model saving are then applied as validation results arrive.
+        If teacher is set, the model is trained on the teacher's predictions
+        instead of the labels, validation still uses the labels.
+        """
         self.logger.info('optimizer: {}'.format(self.optimizer))
         self.logger.info('learning rate: {}'.format(self.lr))
         self.logger.info('batch size: {}'.format(self.batch_size))
@@ -62,6 +216,11 @@ class ClassifierTrainer(object):
             self.early_stopping_metric))
         self.logger.info('early stopping patience: {}'.format(
             self.early_stopping_patience))
+        if async_validator is not None:
+            self.logger.info('asynchronous validation, max lag: {}'.format(
+                async_validator.max_lag))
+        if teacher is not None:
+            self.logger.info('training on teacher predictions')
         process = psutil.Process(os.getpid())
 
         self.compile(model)
@@ -69,6 +228,27 @@ class ClassifierTrainer(object):
         def get_rss_prop():  # this is quite expensive
             return (process.memory_info().rss - process.memory_info().shared) / 10**6
 
+        def process_validation_result(epoch, epoch_valid_metrics, weights_fname=None):
+            valid_metrics.append(epoch_valid_metrics)
+            if verbose:
+                self.logger.info('\nEpoch {}:'.format(epoch))
+                self.logger.info('Metrics across all datasets:\n{}\n'.format(
+                    epoch_valid_metrics))
+            if early_stopping.update(epoch, epoch_valid_metrics):
+                if verbose:
+                    self.logger.info('New best {}. Saving model.\n'.format(
+                        self.early_stopping_metric))
+                if save_best_model_to_prefix is not None:
+                    if weights_fname is None:
+                        model.save(save_best_model_to_prefix)
+                    else:  # the weights snapshot of that epoch
+                        open(save_best_model_to_prefix + '.arch.json', 'w').write(
+                            model.model.to_json())
+                        shutil.copyfile(weights_fname,
+                                        save_best_model_to_prefix + '.weights.h5')
+            if weights_fname is not None:
+                os.remove(weights_fname)
+
         # train_iterator = None
 
         train_iterator = gf_io_utils.ExampleQueueIterator(
@@ -76,7 +256,8 @@ class ClassifierTrainer(object):
             num_epochs=self.num_epochs, num_exs_epoch=self.epoch_size)
 
         valid_metrics = []
-        best_metric = np.inf if self.early_stopping_metric == 'Loss' else -np.inf
+        early_stopping = EarlyStoppingMonitor(
+            self.early_stopping_metric, self.early_stopping_patience)
         batches_per_epoch = int(
             np.floor(self.epoch_size / self.batch_size))
         samples_per_epoch = self.batch_size * batches_per_epoch
@@ -86,8 +267,12 @@ class ClassifierTrainer(object):
 
             for batch_indxs in six.moves.range(1, batches_per_epoch + 1):
                 batch = train_iterator.next()
+                if teacher is None:
+                    targets = batch['labels']
+                else:
+                    targets = teacher.predict_on_batch(batch)
                 batch_loss = model.model.train_on_batch(
-                    batch, batch['labels'])
+                    batch, targets)
 
                 if batch_indxs % BATCH_FREQ_UPDATE_MEM_USAGE == 0:
                     rss_minus_shr_memory = get_rss_prop()
@@ -97,38 +282,168 @@ class ClassifierTrainer(object):
                                    values=[("loss", batch_loss),
                                            ("Non-shared RSS (Mb)", rss_minus_shr_memory)])
 
-            epoch_valid_metrics = self.test(model, valid_queue)
-            valid_metrics.append(epoch_valid_metrics)
-            if verbose:
-                self.logger.info('\nEpoch {}:'.format(epoch))
-                self.logger.info('Metrics across all datasets:\n{}\n'.format(
-                    epoch_valid_metrics))
-            current_metric = epoch_valid_metrics[
-                self.early_stopping_metric].mean()
-            if (self.early_stopping_metric == 'Loss') == (current_metric <= best_metric):
-                if verbose:
-                    self.logger.info('New best {}. Saving model.\n'.format(
-                        self.early_stopping_metric))
-                best_metric = current_metric
-                best_epoch = epoch
-                early_stopping_wait = 0
-                if save_best_model_to_prefix is not None:
-                    model.save(save_best_model_to_prefix)
+            if async_validator is None:
+                process_validation_result(epoch, self.test(model, valid_queue))
             else:
-                if early_stopping_wait >= self.early_stopping_patience:
-                    break
-                early_stopping_wait += 1
+                async_validator.submit(model, epoch)
+                for valid_epoch, weights_fname, epoch_valid_metrics in async_validator.get_results(
+                        max_pending=async_validator.max_lag):
+                    process_validation_result(
+                        valid_epoch, epoch_valid_metrics, weights_fname=weights_fname)
+            if early_stopping.stop:
+                break
         train_iterator.close()
 
+        if async_validator is not None:  # apply the remaining validation results
+            for valid_epoch, weights_fname, epoch_valid_metrics in async_validator.get_results(
+                    max_pending=0):
+                if early_stopping.stop:
+                    os.remove(weights_fname)
+                else:
+                    process_validation_result(
+                        valid_epoch, epoch_valid_metrics, weights_fname=weights_fname)
+            async_validator.close()
+
         if verbose:  # end of training messages
             self.logger.info(
                 'Finished training after {} epochs.'.format(epoch))
             if save_best_model_to_prefix is not None:
                 self.logger.info("The best model's architecture and weights (from epoch {0}) "
                                  'were saved to {1}.arch.json and {1}.weights.h5'.format(
-                                     best_epoch, save_best_model_to_prefix))
+                                     early_stopping.best_epoch, save_best_model_to_prefix))
+
+    def distill(self, student, teacher, train_queue, valid_queue,
+                save_best_model_to_prefix=None, verbose=True):
+        """
+        Trains a student model on the soft predictions of a trained teacher.
+
+        Training intervals only provide inputs, so they can be unlabeled windows
+        sampled as they would be scanned. Early stopping uses the labeled
+        validation queue, as in train.
+        """
+        self.train(student, train_queue, valid_queue,
+                   save_best_model_to_prefix=save_best_model_to_prefix,
+                   verbose=verbose, teacher=teacher)
+
+    def train_many(self, models, train_queue, valid_queue,
+                   save_best_model_to_prefixes=None, verbose=True):
+        """
+        Trains several models against a single stream of training batches.
+
+        Every dequeued batch is used to train each model in turn and validation
+        runs all models on a single pass over the validation queue, so data
+        extraction is paid once for all models. Early stopping is tracked per
+        model, a model stops training once its patience runs out.
+        """
+        self.logger.info('number of models: {}'.format(len(models)))
+        self.logger.info('optimizer: {}'.format(self.optimizer))
+        self.logger.info('learning rate: {}'.format(self.lr))
+        self.logger.info('batch size: {}'.format(self.batch_size))
+        self.logger.info('epoch size: {}'.format(self.epoch_size))
+        self.logger.info('max num of epochs: {}'.format(self.num_epochs))
+        self.logger.info('early stopping metrics: {}'.format(
+            self.early_stopping_metric))
+        self.logger.info('early stopping patience: {}'.format(
+            self.early_stopping_patience))
+        if save_best_model_to_prefixes is None:
+            save_best_model_to_prefixes = [None] * len(models)
+        assert len(save_best_model_to_prefixes) == len(models)
+
+        for model in models:
+            self.compile(model)
+
+        train_iterator = gf_io_utils.ExampleQueueIterator(
+            train_queue, num_exs_batch=self.batch_size,
+            num_epochs=self.num_epochs, num_exs_epoch=self.epoch_size)
+
+        early_stoppings = [EarlyStoppingMonitor(self.early_stopping_metric,
+                                                self.early_stopping_patience)
+                           for _ in models]
+        active_indxs = list(range(len(models)))
+        batches_per_epoch = int(
+            np.floor(self.epoch_size / self.batch_size))
+        samples_per_epoch = self.batch_size * batches_per_epoch
+        for epoch in six.moves.range(1, self.num_epochs + 1):
+            progbar = Progbar(target=samples_per_epoch)
 
-    def test(self, model, queue, batch_size=1000, verbose=True, test_size=None):
+            for batch_indxs in six.moves.range(1, batches_per_epoch + 1):
+                batch = train_iterator.next()
+                batch_losses = [models[indx].model.train_on_batch(batch, batch['labels'])
+                                for indx in active_indxs]
+
+                if batch_indxs % BATCH_FREQ_UPDATE_PROGBAR == 0:
+                    progbar.update(batch_indxs * self.batch_size,
+                                   values=[("mean loss", np.mean(batch_losses))])
+
+            epoch_valid_metrics = self.test_many(
+                [models[indx] for indx in active_indxs], valid_queue)
+            for indx, model_valid_metrics in zip(active_indxs, epoch_valid_metrics):
+                if verbose:
+                    self.logger.info('\nEpoch {}, model {}:'.format(epoch, indx))
+                    self.logger.info('Metrics across all datasets:\n{}\n'.format(
+                        model_valid_metrics))
+                if early_stoppings[indx].update(epoch, model_valid_metrics):
+                    if verbose:
+                        self.logger.info('New best {} for model {}. Saving model.\n'.format(
+                            self.early_stopping_metric, indx))
+                    if save_best_model_to_prefixes[indx] is not None:
+                        models[indx].save(save_best_model_to_prefixes[indx])
+                elif early_stoppings[indx].stop and verbose:
+                    self.logger.info('Model {} stopped after {} epochs.\n'.format(indx, epoch))
+            active_indxs = [indx for indx in active_indxs if not early_stoppings[indx].stop]
+            if len(active_indxs) == 0:
+                break
+        train_iterator.close()
+
+        if verbose:  # end of training messages
+            self.logger.info(
+                'Finished training after {} epochs.'.format(epoch))
+            for indx, prefix in enumerate(save_best_model_to_prefixes):
+                if prefix is not None:
+                    self.logger.info("Model {0}: the best architecture and weights (from epoch {1}) "
+                                     'were saved to {2}.arch.json and {2}.weights.h5'.format(
+                                         indx, early_stoppings[indx].best_epoch, prefix))
+
+    def test(self, model, queue, batch_size=1000, verbose=True, test_size=None,
+             rc_average=False):
+        return self.test_many([model], queue, batch_size=batch_size,
+                              verbose=verbose, test_size=test_size,
+                              rc_average=rc_average)[0]
+
+    def test_many(self, models, queue, batch_size=1000, verbose=True, test_size=None,
+                  rc_average=False, ensemble=False, bootstrap_samples=0, confidence=0.95):
+        """
+        Tests several models in a single pass over the queue.
+
+        Each batch is extracted once and run through every model.
+        If rc_average, predictions are averaged with the reverse complement's.
+        If bootstrap_samples, results have confidence intervals from that many
+        bootstrap resamples of the examples.
+        Returns a list with a ClassificationResult per model, followed by
+        the result of the averaged predictions if ensemble.
+        """
+        labels, predictions = self.predict_labeled_many(
+            models, queue, batch_size=batch_size, verbose=verbose, test_size=test_size,
+            rc_average=rc_average)
+        if ensemble:
+            predictions.append(np.mean(predictions, axis=0))
+        return [self.evaluate(labels, model_predictions, bootstrap_samples=bootstrap_samples,
+                              confidence=confidence)
+                for model_predictions in predictions]
+
+    def evaluate(self, labels, predictions, bootstrap_samples=0, confidence=0.95):
+        return ClassificationResult(labels, predictions, task_names=self.task_names,
+                                    n_jobs=self.metrics_n_jobs,
+                                    bootstrap_samples=bootstrap_samples, confidence=confidence)
+
+    def predict_labeled_many(self, models, queue, batch_size=1000, verbose=True, test_size=None,
+                             rc_average=False, return_intervals=False):
+        """
+        Predicts with several models on labeled examples in a single pass over the queue.
+
+        Returns the labels array and a list with the predictions array of each model,
+        followed by a dict of interval arrays as predict_many if return_intervals.
+        """
         iterator = None
         process = psutil.Process(os.getpid())
 
@@ -149,15 +464,20 @@ class ClassifierTrainer(object):
             if verbose:
                 progbar = Progbar(target=num_examples)
 
-            predictions = []
+            predictions = [[] for _ in models]
             labels = []
+            intervals = {'chrom': [], 'start': [], 'end': []}
 
             for batch_indx, batch in enumerate(iterator):
                 if batch_indx == num_batches:
                     break
-                predictions.append(
-                    np.vstack(model.model.predict_on_batch(batch)))
+                for model_predictions, model in zip(predictions, models):
+                    model_predictions.append(
+                        model.predict_on_batch(batch, rc_average=rc_average))
                 labels.append(batch['labels'])
+                if return_intervals:
+                    for key, values in intervals.items():
+                        values.append(batch['intervals/{}'.format(key)])
                 if verbose:
                     if batch_indx % BATCH_FREQ_UPDATE_MEM_USAGE == 0:
                         rss_minus_shr_memory = get_rss_prop()
@@ -172,13 +492,45 @@ class ClassifierTrainer(object):
                 iterator.close()  # NOQA
             raise e
 
-        predictions = np.vstack(predictions)
         labels = np.vstack(labels)
-        return ClassificationResult(labels, predictions, task_names=self.task_names)
-
-    def predict(self, model, queue, batch_size=1000, verbose=True):
+        predictions = [np.vstack(model_predictions) for model_predictions in predictions]
+        if return_intervals:
+            return labels, predictions, {key: np.concatenate(values)
+                                         for key, values in intervals.items()}
+        return labels, predictions
+
+    def predict(self, model, queue, batch_size=1000, verbose=True, writer=None,
+                rc_average=False):
+        """
+        Predicts on every example in the queue.
+
+        Returns a dict of interval arrays and the predictions array. If writer,
+        a StreamingPredictionWriter, is set each batch is written as it arrives
+        instead, nothing is accumulated and the number of examples is returned.
+        If rc_average, predictions are averaged with the reverse complement's.
+        """
+        if writer is not None:
+            return self.predict_many([model], queue, batch_size=batch_size, verbose=verbose,
+                                     writers=[writer], rc_average=rc_average)
+        intervals, predictions = self.predict_many(
+            [model], queue, batch_size=batch_size, verbose=verbose, rc_average=rc_average)
+        return intervals, predictions[0]
+
+    def predict_many(self, models, queue, batch_size=1000, verbose=True, writers=None,
+                     rc_average=False, ensemble=False):
+        """
+        Predicts with several models in a single pass over the queue.
+
+        Returns a dict of interval arrays and a list with the predictions array
+        of each model, followed by the averaged predictions if ensemble. If
+        writers are set, one per predictions array, each batch is written as
+        it arrives instead and the number of examples is returned.
+        """
         iterator = None
         process = psutil.Process(os.getpid())
+        num_outputs = len(models) + 1 if ensemble else len(models)
+        if writers is not None:
+            assert len(writers) == num_outputs
 
         def get_rss_prop():  # this is quite expensive
             return (process.memory_info().rss - process.memory_info().shared) / 10**6
@@ -195,14 +547,26 @@ class ClassifierTrainer(object):
             chroms = []
             starts = []
             ends = []
-            predictions = []
+            predictions = [[] for _ in range(num_outputs)]
+            num_examples = 0
 
             for batch_indx, batch in enumerate(iterator):
-                chroms.append(batch['intervals/chrom'])
-                starts.append(batch['intervals/start'])
-                ends.append(batch['intervals/end'])
-                predictions.append(
-                    np.vstack(model.model.predict_on_batch(batch)))
+                batch_predictions = [model.predict_on_batch(batch, rc_average=rc_average)
+                                     for model in models]
+                if ensemble:
+                    batch_predictions.append(np.mean(batch_predictions, axis=0))
+                num_examples += len(batch_predictions[0])
+                if writers is not None:
+                    for writer, output_predictions in zip(writers, batch_predictions):
+                        writer.write(batch['intervals/chrom'], batch['intervals/start'],
+                                     batch['intervals/end'], output_predictions)
+                else:
+                    chroms.append(batch['intervals/chrom'])
+                    starts.append(batch['intervals/start'])
+                    ends.append(batch['intervals/end'])
+                    for output_predictions, output_batch_predictions in zip(
+                            predictions, batch_predictions):
+                        output_predictions.append(output_batch_predictions)
 
                 if verbose:
                     if batch_indx % BATCH_FREQ_UPDATE_MEM_USAGE == 0:
@@ -219,9 +583,12 @@ class ClassifierTrainer(object):
                 iterator.close()  # NOQA
             raise e
 
+        if writers is not None:
+            return num_examples
+
         # concatenate intervals and predictions
         intervals = {'chrom': np.concatenate(chroms),
                      'start': np.concatenate(starts),
                      'end': np.concatenate(ends)}
-        predictions = np.vstack(predictions)
+        predictions = [np.vstack(output_predictions) for output_predictions in predictions]
         return intervals, predictions